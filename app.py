@@ -3,7 +3,7 @@ Flask Backend for Surgical Risk Prediction System
 Provides REST API for doctor dashboard and patient portal
 """
 
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, session, Response, stream_with_context, g
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import json
@@ -12,10 +12,11 @@ import os
 from database import (
     init_database, create_user, verify_user, create_patient,
     get_patient_by_id, get_patient_by_user_id, get_patients_by_doctor,
-    get_all_patients,
     save_risk_assessment, get_latest_risk_assessment,
-    save_lifestyle_plan, get_lifestyle_plan, get_doctor_info
+    save_lifestyle_plan, get_lifestyle_plan, get_doctor_info,
+    unit_of_work, SITES, ALL_SITES, set_site, reset_site
 )
+from password_hashing import HashingOverloaded
 
 # Try to import ML predictor, but allow system to work without it
 try:
@@ -80,6 +81,72 @@ else:
 # Initialize database
 init_database()
 
+# Load the in-memory ICU bed board of every site
+import bed_board
+bed_board.load_bed_boards()
+
+# Recover the ICU waitlist queue of every site from icu_waitlist
+import icu_waitlist_queue
+icu_waitlist_queue.load_waitlist_queues()
+
+# Periodic ANALYZE / incremental vacuum / integrity check
+import db_maintenance
+db_maintenance.start_scheduler()
+
+# Assign freed ICU beds to waiting patients in the background
+import auto_allocator
+auto_allocator.start_auto_allocators()
+
+
+# ============================================================================
+# MULTI-SITE ROUTING
+# ============================================================================
+
+# Endpoints that authenticate against a site chosen in the request body
+SITE_LOGIN_ENDPOINTS = {'register', 'login', 'admin_login'}
+
+# Endpoints that fan out over every site with ?site=*; the others work on one
+# site's database (its bed board, waitlist queue, event stream or tables)
+SITE_AGGREGATE_ENDPOINTS = {
+    'admin_check_session', 'get_icu_status', 'get_icu_status_endpoint', 'get_waitlist_endpoint',
+    'get_icu_queue_endpoint', 'get_occupancy_forecast_endpoint', 'get_icu_history_endpoint',
+    'get_icu_occupancy_history_endpoint', 'get_analytics_endpoint', 'get_icu_recommendations_endpoint',
+    'get_all_patients_endpoint', 'get_auto_allocator_endpoint', 'get_query_stats_endpoint'
+}
+
+
+@app.before_request
+def select_site():
+    """In multi-site mode, point the database layer at the session's site shard"""
+    if not SITES:
+        return None
+    
+    if request.endpoint in SITE_LOGIN_ENDPOINTS:
+        site = (request.get_json(silent=True) or {}).get('site')
+        if site not in SITES:
+            return jsonify({'error': f'site required (one of: {", ".join(SITES)})'}), 400
+    else:
+        site = session.get('site')
+        # Admins may target another site, or ALL_SITES for hospital-wide aggregates
+        if 'admin_id' in session and request.args.get('site'):
+            site = request.args['site']
+    
+    if site:
+        if site != ALL_SITES and site not in SITES:
+            return jsonify({'error': f'Unknown site: {site}'}), 400
+        if site == ALL_SITES and request.endpoint not in SITE_AGGREGATE_ENDPOINTS:
+            return jsonify({'error': f'site={ALL_SITES} is not supported here; choose one of: '
+                                     f'{", ".join(SITES)}'}), 400
+        g.site_token = set_site(site)
+    return None
+
+
+@app.teardown_request
+def release_site(exc=None):
+    token = g.pop('site_token', None)
+    if token is not None:
+        reset_site(token)
+
 
 # ============================================================================
 # UTILITY FUNCTIONS
@@ -152,6 +219,8 @@ def register():
             'user_id': user_id
         }), 201
         
+    except HashingOverloaded:
+        return jsonify({'error': 'Server busy, please retry shortly'}), 503, {'Retry-After': '1'}
     except Exception as e:
         # Check for duplicate email
         if 'UNIQUE constraint failed' in str(e):
@@ -177,6 +246,8 @@ def login():
         # Create session (no PHI in session - only IDs and type)
         session['user_id'] = user['user_id']
         session['user_type'] = user['user_type']
+        if SITES:
+            session['site'] = data['site']
         session.permanent = True
         
         return jsonify({
@@ -190,6 +261,8 @@ def login():
             }
         }), 200
         
+    except HashingOverloaded:
+        return jsonify({'error': 'Server busy, please retry shortly'}), 503, {'Retry-After': '1'}
     except Exception as e:
         return jsonify({'error': f'Login failed: {str(e)}'}), 500
 
@@ -428,18 +501,7 @@ def assess_patient_risk(patient_id):
             prediction = predictor.predict(patient)
             recommendations = ClinicalRecommendations.generate_recommendations(prediction)
         
-        # Save assessment to database
-        assessment_id = save_risk_assessment(
-            patient_id=patient_id,
-            overall_risk=prediction['overall_risk'],
-            risks=prediction['risks'],
-            recommendations=json.dumps(recommendations),
-            contributing_factors=json.dumps(prediction['contributing_factors'])
-        )
-        
         # Generate ICU prediction
-        from database import save_icu_prediction, add_to_icu_waitlist
-        
         if predictor is None:
             # Mock ICU prediction
             icu_prediction = {
@@ -451,20 +513,35 @@ def assess_patient_risk(patient_id):
         else:
             icu_prediction = predictor.predict_icu_need(patient, prediction)
         
-        # Save ICU prediction to database
-        prediction_id = save_icu_prediction(
-            patient_id=patient_id,
-            assessment_id=assessment_id,
-            prediction_data=icu_prediction
-        )
+        from database import save_icu_prediction
+        from icu_waitlist_queue import add_to_icu_waitlist
         
-        # If ICU needed and HIGH/CRITICAL risk, add to waitlist automatically
-        if icu_prediction['icu_needed'] and prediction['overall_risk'] in ['HIGH', 'CRITICAL']:
-            add_to_icu_waitlist(
+        # The model runs before any write; only the assessment, ICU prediction and
+        # waitlist entry are written on one connection, committed together
+        with unit_of_work():
+            # Save assessment to database
+            assessment_id = save_risk_assessment(
                 patient_id=patient_id,
-                prediction_id=prediction_id,
-                priority=icu_prediction['priority_score']
+                overall_risk=prediction['overall_risk'],
+                risks=prediction['risks'],
+                recommendations=json.dumps(recommendations),
+                contributing_factors=json.dumps(prediction['contributing_factors'])
             )
+            
+            # Save ICU prediction to database
+            prediction_id = save_icu_prediction(
+                patient_id=patient_id,
+                assessment_id=assessment_id,
+                prediction_data=icu_prediction
+            )
+            
+            # If ICU needed and HIGH/CRITICAL risk, add to waitlist automatically
+            if icu_prediction['icu_needed'] and prediction['overall_risk'] in ['HIGH', 'CRITICAL']:
+                add_to_icu_waitlist(
+                    patient_id=patient_id,
+                    prediction_id=prediction_id,
+                    priority=icu_prediction['priority_score']
+                )
         
         print(f"✅ Risk assessment completed successfully")
         print(f"Overall Risk: {prediction['overall_risk']}")
@@ -683,7 +760,8 @@ def get_patient_lifestyle_plan():
 def log_symptoms():
     """Log patient symptoms"""
     try:
-        from database import save_symptom_log
+        # Group-commit writer: returns once the row is committed with its batch
+        from group_commit import save_symptom_log
         
         user_id = session['user_id']
         patient = get_patient_by_user_id(user_id)
@@ -1072,6 +1150,8 @@ def admin_login():
             session['admin_email'] = admin['email']
             session['admin_name'] = admin['full_name']
             session['admin_role'] = admin['role']
+            if SITES:
+                session['site'] = data['site']
             
             return jsonify({
                 'message': 'Login successful',
@@ -1085,6 +1165,8 @@ def admin_login():
         else:
             return jsonify({'error': 'Invalid credentials'}), 401
     
+    except HashingOverloaded:
+        return jsonify({'error': 'Server busy, please retry shortly'}), 503, {'Retry-After': '1'}
     except Exception as e:
         print(f"Admin login error: {e}")
         return jsonify({'error': 'Login failed'}), 500
@@ -1119,7 +1201,8 @@ def admin_check_session():
 def get_icu_status():
     """Get real-time ICU bed status"""
     try:
-        from database import get_all_icu_beds, get_icu_capacity
+        from database import get_icu_capacity
+        from bed_board import get_all_icu_beds
         
         beds = get_all_icu_beds()
         capacity = get_icu_capacity()
@@ -1134,15 +1217,48 @@ def get_icu_status():
         return jsonify({'error': 'Failed to fetch ICU status'}), 500
 
 
+@app.route('/api/admin/icu-events', methods=['GET'])
+@admin_required
+def icu_events_endpoint():
+    """Stream bed, capacity and waitlist changes as Server-Sent Events"""
+    try:
+        from icu_event_stream import get_event_stream
+        
+        stream = get_event_stream()
+        # EventSource sends the last ID it saw when it reconnects
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+        
+        return Response(
+            stream_with_context(stream.subscribe(last_event_id)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    
+    except Exception as e:
+        print(f"ICU events error: {e}")
+        return jsonify({'error': 'Failed to open ICU event stream'}), 500
+
+
+def _allocation_summary(assignment):
+    """An assign_waiting_patients allocation in the shape the admin dashboard shows"""
+    return {
+        'patient_id': assignment['patient_id'],
+        'patient_name': assignment['patient_name'],
+        'risk_level': assignment['risk_level'],
+        'bed_number': assignment['room_number']
+    }
+
+
 @app.route('/api/admin/auto-allocate-beds', methods=['POST'])
 @admin_required
 def auto_allocate_beds():
-    """Automatically allocate ICU beds based on patient criticality"""
+    """Automatically allocate ICU beds to the patients at the head of the waitlist queue"""
     try:
-        from database import auto_allocate_beds_by_criticality
+        from bed_assignment import assign_waiting_patients
         
         print("🔄 Starting auto-allocation...")
-        allocated = auto_allocate_beds_by_criticality()
+        allocated = [_allocation_summary(a) for a in
+                     assign_waiting_patients(allocated_by='system', from_queue=True)['assigned']]
         print(f"✅ Allocated {len(allocated)} beds")
         print(f"Allocated patients: {allocated}")
         
@@ -1158,14 +1274,33 @@ def auto_allocate_beds():
         return jsonify({'error': f'Failed to auto-allocate beds: {str(e)}'}), 500
 
 
+@app.route('/api/admin/auto-allocator', methods=['GET'])
+@admin_required
+def get_auto_allocator_endpoint():
+    """Background auto-allocation: passes, lease and bed-free-to-assignment latency"""
+    try:
+        from auto_allocator import auto_allocator_status, AUTO_ALLOCATE_ENABLED
+        
+        return jsonify({
+            'enabled': AUTO_ALLOCATE_ENABLED,
+            'allocators': auto_allocator_status()
+        }), 200
+    
+    except Exception as e:
+        print(f"Auto-allocator status error: {e}")
+        return jsonify({'error': 'Failed to fetch auto-allocator status'}), 500
+
+
 @app.route('/api/admin/manual-allocate-bed', methods=['POST'])
 @admin_required
 def manual_allocate_bed():
-    """Manually allocate one ICU bed to highest priority patient"""
+    """Manually allocate one ICU bed to the patient at the head of the waitlist queue"""
     try:
-        from database import allocate_one_bed_manually
+        from bed_assignment import assign_waiting_patients
         
-        result = allocate_one_bed_manually()
+        assigned = assign_waiting_patients(allocated_by='admin', from_queue=True, limit=1,
+                                           allocation_type='manual')['assigned']
+        result = _allocation_summary(assigned[0]) if assigned else None
         
         if result:
             return jsonify({
@@ -1190,7 +1325,7 @@ def manual_allocate_bed():
 def create_bed():
     """Create a new ICU bed"""
     try:
-        from database import create_icu_bed
+        from bed_board import create_icu_bed
         
         data = request.get_json()
         bed_id = create_icu_bed(data)
@@ -1210,7 +1345,7 @@ def create_bed():
 def update_bed_status_endpoint(bed_id):
     """Update ICU bed status"""
     try:
-        from database import update_bed_status
+        from bed_board import update_bed_status
         
         data = request.get_json()
         status = data.get('status')
@@ -1235,7 +1370,7 @@ def update_bed_status_endpoint(bed_id):
 def allocate_bed_endpoint():
     """Manually allocate a bed to a patient"""
     try:
-        from database import allocate_bed
+        from bed_board import allocate_bed
         
         data = request.get_json()
         patient_id = data.get('patient_id')
@@ -1244,11 +1379,13 @@ def allocate_bed_endpoint():
         if not patient_id or not bed_id:
             return jsonify({'error': 'Patient ID and Bed ID required'}), 400
         
+        # Clients may send an Idempotency-Key so a retried request cannot allocate twice
         allocation_id = allocate_bed(
             patient_id, 
             bed_id, 
             allocated_by=session.get('admin_id'),
-            allocation_type='manual'
+            allocation_type='manual',
+            idempotency_key=request.headers.get('Idempotency-Key')
         )
         
         if allocation_id:
@@ -1269,7 +1406,7 @@ def allocate_bed_endpoint():
 def discharge_bed_endpoint(allocation_id):
     """Discharge a patient from ICU"""
     try:
-        from database import discharge_from_icu
+        from bed_board import discharge_from_icu
         
         data = request.get_json()
         discharge_reason = data.get('discharge_reason', '')
@@ -1291,9 +1428,9 @@ def discharge_bed_endpoint(allocation_id):
 def get_waitlist_endpoint():
     """Get ICU waitlist"""
     try:
-        from database import get_icu_waitlist
+        from icu_waitlist_queue import get_icu_queue
         
-        waitlist = get_icu_waitlist()
+        waitlist = get_icu_queue()
         
         return jsonify({'waitlist': waitlist}), 200
     
@@ -1302,6 +1439,48 @@ def get_waitlist_endpoint():
         return jsonify({'error': 'Failed to fetch waitlist'}), 500
 
 
+@app.route('/api/admin/icu-waitlist/<int:waitlist_id>', methods=['PUT'])
+@admin_required
+def reprioritize_waitlist_endpoint(waitlist_id):
+    """Change the priority of a waiting patient"""
+    try:
+        from icu_waitlist_queue import get_waitlist_queue
+        
+        data = request.get_json() or {}
+        priority = data.get('priority')
+        
+        if priority is None:
+            return jsonify({'error': 'Priority required'}), 400
+        
+        if not get_waitlist_queue().reprioritize(waitlist_id, priority):
+            return jsonify({'error': 'Waitlist entry not found or no longer waiting'}), 404
+        
+        return jsonify({'message': 'Priority updated', 'waitlist_id': waitlist_id}), 200
+    
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Priority must be a number'}), 400
+    except Exception as e:
+        print(f"Waitlist update error: {e}")
+        return jsonify({'error': 'Failed to update waitlist entry'}), 500
+
+
+@app.route('/api/admin/icu-waitlist/<int:waitlist_id>', methods=['DELETE'])
+@admin_required
+def cancel_waitlist_endpoint(waitlist_id):
+    """Take a patient off the ICU waitlist"""
+    try:
+        from icu_waitlist_queue import get_waitlist_queue
+        
+        if not get_waitlist_queue().cancel(waitlist_id):
+            return jsonify({'error': 'Waitlist entry not found or no longer waiting'}), 404
+        
+        return jsonify({'message': 'Waitlist entry cancelled', 'waitlist_id': waitlist_id}), 200
+    
+    except Exception as e:
+        print(f"Waitlist cancel error: {e}")
+        return jsonify({'error': 'Failed to cancel waitlist entry'}), 500
+
+
 @app.route('/api/admin/icu-forecast', methods=['GET'])
 @admin_required
 def get_forecast_endpoint():
@@ -1324,6 +1503,69 @@ def get_forecast_endpoint():
         return jsonify({'error': 'Failed to generate forecast'}), 500
 
 
+@app.route('/api/admin/icu-occupancy-forecast', methods=['GET'])
+@admin_required
+def get_occupancy_forecast_endpoint():
+    """Monte Carlo forecast of ICU occupancy with percentile bands and overflow risk"""
+    try:
+        from icu_forecast import forecast_icu_occupancy, HORIZON_DAYS, FORECAST_SCENARIOS
+        
+        days = request.args.get('days', HORIZON_DAYS, type=int)
+        scenarios = request.args.get('scenarios', FORECAST_SCENARIOS, type=int)
+        
+        forecast = forecast_icu_occupancy(days, scenarios)
+        
+        return jsonify({'forecast': forecast}), 200
+    
+    except Exception as e:
+        print(f"Occupancy forecast error: {e}")
+        return jsonify({'error': 'Failed to generate occupancy forecast'}), 500
+
+
+@app.route('/api/admin/icu-history', methods=['GET'])
+@admin_required
+def get_icu_history_endpoint():
+    """ICU beds and capacity as they were at ?at= (ISO timestamp, UTC)"""
+    try:
+        from icu_ledger import get_icu_state_at, get_ledger_status
+
+        at = request.args.get('at')
+        if not at:
+            return jsonify({'error': 'at is required'}), 400
+        try:
+            state = get_icu_state_at(at)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify({'state': state, 'ledger': get_ledger_status()}), 200
+
+    except Exception as e:
+        print(f"ICU history error: {e}")
+        return jsonify({'error': 'Failed to reconstruct ICU state'}), 500
+
+
+@app.route('/api/admin/icu-occupancy-history', methods=['GET'])
+@admin_required
+def get_icu_occupancy_history_endpoint():
+    """Occupied beds from ?start= to ?end= (ISO, UTC) every ?step= minutes"""
+    try:
+        from icu_ledger import get_icu_occupancy_series
+
+        end = request.args.get('end') or datetime.utcnow().isoformat()
+        start = request.args.get('start') or (datetime.fromisoformat(end) - timedelta(days=1)).isoformat()
+        step = request.args.get('step', 60, type=int)
+        try:
+            series = get_icu_occupancy_series(start, end, step)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify({'series': series}), 200
+
+    except Exception as e:
+        print(f"ICU occupancy history error: {e}")
+        return jsonify({'error': 'Failed to load ICU occupancy history'}), 500
+
+
 @app.route('/api/admin/icu-analytics', methods=['GET'])
 @admin_required
 def get_analytics_endpoint():
@@ -1342,75 +1584,54 @@ def get_analytics_endpoint():
         return jsonify({'error': 'Failed to fetch analytics'}), 500
 
 
+@app.route('/api/admin/icu-trends', methods=['GET'])
+@admin_required
+def get_icu_trends_endpoint():
+    """Get per-day ICU statistics from the daily rollup"""
+    try:
+        from database import get_icu_daily_trend
+        
+        days = request.args.get('days', 365, type=int)
+        floor_number = request.args.get('floor', type=int)
+        
+        trend = get_icu_daily_trend(days, floor_number)
+        
+        return jsonify({'trend': trend}), 200
+    
+    except Exception as e:
+        print(f"ICU trends error: {e}")
+        return jsonify({'error': 'Failed to fetch ICU trends'}), 500
+
+
+@app.route('/api/admin/icu-stats/refresh', methods=['POST'])
+@admin_required
+def refresh_icu_stats_endpoint():
+    """Recompute recent days of the ICU daily statistics rollup"""
+    try:
+        from database import refresh_icu_daily_stats
+        
+        data = request.get_json(silent=True) or {}
+        days = data.get('days', 7)
+        
+        rows = refresh_icu_daily_stats(None if days is None else int(days))
+        
+        return jsonify({'message': f'{rows} daily stat row(s) recomputed'}), 200
+    
+    except Exception as e:
+        print(f"ICU stats refresh error: {e}")
+        return jsonify({'error': 'Failed to refresh ICU statistics'}), 500
+
+
 @app.route('/api/admin/icu-recommendations', methods=['GET'])
 @admin_required
-def get_icu_recommendations():
+def get_icu_recommendations_endpoint():
     """Get smart recommendations for ICU capacity management"""
     try:
-        from database import (
-            get_icu_status, get_icu_waitlist, get_all_patients,
-            get_bed_allocations, get_icu_forecast
-        )
+        from icu_recommendations import get_icu_recommendations, DEFAULT_LIMIT
         
-        # Get current ICU status
-        status = get_icu_status()
-        capacity = status.get('capacity', {})
-        utilization = capacity.get('utilization_rate', 0)
+        limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
         
-        recommendations = {
-            'postpone_elective': [],
-            'expedite_discharge': [],
-            'transfer_candidates': []
-        }
-        
-        # Only generate recommendations if capacity is tight (> 80%)
-        if utilization > 80:
-            # Get all patients with upcoming surgeries
-            patients = get_all_patients()
-            
-            # Suggest postponing LOW/MODERATE risk elective cases
-            for patient in patients:
-                if patient.get('surgery_date'):
-                    surgery_date = datetime.fromisoformat(patient['surgery_date'].replace('Z', '+00:00'))
-                    days_until = (surgery_date.date() - datetime.now().date()).days
-                    
-                    # Only consider surgeries in next 7 days
-                    if 0 <= days_until <= 7:
-                        risk_level = patient.get('risk_category', 'MODERATE')
-                        icu_prob = patient.get('icu_probability', 0)
-                        
-                        # Suggest postponing low-moderate risk with low ICU probability
-                        if risk_level in ['LOW', 'MODERATE'] and icu_prob < 30:
-                            recommendations['postpone_elective'].append({
-                                'patient_id': patient['patient_id'],
-                                'patient_name': patient['name'],
-                                'surgery_type': patient.get('surgery_type', 'General Surgery'),
-                                'surgery_date': patient['surgery_date'],
-                                'risk_level': risk_level,
-                                'icu_probability': icu_prob,
-                                'reason': 'Low ICU risk, can be safely rescheduled'
-                            })
-            
-            # Suggest expediting discharges for patients who can move to step-down
-            allocations = get_bed_allocations()
-            for allocation in allocations:
-                if allocation.get('status') == 'active':
-                    # Check stay duration
-                    admission_time = datetime.fromisoformat(allocation['allocation_time'].replace('Z', '+00:00'))
-                    stay_days = (datetime.now() - admission_time).days
-                    
-                    # Patients who have been 3+ days and are moderate risk can potentially step down
-                    if stay_days >= 3:
-                        recommendations['expedite_discharge'].append({
-                            'patient_id': allocation['patient_id'],
-                            'patient_name': allocation.get('patient_name', 'Unknown'),
-                            'bed_id': allocation['bed_id'],
-                            'room_number': allocation.get('room_number', 'N/A'),
-                            'current_stay_days': stay_days,
-                            'reason': 'Extended stay, candidate for step-down care'
-                        })
-        
-        return jsonify({'recommendations': recommendations}), 200
+        return jsonify(get_icu_recommendations(limit)), 200
     
     except Exception as e:
         print(f"Recommendations error: {e}")
@@ -1422,15 +1643,139 @@ def get_icu_recommendations():
 @app.route('/api/admin/all-patients', methods=['GET'])
 @admin_required
 def get_all_patients_endpoint():
-    """Get all patients for ICU overview"""
+    """Get all patients for ICU overview (streamed straight from the cursor)"""
     try:
-        patients = get_all_patients()
-        return jsonify({'patients': patients}), 200
+        from database import stream_all_patients_json
+        
+        # Pull the first chunk now so query errors are reported as a 500 below
+        chunks = stream_all_patients_json()
+        first_chunk = next(chunks)
+        
+        def generate():
+            yield '{"patients":' + first_chunk
+            yield from chunks
+            yield '}'
+        
+        return Response(stream_with_context(generate()), mimetype='application/json'), 200
     except Exception as e:
         print(f"All patients error: {e}")
         return jsonify({'error': 'Failed to fetch all patients'}), 500
 
 
+@app.route('/api/admin/archive-symptom-logs', methods=['POST'])
+@admin_required
+def archive_symptom_logs_endpoint():
+    """Move symptom logs older than the hot window into the archive database"""
+    try:
+        from database import archive_symptom_logs, SYMPTOM_HOT_MONTHS
+        
+        data = request.get_json(silent=True) or {}
+        hot_months = int(data.get('hot_months', SYMPTOM_HOT_MONTHS))
+        
+        result = archive_symptom_logs(hot_months)
+        moved = sum(month['rows_moved'] for month in result['months'])
+        
+        return jsonify({
+            'message': f'{moved} symptom log(s) archived',
+            'archived': result
+        }), 200
+    
+    except Exception as e:
+        print(f"Symptom archive error: {e}")
+        return jsonify({'error': 'Failed to archive symptom logs'}), 500
+
+
+@app.route('/api/admin/migrate-recommendations', methods=['POST'])
+@admin_required
+def migrate_recommendations_endpoint():
+    """Move inline recommendation JSON into shared recommendation sets"""
+    try:
+        from database import migrate_recommendation_sets
+        
+        report = migrate_recommendation_sets()
+        
+        return jsonify({
+            'message': f"{report['assessments_migrated']} assessment(s) migrated",
+            'report': report
+        }), 200
+    
+    except Exception as e:
+        print(f"Recommendation migration error: {e}")
+        return jsonify({'error': 'Failed to migrate recommendations'}), 500
+
+
+@app.route('/api/admin/maintenance', methods=['GET'])
+@admin_required
+def get_maintenance_status_endpoint():
+    """Get database size, page statistics and recent maintenance runs"""
+    try:
+        limit = request.args.get('limit', 20, type=int)
+        
+        return jsonify(db_maintenance.get_maintenance_status(limit)), 200
+    
+    except Exception as e:
+        print(f"Maintenance status error: {e}")
+        return jsonify({'error': 'Failed to fetch maintenance status'}), 500
+
+
+@app.route('/api/admin/maintenance/run', methods=['POST'])
+@admin_required
+def run_maintenance_endpoint():
+    """Run database maintenance tasks now"""
+    try:
+        data = request.get_json(silent=True) or {}
+        tasks = data.get('tasks') or None
+        unknown = set(tasks or []) - set(db_maintenance.TASKS)
+        if unknown:
+            return jsonify({'error': f'Unknown tasks: {", ".join(sorted(unknown))}'}), 400
+        
+        results = db_maintenance.run_maintenance(
+            tasks, full_analyze=bool(data.get('full_analyze')),
+            page_budget=int(data.get('page_budget', db_maintenance.VACUUM_PAGE_BUDGET))
+        )
+        failed = [r['task'] for r in results if r['status'] != 'ok']
+        
+        return jsonify({
+            'message': f'{len(results) - len(failed)} task(s) completed'
+                       + (f', failed: {", ".join(failed)}' if failed else ''),
+            'runs': results
+        }), 200
+    
+    except Exception as e:
+        print(f"Maintenance run error: {e}")
+        return jsonify({'error': 'Failed to run maintenance'}), 500
+
+
+@app.route('/api/admin/query-stats', methods=['GET'])
+@admin_required
+def get_query_stats_endpoint():
+    """Get per-statement SQL latency statistics, the recent slow-query log and write batching"""
+    try:
+        import query_stats
+        from group_commit import symptom_writer
+        from bed_board import bed_board_status
+        from icu_waitlist_queue import waitlist_queue_status
+        from icu_event_stream import event_stream_status
+        from auto_allocator import auto_allocator_status
+        
+        limit = request.args.get('limit', 50, type=int)
+        stats = query_stats.get_query_stats(limit)
+        stats['symptom_group_commit'] = symptom_writer().stats()
+        stats['bed_boards'] = bed_board_status()
+        stats['waitlist_queues'] = waitlist_queue_status()
+        stats['icu_event_streams'] = event_stream_status()
+        stats['auto_allocators'] = auto_allocator_status()
+        
+        if request.args.get('reset') == '1':
+            query_stats.reset()
+        
+        return jsonify(stats), 200
+    
+    except Exception as e:
+        print(f"Query stats error: {e}")
+        return jsonify({'error': 'Failed to fetch query statistics'}), 500
+
+
 # ============================================================================
 # ICU BED MANAGEMENT - HELPER FUNCTIONS
 # ============================================================================
@@ -1464,7 +1809,8 @@ def enqueue_patient_for_icu():
     Called automatically after AI model generates predictions
     """
     try:
-        from database import add_to_icu_waitlist, get_icu_prediction
+        from database import get_icu_prediction
+        from icu_waitlist_queue import add_to_icu_waitlist
         
         data = request.get_json()
         patient_id = data.get('patient_id')
@@ -1512,9 +1858,9 @@ def enqueue_patient_for_icu():
 def get_icu_status_endpoint():
     """Get real-time ICU bed occupancy status"""
     try:
-        from database import get_icu_status
+        from database import get_icu_capacity
         
-        status = get_icu_status()
+        status = get_icu_capacity()
         
         return jsonify(status), 200
     
@@ -1528,16 +1874,10 @@ def get_icu_status_endpoint():
 def get_icu_queue_endpoint():
     """Get current ICU queue (waiting patients sorted by priority)"""
     try:
-        from database import get_icu_waitlist
-        
-        queue = get_icu_waitlist()
+        from icu_waitlist_queue import get_icu_queue
         
-        # Calculate wait time for each patient
-        for patient in queue:
-            if patient.get('added_at'):
-                added_time = datetime.fromisoformat(patient['added_at'].replace('Z', '+00:00'))
-                wait_hours = (datetime.now() - added_time).total_seconds() / 3600
-                patient['wait_hours'] = round(wait_hours, 1)
+        # Queue order, aged priority and wait time come from the in-memory queue
+        queue = get_icu_queue()
         
         return jsonify({
             'queue': queue,
@@ -1558,10 +1898,7 @@ def get_icu_allocation_logs():
         
         limit = request.args.get('limit', 50, type=int)
         
-        allocations = get_bed_allocations()
-        
-        # Limit results
-        allocations = allocations[:limit] if allocations else []
+        allocations = get_bed_allocations(limit)
         
         # Add human-readable timestamps
         for allocation in allocations:
@@ -1584,7 +1921,7 @@ def get_icu_allocation_logs():
 def manual_bed_assignment():
     """Manually assign ICU bed to a patient (admin override)"""
     try:
-        from database import allocate_bed, get_available_icu_beds
+        from bed_board import allocate_bed
         
         data = request.get_json()
         patient_id = data.get('patient_id')
@@ -1598,7 +1935,8 @@ def manual_bed_assignment():
             patient_id=patient_id,
             bed_id=bed_id,
             allocated_by=session.get('email', 'admin'),
-            allocation_type='manual'
+            allocation_type='manual',
+            idempotency_key=request.headers.get('Idempotency-Key')
         )
         
         if not allocation_id:
@@ -1620,19 +1958,14 @@ def manual_bed_assignment():
 def release_bed_endpoint(bed_id):
     """Release/discharge patient from ICU bed"""
     try:
-        from database import discharge_from_icu, get_bed_allocations
+        from database import get_active_allocation
+        from bed_board import discharge_from_icu
         
         data = request.get_json()
         discharge_reason = data.get('discharge_reason', 'Discharged')
         
         # Find active allocation for this bed
-        allocations = get_bed_allocations()
-        active_allocation = None
-        
-        for allocation in allocations:
-            if allocation.get('bed_id') == bed_id and not allocation.get('actual_discharge'):
-                active_allocation = allocation
-                break
+        active_allocation = get_active_allocation(bed_id)
         
         if not active_allocation:
             return jsonify({'error': 'No active allocation found for this bed'}), 404
@@ -1662,63 +1995,36 @@ def auto_assign_beds():
     """
     Background job/API to automatically assign available beds to highest-priority patients in queue
     Can be called manually or run as a scheduled task
+    Body (optional): {"strategy": "greedy" | "optimal"}. Both assign the same
+    highest-priority patients; "optimal" chooses the beds that maximise the
+    batch's total match score instead of letting each patient pick in turn.
     """
     try:
-        from database import (
-            get_available_icu_beds, get_icu_waitlist, allocate_bed,
-            get_icu_prediction
-        )
+        from bed_assignment import assign_waiting_patients, STRATEGIES
         
-        assigned = []
+        data = request.get_json(silent=True) or {}
+        strategy = data.get('strategy', 'greedy')
+        if strategy not in STRATEGIES:
+            return jsonify({'error': f"strategy must be one of: {', '.join(STRATEGIES)}"}), 400
         
-        # Get available beds and waiting patients
-        available_beds = get_available_icu_beds()
-        waitlist = get_icu_waitlist()  # Already sorted by priority
+        plan = assign_waiting_patients(strategy)
         
-        if not available_beds or not waitlist:
+        if not plan['assignments']:
             return jsonify({
                 'status': 'no_action',
                 'message': 'No beds available or no patients waiting',
                 'assigned': []
             }), 200
         
-        # Match patients to beds
-        for patient in waitlist:
-            if not available_beds:
-                break  # No more beds available
-            
-            patient_id = patient['patient_id']
-            
-            # Get patient's requirements
-            prediction = get_icu_prediction(patient_id)
-            
-            # Find best matching bed
-            best_bed = _select_best_bed(available_beds, prediction)
-            
-            # Allocate the bed
-            allocation_id = allocate_bed(
-                patient_id=patient_id,
-                bed_id=best_bed['bed_id'],
-                allocated_by='system',
-                allocation_type='automatic'
-            )
-            
-            if allocation_id:
-                assigned.append({
-                    'patient_id': patient_id,
-                    'patient_name': patient.get('patient_name'),
-                    'bed_id': best_bed['bed_id'],
-                    'room_number': best_bed.get('room_number'),
-                    'allocation_id': allocation_id
-                })
-                
-                # Remove assigned bed from available list
-                available_beds = [b for b in available_beds if b['bed_id'] != best_bed['bed_id']]
-        
         return jsonify({
             'status': 'completed',
-            'message': f'{len(assigned)} bed(s) assigned automatically',
-            'assigned': assigned
+            'message': f"{len(plan['assigned'])} bed(s) assigned automatically",
+            'assigned': plan['assigned'],
+            'strategy': strategy,
+            'total_score': plan['total_score'],
+            'greedy_total_score': plan['greedy_total_score'],
+            'improvement': plan['improvement'],
+            'solver': plan['solver']
         }), 200
     
     except Exception as e:
@@ -1733,10 +2039,9 @@ def auto_assign_beds():
 def auto_allocate_bed():
     """Automatically allocate best-matching ICU bed for a patient"""
     try:
-        from database import (
-            get_available_icu_beds, allocate_bed, 
-            get_icu_prediction, add_to_icu_waitlist
-        )
+        from database import get_icu_prediction
+        from bed_board import get_available_icu_beds, allocate_bed
+        from icu_waitlist_queue import add_to_icu_waitlist
         
         data = request.get_json()
         patient_id = data.get('patient_id')
@@ -1785,6 +2090,9 @@ def auto_allocate_bed():
             allocation_type='automatic'
         )
         
+        if not allocation_id:
+            return jsonify({'error': 'Bed was allocated concurrently, please retry'}), 409
+        
         return jsonify({
             'status': 'allocated',
             'message': 'ICU bed allocated successfully',
@@ -1799,39 +2107,12 @@ def auto_allocate_bed():
 
 def _select_best_bed(available_beds, prediction):
     """Select the best bed based on patient needs and bed features"""
-    risk_level = prediction.get('risk_level', 'MODERATE')
-    
-    # Score each bed
-    bed_scores = []
-    for bed in available_beds:
-        score = 0
-        
-        # Proximity to nursing station (higher priority for critical patients)
-        if risk_level in ['CRITICAL', 'HIGH']:
-            # Closer is better for critical patients (lower proximity value)
-            score += (10 - bed.get('proximity_to_nursing_station', 5)) * 10
-        else:
-            # Farther is acceptable for stable patients (save close beds)
-            score += bed.get('proximity_to_nursing_station', 5) * 5
-        
-        # Equipment match (perfect match gets bonus)
-        if prediction.get('ventilator_needed') and bed.get('has_ventilator'):
-            score += 30
-        if prediction.get('dialysis_needed') and bed.get('has_dialysis'):
-            score += 30
-        
-        # Cost optimization (prefer lower cost for moderate risk)
-        if risk_level == 'MODERATE':
-            # Prefer cheaper beds for moderate risk
-            max_cost = 5000
-            score += (max_cost - bed.get('bed_cost_per_day', 2500)) / 100
-        
-        bed_scores.append({'bed': bed, 'score': score})
-    
-    # Sort by score (highest first)
-    bed_scores.sort(key=lambda x: x['score'], reverse=True)
+    from bed_assignment import score_matrix
     
-    return bed_scores[0]['bed'] if bed_scores else available_beds[0]
+    # Proximity to the nursing station by risk level, equipment match and,
+    # for moderate risk, cost; see bed_assignment.score_matrix
+    scores = score_matrix([prediction], available_beds)[0]
+    return available_beds[int(scores.argmax())]
 
 
 # ============================================================================
@@ -0,0 +1,160 @@
+"""
+Asyncio facade for the database layer
+Runs the blocking functions in database.py on dedicated worker threads so an
+async server never blocks its event loop on SQLite:
+  - one writer thread owning the only write connection
+  - a small pool of reader threads, each with its own query_only connection
+  - a bound on in-flight calls so callers queue in the event loop (backpressure)
+
+Usage:
+    adb = AsyncDatabase()
+    patients = await adb.get_all_patients()
+    async with adb.transaction() as tx:
+        assessment_id = await tx.save_risk_assessment(...)
+        await tx.save_icu_prediction(patient_id, assessment_id, data)
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import database
+
+# database.py functions with these prefixes never write
+READ_PREFIXES = ('get_', 'verify_')
+
+# database.py callables that are not data functions
+NOT_EXPORTED = {
+    'get_db_connection', 'unit_of_work', 'bind_thread_connection',
+    'set_site', 'reset_site', 'use_site', 'current_site', 'current_database_path',
+    'shard_path', 'fan_out', 'site_aggregate'
+}
+
+
+# The connection owned by the current worker thread
+_worker = threading.local()
+
+
+def _open_thread_connection(site=None, read_only=False):
+    """Executor initializer: give this worker thread its own long-lived connection"""
+    _worker.conn = database._connect(database.shard_path(site) if site else None, read_only=read_only)
+    database.bind_thread_connection(_worker.conn)
+
+
+def _close_thread_connection(barrier=None):
+    """Close this worker thread's connection (the barrier makes every reader take one task)"""
+    if barrier is not None:
+        barrier.wait()
+    database.bind_thread_connection(None)
+    _worker.conn.close()
+
+
+def _call(fn, args, kwargs):
+    return fn(*args, **kwargs)
+
+
+def _call_and_commit(fn, args, kwargs):
+    """Run a write on the writer thread and commit it"""
+    try:
+        result = fn(*args, **kwargs)
+        _worker.conn.commit()
+        return result
+    except Exception:
+        _worker.conn.rollback()
+        raise
+
+
+def _finish_transaction(commit):
+    if commit:
+        _worker.conn.commit()
+    else:
+        _worker.conn.rollback()
+
+
+def _data_function(name):
+    """Look up a public data function in database.py"""
+    fn = getattr(database, name, None)
+    if name.startswith('_') or name in NOT_EXPORTED or not callable(fn) \
+            or getattr(fn, '__module__', None) != database.__name__:
+        raise AttributeError(name)
+    return fn
+
+
+class AsyncDatabase:
+    """Awaitable versions of the database.py data functions"""
+
+    def __init__(self, readers=4, max_pending=256, site=None):
+        """In multi-site mode each AsyncDatabase serves one site's shard"""
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='db-writer',
+            initializer=_open_thread_connection, initargs=(site,)
+        )
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix='db-reader',
+            initializer=_open_thread_connection, initargs=(site, True)
+        )
+        self._reader_count = readers
+        self._pending = asyncio.Semaphore(max_pending)
+        self._write_lock = asyncio.Lock()
+
+    async def _submit(self, executor, fn, *args):
+        async with self._pending:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, fn, *args)
+
+    async def read(self, fn, *args, **kwargs):
+        """Run a read-only database function on a reader thread"""
+        return await self._submit(self._readers, _call, fn, args, kwargs)
+
+    async def write(self, fn, *args, **kwargs):
+        """Run a database function on the writer thread and commit it"""
+        async with self._write_lock:
+            return await self._submit(self._writer, _call_and_commit, fn, args, kwargs)
+
+    def transaction(self):
+        """Async context manager grouping several writes into one commit"""
+        return _AsyncTransaction(self)
+
+    def __getattr__(self, name):
+        fn = _data_function(name)
+        if getattr(fn, 'read_only', False) or name.startswith(READ_PREFIXES):
+            return partial(self.read, fn)
+        return partial(self.write, fn)
+
+    def close(self):
+        """Close the worker connections and stop the executors"""
+        self._writer.submit(_close_thread_connection).result()
+        # The barrier makes every reader thread (started or not) take exactly one close task
+        barrier = threading.Barrier(self._reader_count)
+        futures = [self._readers.submit(_close_thread_connection, barrier)
+                   for _ in range(self._reader_count)]
+        for future in futures:
+            future.result()
+        self._writer.shutdown()
+        self._readers.shutdown()
+
+
+class _AsyncTransaction:
+    """Writes issued through this object share one commit on the writer connection"""
+
+    def __init__(self, db):
+        self._db = db
+
+    async def __aenter__(self):
+        await self._db._write_lock.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self._db._submit(self._db._writer, _finish_transaction, exc_type is None)
+        finally:
+            self._db._write_lock.release()
+        return False
+
+    async def call(self, fn, *args, **kwargs):
+        """Run any database function inside the transaction"""
+        return await self._db._submit(self._db._writer, _call, fn, args, kwargs)
+
+    def __getattr__(self, name):
+        return partial(self.call, _data_function(name))
@@ -0,0 +1,267 @@
+"""
+Background ICU auto-allocation
+One worker thread per database runs bed_assignment.assign_waiting_patients
+whenever a bed may have become free or a patient joined the waitlist, so a
+freed bed does not sit idle until someone presses a button. Only patients
+waiting in the icu_waitlist queue are candidates, in queue order, so
+cancellations and new priorities made through the queue are respected.
+
+  - The bed board and the waitlist queue wake the worker after every write
+    (notify()); changes made elsewhere are seen through PRAGMA data_version
+    every POLL_SECONDS.
+  - Wakes are debounced: the pass runs once no new wake came for
+    DEBOUNCE_SECONDS, and at the latest MAX_DELAY_SECONDS after the first,
+    so a burst of discharges is assigned in one batch.
+  - A pass only touches the database when, from memory, the bed board has
+    an available bed and the queue a waiting patient.
+  - Passes run under the job_leases row LEASE_NAME, so of several processes
+    only one allocates at a time; the others skip their pass. The holder
+    renews the lease once half of it has run out and keeps it while idle,
+    and sees the other processes' changes through data_version.
+
+Metrics: the time from a bed becoming free to its assignment, read from the
+icu_events ledger (first 'available' event after the bed was last busy, to
+the 'occupied' event of the assignment), over the last LATENCY_SAMPLES
+assignments.
+
+Configuration: the workers are off unless RECOVAI_AUTO_ALLOCATE=1, and then
+start with a pass for the patients already queued;
+RECOVAI_AUTO_ALLOCATE_DEBOUNCE_SECONDS and RECOVAI_AUTO_ALLOCATE_STRATEGY
+('greedy' or 'optimal') tune them.
+"""
+
+import os
+import socket
+import statistics
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+
+import database
+
+AUTO_ALLOCATE_ENABLED = os.environ.get('RECOVAI_AUTO_ALLOCATE', '0') == '1'
+DEBOUNCE_SECONDS = float(os.environ.get('RECOVAI_AUTO_ALLOCATE_DEBOUNCE_SECONDS', '1.0'))
+MAX_DELAY_SECONDS = 10.0
+POLL_SECONDS = 5.0
+STRATEGY = os.environ.get('RECOVAI_AUTO_ALLOCATE_STRATEGY', 'optimal')
+
+LEASE_NAME = 'icu_auto_allocate'
+LEASE_SECONDS = 60
+LATENCY_SAMPLES = 1000
+ALLOCATED_BY = 'auto-allocator'
+
+
+def bed_free_latencies(bed_ids):
+    """
+    {bed_id: (free_at, assigned_at, seconds)} for beds just assigned, from the
+    ledger: assigned_at is the bed's last 'occupied' event and free_at the
+    first event after it was last busy before that
+    """
+    if not bed_ids:
+        return {}
+    placeholders = ','.join('?' * len(bed_ids))
+    with database.get_db_connection(read_only=True) as conn:
+        rows = conn.execute(f'''
+            WITH assigned AS (
+                SELECT bed_id, MAX(event_id) as occupied_id
+                FROM icu_events
+                WHERE bed_id IN ({placeholders}) AND status = 'occupied'
+                GROUP BY bed_id
+            ),
+            busy AS (
+                SELECT a.bed_id, a.occupied_id,
+                       (SELECT COALESCE(MAX(x.event_id), 0) FROM icu_events x
+                        WHERE x.bed_id = a.bed_id AND x.event_id < a.occupied_id
+                        AND x.status != 'available') as busy_id
+                FROM assigned a
+            ),
+            spans AS (
+                SELECT b.bed_id,
+                       (SELECT MIN(f.occurred_at) FROM icu_events f
+                        WHERE f.bed_id = b.bed_id
+                        AND f.event_id > b.busy_id AND f.event_id < b.occupied_id) as free_at,
+                       (SELECT occurred_at FROM icu_events WHERE event_id = b.occupied_id) as assigned_at
+                FROM busy b
+            )
+            SELECT bed_id, free_at, assigned_at,
+                   (julianday(assigned_at) - julianday(free_at)) * 86400 as seconds
+            FROM spans
+            WHERE free_at IS NOT NULL
+        ''', list(bed_ids)).fetchall()
+    return {row['bed_id']: (row['free_at'], row['assigned_at'], row['seconds']) for row in rows}
+
+
+class AutoAllocator:
+    """Debounced background assignment of one database's free beds"""
+
+    def __init__(self, path, site=None, debounce=DEBOUNCE_SECONDS, strategy=STRATEGY):
+        self.path = path
+        self.site = site
+        self.debounce = debounce
+        self.strategy = strategy
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{id(self):x}'
+        self._conn = database._connect(path, read_only=True, cross_thread=True)
+        self._version = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._counters = {'wakes': 0, 'passes': 0, 'skipped_idle': 0, 'lease_denied': 0,
+                          'assigned': 0, 'errors': 0}
+        self._last_pass = None
+        self._lease_until = 0
+        self._thread = threading.Thread(target=self._run, name='icu-auto-allocate', daemon=True)
+
+    def _site(self):
+        return database.use_site(self.site) if self.site else nullcontext()
+
+    def start(self):
+        self._thread.start()
+        # Patients may already be waiting for free beds
+        self.notify()
+        return self
+
+    def notify(self):
+        """A bed or the waitlist changed; run a pass after the debounce"""
+        with self._lock:
+            self._counters['wakes'] += 1
+        self._wake.set()
+
+    def _changed(self):
+        """Whether another connection committed since the last check"""
+        version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        changed = version != self._version
+        self._version = version
+        return changed
+
+    def _run(self):
+        with self._site():
+            self._changed()
+            while not self._stop.is_set():
+                if not self._wake.wait(POLL_SECONDS) and not self._changed():
+                    continue
+                # Let a burst of changes settle into one pass
+                first = time.monotonic()
+                self._wake.clear()
+                while (self._wake.wait(self.debounce) and not self._stop.is_set()
+                       and time.monotonic() - first < MAX_DELAY_SECONDS):
+                    self._wake.clear()
+                self._wake.clear()
+                if self._stop.is_set():
+                    return
+                self._changed()
+                try:
+                    self.run_pass()
+                except Exception as e:
+                    with self._lock:
+                        self._counters['errors'] += 1
+                    print(f"⚠️  ICU auto-allocation failed: {e}")
+
+    def run_pass(self):
+        """One assignment pass under the lease; returns the beds assigned"""
+        import bed_assignment
+        import bed_board
+
+        import icu_waitlist_queue
+
+        if not bed_board.get_bed_board().counts().get('available') or \
+                not len(icu_waitlist_queue.get_waitlist_queue()):
+            with self._lock:
+                self._counters['skipped_idle'] += 1
+            return []
+        if not self._hold_lease():
+            with self._lock:
+                self._counters['lease_denied'] += 1
+            return []
+
+        start = time.perf_counter()
+        plan = bed_assignment.assign_waiting_patients(self.strategy, allocated_by=ALLOCATED_BY,
+                                                      from_queue=True)
+        assigned = plan['assigned']
+        latencies = bed_free_latencies([a['bed_id'] for a in assigned])
+        duration_ms = round((time.perf_counter() - start) * 1000, 3)
+        if assigned:
+            print(f"🛏️  Auto-allocated {len(assigned)} ICU bed(s) in {duration_ms:.0f} ms")
+
+        with self._lock:
+            self._counters['passes'] += 1
+            self._counters['assigned'] += len(assigned)
+            self._latencies.extend(seconds for _, _, seconds in latencies.values())
+            self._last_pass = {'at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'assigned': len(assigned),
+                               'duration_ms': duration_ms}
+        return assigned
+
+    def _hold_lease(self):
+        """Take or renew the lease, writing only once half of it has run out"""
+        now = time.time()
+        if now < self._lease_until - LEASE_SECONDS / 2:
+            return True
+        if not database.acquire_lease(LEASE_NAME, self.holder, LEASE_SECONDS):
+            self._lease_until = 0
+            return False
+        self._lease_until = now + LEASE_SECONDS
+        return True
+
+    def status(self):
+        with self._lock:
+            samples = sorted(self._latencies)
+            latency = None
+            if samples:
+                latency = {
+                    'samples': len(samples),
+                    'p50': round(statistics.median(samples), 3),
+                    'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+                    'max': round(samples[-1], 3),
+                    'mean': round(statistics.fmean(samples), 3)
+                }
+            return dict(self._counters, path=self.path, holder=self.holder, strategy=self.strategy,
+                        last_pass=self._last_pass, bed_free_to_assignment_seconds=latency)
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._conn.close()
+        try:
+            with self._site():
+                database.release_lease(LEASE_NAME, self.holder)
+        except Exception as e:
+            print(f"⚠️  Could not release the auto-allocation lease: {e}")
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def start_auto_allocators():
+    """Start the worker of every site's database (no-op when disabled)"""
+    if not AUTO_ALLOCATE_ENABLED:
+        return
+    sites = database.SITES or [None]
+    with _allocators_lock:
+        for site in sites:
+            with database.use_site(site) if site else nullcontext():
+                path = database.current_database_path()
+                if path not in _allocators:
+                    _allocators[path] = AutoAllocator(path, site).start()
+
+
+def notify(path):
+    """Wake the worker of a database after a bed or waitlist write, if it is running"""
+    allocator = _allocators.get(path)
+    if allocator is not None:
+        allocator.notify()
+
+
+def auto_allocator_status():
+    with _allocators_lock:
+        return [allocator.status() for allocator in _allocators.values()]
+
+
+def stop_auto_allocators():
+    with _allocators_lock:
+        for allocator in _allocators.values():
+            allocator.close()
+        _allocators.clear()
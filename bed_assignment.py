@@ -0,0 +1,216 @@
+"""
+Batch ICU bed assignment
+Scores every (waiting patient, available bed) pair at once with the criteria
+of app._select_best_bed and solves the whole batch as a maximum-score
+assignment, instead of letting each patient in turn take the bed that is
+best for them alone - which can hand the only dialysis bed to someone who
+did not need it.
+
+Priority is a hard constraint: with B free beds the first B patients of the
+waitlist (already in priority order) are the ones assigned, exactly as the
+greedy walk would; only which of them gets which bed is optimised.
+
+The assignment uses scipy.optimize.linear_sum_assignment when scipy is
+installed and a NumPy shortest-augmenting-path Hungarian solver otherwise.
+
+assign_waiting_patients() runs a whole round against the database: one
+waitlist query, one bulk prediction query and one transaction for every
+allocation.
+"""
+
+import time
+
+import numpy as np
+
+import bed_board
+import database
+
+try:
+    from scipy.optimize import linear_sum_assignment
+    SCIPY_AVAILABLE = True
+except ImportError:
+    linear_sum_assignment = None
+    SCIPY_AVAILABLE = False
+
+STRATEGIES = ('greedy', 'optimal')
+
+# _select_best_bed's defaults for missing bed fields
+DEFAULT_PROXIMITY = 5
+DEFAULT_COST = 2500
+MAX_COST = 5000
+
+
+def _column(beds, key, default):
+    return np.array([default if bed.get(key) is None else bed[key] for bed in beds], dtype=float)
+
+
+def score_matrix(predictions, beds):
+    """
+    scores[i, j] = _select_best_bed's score of beds[j] for predictions[i]
+    A missing prediction scores like {} (MODERATE, no equipment needs).
+    """
+    predictions = [prediction or {} for prediction in predictions]
+    risk = np.array([p.get('risk_level', 'MODERATE') for p in predictions])
+    critical = np.isin(risk, ['CRITICAL', 'HIGH'])[:, None]
+    moderate = (risk == 'MODERATE')[:, None]
+    needs_ventilator = np.array([bool(p.get('ventilator_needed')) for p in predictions])[:, None]
+    needs_dialysis = np.array([bool(p.get('dialysis_needed')) for p in predictions])[:, None]
+
+    proximity = _column(beds, 'proximity_to_nursing_station', DEFAULT_PROXIMITY)[None, :]
+    ventilator = _column(beds, 'has_ventilator', 0)[None, :] > 0
+    dialysis = _column(beds, 'has_dialysis', 0)[None, :] > 0
+    cost = _column(beds, 'bed_cost_per_day', DEFAULT_COST)[None, :]
+
+    # Critical patients want the beds nearest the nursing station; stable ones leave them free
+    scores = np.where(critical, (10 - proximity) * 10, proximity * 5)
+    scores = scores + 30 * (needs_ventilator & ventilator) + 30 * (needs_dialysis & dialysis)
+    # Moderate-risk patients prefer cheaper beds
+    return scores + np.where(moderate, (MAX_COST - cost) / 100, 0)
+
+
+def greedy_assignment(scores):
+    """
+    Each row in order takes its highest-scoring remaining column (first on ties),
+    as the auto-assign loop does; returns the column per row
+    """
+    remaining = np.ones(scores.shape[1], dtype=bool)
+    columns = np.empty(scores.shape[0], dtype=int)
+    for i, row in enumerate(scores):
+        j = int(np.argmax(np.where(remaining, row, -np.inf)))
+        columns[i] = j
+        remaining[j] = False
+    return columns
+
+
+def _hungarian(cost):
+    """
+    Minimum-cost assignment of every row of an n x m cost matrix (n <= m) to a
+    distinct column; returns the column per row. Shortest augmenting paths
+    with potentials, O(n^2 m), the inner loop vectorised over columns.
+    """
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    # owner[j]: row (1-based) assigned to column j (1-based), 0 if free
+    owner = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        owner[0] = i
+        j0 = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            free = ~used[1:]
+            slack = cost[i0 - 1] - u[i0] - v[1:]
+            improved = free & (slack < min_slack[1:])
+            min_slack[1:][improved] = slack[improved]
+            way[1:][improved] = j0
+            j1 = int(np.argmin(np.where(free, min_slack[1:], np.inf))) + 1
+            delta = min_slack[j1]
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_slack[1:][free] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+
+    columns = np.empty(n, dtype=int)
+    assigned = np.nonzero(owner[1:])[0]
+    columns[owner[1:][assigned] - 1] = assigned
+    return columns
+
+
+def optimal_assignment(scores):
+    """Maximum total-score assignment of every row to a distinct column (rows <= columns)"""
+    if SCIPY_AVAILABLE:
+        rows, columns = linear_sum_assignment(scores, maximize=True)
+        return columns[np.argsort(rows)]
+    return _hungarian(-scores)
+
+
+def plan_assignments(waitlist, predictions, beds, strategy='optimal'):
+    """
+    Decide which bed each of the highest-priority waiting patients gets
+    waitlist: patients in priority order; predictions: {patient_id: prediction}
+    Returns {'assignments': [{'patient', 'bed', 'score'}], 'total_score',
+    'greedy_total_score', 'improvement', 'strategy', 'solver', 'solve_ms'}.
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f'Unknown assignment strategy: {strategy}')
+
+    patients = waitlist[:len(beds)]
+    if not patients:
+        return {'assignments': [], 'total_score': 0.0, 'greedy_total_score': 0.0,
+                'improvement': 0.0, 'strategy': strategy, 'solver': None, 'solve_ms': 0.0}
+
+    start = time.perf_counter()
+    scores = score_matrix([predictions.get(p['patient_id']) for p in patients], beds)
+    rows = np.arange(len(patients))
+    greedy = greedy_assignment(scores)
+    if strategy == 'optimal':
+        columns = optimal_assignment(scores)
+        solver = 'scipy' if SCIPY_AVAILABLE else 'numpy'
+    else:
+        columns = greedy
+        solver = 'greedy'
+    solve_ms = (time.perf_counter() - start) * 1000
+
+    total = float(scores[rows, columns].sum())
+    greedy_total = float(scores[rows, greedy].sum())
+    return {
+        'assignments': [
+            {'patient': patient, 'bed': beds[j], 'score': round(float(scores[i, j]), 2)}
+            for i, (patient, j) in enumerate(zip(patients, columns))
+        ],
+        'total_score': round(total, 2),
+        'greedy_total_score': round(greedy_total, 2),
+        'improvement': round(total - greedy_total, 2),
+        'strategy': strategy,
+        'solver': solver,
+        'solve_ms': round(solve_ms, 3)
+    }
+
+
+def assign_waiting_patients(strategy='greedy', allocated_by='system', from_queue=False,
+                            limit=None, allocation_type='automatic'):
+    """
+    Assign the available beds to the highest-priority waiting patients
+    Candidates come from database.get_icu_waitlist(), or with from_queue=True
+    only from the waiting entries of the icu_waitlist queue, in queue order;
+    limit caps how many of them are assigned.
+    Returns the plan_assignments result plus 'assigned': the allocations
+    that were made (a bed taken meanwhile by another process is skipped).
+    """
+    board = bed_board.get_bed_board()
+    beds = board.search('available')
+    # Only the patients who can get a bed matter
+    wanted = len(beds) if limit is None else min(limit, len(beds))
+    if from_queue:
+        import icu_waitlist_queue
+        candidates = icu_waitlist_queue.get_icu_queue(wanted)
+    else:
+        candidates = database.get_icu_waitlist()[:wanted]
+    predictions = database.get_icu_predictions([p['patient_id'] for p in candidates])
+    plan = plan_assignments(candidates, predictions, beds, strategy)
+
+    allocation_ids = board.allocate_many(
+        [(a['patient']['patient_id'], a['bed']['bed_id']) for a in plan['assignments']],
+        allocated_by=allocated_by,
+        allocation_type=allocation_type
+    )
+    plan['assigned'] = [{
+        'patient_id': a['patient']['patient_id'],
+        'patient_name': a['patient'].get('patient_name'),
+        'risk_level': a['patient'].get('risk_level'),
+        'bed_id': a['bed']['bed_id'],
+        'room_number': a['bed'].get('room_number'),
+        'allocation_id': allocation_id,
+        'score': a['score']
+    } for a, allocation_id in zip(plan['assignments'], allocation_ids) if allocation_id]
+    return plan
@@ -0,0 +1,366 @@
+"""
+In-memory ICU bed board
+Keeps every icu_beds row in process, indexed by status and by equipment
+bitmask and sorted by proximity to the nursing station, so availability
+checks and filtered bed searches no longer query the database.
+
+Writes go through the board: it runs the usual database function on its own
+connection, commits, then re-reads the beds it touched. Before every read the
+board compares PRAGMA data_version, which only changes when another
+connection (another worker process, a unit of work, a bulk allocation) has
+committed, and rebuilds itself from icu_beds if so. The database stays the
+arbiter: allocate_bed still re-checks the bed inside its transaction.
+
+Two locks: _lock guards the in-memory indexes and is only held for lookups,
+syncs and refreshes; _conn_lock serialises use of the board's connection and
+is held by a write for its whole transaction. A read that finds a write in
+progress skips its data_version check and answers from the board as it is, so
+a writer waiting on a busy database never holds up the reads.
+
+Lookups (with n beds and k results):
+  get / is_available / count    O(1)
+  search(status, filters)       O(k log 16), merging at most 16 mask buckets
+  best_available(filters)       O(16)
+"""
+
+import heapq
+import threading
+from bisect import bisect_left, insort
+from itertools import islice
+
+import auto_allocator
+import database
+import icu_event_stream
+
+# Equipment bits; a bed's mask is the OR of the features it has
+EQUIPMENT_BITS = {
+    'has_ventilator': 1,
+    'has_dialysis': 2,
+    'has_ecmo': 4,
+    'isolation_room': 8
+}
+ALL_MASKS = range(1 << len(EQUIPMENT_BITS))
+
+# Masks that include every bit of the key, i.e. beds that satisfy a filter
+_SUPERSETS = {required: [mask for mask in ALL_MASKS if mask & required == required]
+              for required in ALL_MASKS}
+
+
+def equipment_mask(features):
+    """Bitmask of the truthy equipment flags in a bed row or filter dict"""
+    mask = 0
+    if features:
+        for column, bit in EQUIPMENT_BITS.items():
+            if features.get(column):
+                mask |= bit
+    return mask
+
+
+def _sort_key(bed):
+    # Nearest the nursing station first, then oldest bed, as the SQL lookups order them
+    proximity = bed.get('proximity_to_nursing_station')
+    return (-1 if proximity is None else proximity, bed['bed_id'])
+
+
+class BedBoard:
+    """Authoritative in-process view of one database's icu_beds table"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn_lock = threading.RLock()
+        self._conn = database._connect(path, cross_thread=True)
+        self._version = None
+        self._reloads = 0
+        self._beds = {}
+        # status -> sorted [(proximity, bed_id)]
+        self._by_status = {}
+        # (status, equipment mask) -> sorted [(proximity, bed_id)]
+        self._by_mask = {}
+        self.load()
+
+    # ---- index maintenance ----
+
+    def load(self):
+        """Rebuild the board from icu_beds"""
+        with self._conn_lock, self._lock:
+            version = self._data_version()
+            rows = self._conn.execute('SELECT * FROM icu_beds').fetchall()
+            self._beds = {}
+            self._by_status = {}
+            self._by_mask = {}
+            for row in rows:
+                self._add(dict(row))
+            # Read before the SELECT, so a commit landing in between triggers another load
+            self._version = version
+            self._reloads += 1
+
+    def _data_version(self):
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _sync(self):
+        """Reload if another connection committed; a no-op while a write holds the connection"""
+        if not self._conn_lock.acquire(blocking=False):
+            return
+        try:
+            if self._data_version() != self._version:
+                self.load()
+        finally:
+            self._conn_lock.release()
+
+    def _add(self, bed):
+        key = _sort_key(bed)
+        self._beds[bed['bed_id']] = bed
+        insort(self._by_status.setdefault(bed['status'], []), key)
+        insort(self._by_mask.setdefault((bed['status'], equipment_mask(bed)), []), key)
+
+    def _remove(self, bed_id):
+        bed = self._beds.pop(bed_id, None)
+        if bed is None:
+            return
+        key = _sort_key(bed)
+        for keys in (self._by_status[bed['status']],
+                     self._by_mask[(bed['status'], equipment_mask(bed))]):
+            del keys[bisect_left(keys, key)]
+
+    def _refresh(self, bed_ids):
+        """Re-read the given beds after a write"""
+        for bed_id in bed_ids:
+            row = self._conn.execute('SELECT * FROM icu_beds WHERE bed_id = ?', (bed_id,)).fetchone()
+            self._remove(bed_id)
+            if row is not None:
+                self._add(dict(row))
+
+    # ---- reads ----
+
+    def get(self, bed_id):
+        """One bed, or None"""
+        with self._lock:
+            self._sync()
+            bed = self._beds.get(bed_id)
+            return dict(bed) if bed else None
+
+    def is_available(self, bed_id):
+        with self._lock:
+            self._sync()
+            bed = self._beds.get(bed_id)
+            return bed is not None and bed['status'] == 'available'
+
+    def count(self, status=None):
+        """Number of beds, or of beds in one status"""
+        with self._lock:
+            self._sync()
+            if status is None:
+                return len(self._beds)
+            return len(self._by_status.get(status, ()))
+
+    def counts(self):
+        """{status: number of beds}"""
+        with self._lock:
+            self._sync()
+            return {status: len(keys) for status, keys in self._by_status.items() if keys}
+
+    def beds(self):
+        """Every bed, ordered by floor and room like get_all_icu_beds"""
+        with self._lock:
+            self._sync()
+            beds = [dict(bed) for bed in self._beds.values()]
+        beds.sort(key=lambda bed: (bed['floor_number'], bed['room_number']))
+        return beds
+
+    def search(self, status='available', filters=None, limit=None):
+        """
+        Beds in a status that have at least the equipment in filters, nearest
+        the nursing station first
+        """
+        with self._lock:
+            self._sync()
+            buckets = [self._by_mask[(status, mask)]
+                       for mask in _SUPERSETS[equipment_mask(filters)]
+                       if (status, mask) in self._by_mask]
+            keys = heapq.merge(*buckets)
+            if limit is not None:
+                keys = islice(keys, limit)
+            return [dict(self._beds[bed_id]) for _, bed_id in keys]
+
+    def best_available(self, filters=None):
+        """The nearest available bed with the required equipment, or None"""
+        with self._lock:
+            self._sync()
+            heads = [self._by_mask[('available', mask)][0]
+                     for mask in _SUPERSETS[equipment_mask(filters)]
+                     if self._by_mask.get(('available', mask))]
+            return dict(self._beds[min(heads)[1]]) if heads else None
+
+    def status(self):
+        with self._lock:
+            return {'path': self.path, 'beds': len(self._beds), 'reloads': self._reloads,
+                    'by_status': {s: len(keys) for s, keys in self._by_status.items() if keys}}
+
+    # ---- write-through ----
+
+    def _write(self, bed_ids, fn, *args):
+        """
+        Run a database function in a BEGIN IMMEDIATE transaction on the board's
+        connection and re-read bed_ids (None: the bed_id fn returned). Inside a
+        unit of work it joins that transaction instead and the board catches up
+        through data_version once it commits.
+        """
+        if getattr(database._local, 'conn', None) is not None:
+            return fn(*args)
+
+        with self._conn_lock:
+            with self._lock:
+                self._sync()
+            database.bind_thread_connection(self._conn)
+            try:
+                result = database.run_immediate(self._conn, fn, *args)
+            finally:
+                database.bind_thread_connection(None)
+            with self._lock:
+                self._refresh([result] if bed_ids is None else bed_ids)
+        icu_event_stream.notify(self.path)
+        auto_allocator.notify(self.path)
+        return result
+
+    def allocate(self, patient_id, bed_id, allocated_by='system', allocation_type='automatic',
+                 idempotency_key=None):
+        """database.allocate_bed; beds the board already knows are taken fail without a query"""
+        # A unit of work may have freed the bed in its own, not yet committed, transaction,
+        # and a repeated request must get its allocation back although the bed is now taken
+        if (getattr(database._local, 'conn', None) is None and idempotency_key is None
+                and not self.is_available(bed_id)):
+            return None
+        return self._write([bed_id], database.allocate_bed,
+                           patient_id, bed_id, allocated_by, allocation_type, idempotency_key)
+
+    def allocate_many(self, allocations, allocated_by='system', allocation_type='automatic'):
+        """
+        database.allocate_bed for each (patient_id, bed_id) pair, all in one
+        transaction; returns the allocation_id (None for a taken bed) per pair
+        """
+        if not allocations:
+            return []
+
+        def allocate_all():
+            return [database.allocate_bed(patient_id, bed_id, allocated_by, allocation_type)
+                    for patient_id, bed_id in allocations]
+        return self._write([bed_id for _, bed_id in allocations], allocate_all)
+
+    def discharge(self, allocation_id, discharge_reason=''):
+        """database.discharge_from_icu"""
+        with self._conn_lock:
+            row = self._conn.execute(
+                'SELECT bed_id FROM bed_allocations WHERE allocation_id = ?', (allocation_id,)
+            ).fetchone()
+        bed_ids = [row['bed_id']] if row else []
+        return self._write(bed_ids, database.discharge_from_icu, allocation_id, discharge_reason)
+
+    def set_status(self, bed_id, status):
+        """database.update_bed_status"""
+        return self._write([bed_id], database.update_bed_status, bed_id, status)
+
+    def add_bed(self, bed_data):
+        """database.create_icu_bed; returns the new bed_id"""
+        return self._write(None, database.create_icu_bed, bed_data)
+
+    def close(self):
+        with self._conn_lock, self._lock:
+            self._conn.close()
+
+
+_boards = {}
+_boards_lock = threading.Lock()
+
+
+def get_bed_board():
+    """The bed board of the current site's database, built on first use"""
+    path = database.current_database_path()
+    board = _boards.get(path)
+    if board is None:
+        with _boards_lock:
+            board = _boards.get(path)
+            if board is None:
+                board = _boards[path] = BedBoard(path)
+    return board
+
+
+def load_bed_boards():
+    """Build (or rebuild) the board of every site at startup"""
+    if not database.SITES:
+        get_bed_board().load()
+        return
+    for site in database.SITES:
+        with database.use_site(site):
+            get_bed_board().load()
+
+
+def bed_board_status():
+    """Size and reload count of every loaded board"""
+    with _boards_lock:
+        return [board.status() for board in _boards.values()]
+
+
+def close_bed_boards():
+    with _boards_lock:
+        for board in _boards.values():
+            board.close()
+        _boards.clear()
+
+
+# ---- drop-in replacements for the database functions of the same name ----
+
+def _occupants(patient_ids):
+    """Name and latest risk level of each patient occupying a bed"""
+    if not patient_ids:
+        return {}
+    placeholders = ', '.join('?' * len(patient_ids))
+    with database.get_db_connection(read_only=True) as conn:
+        rows = conn.execute(f'''
+            SELECT
+                p.patient_id,
+                u.full_name as patient_name,
+                (SELECT ra.overall_risk FROM risk_assessments ra
+                 WHERE ra.patient_id = p.patient_id
+                 ORDER BY ra.assessed_at DESC LIMIT 1) as patient_risk
+            FROM patients p
+            LEFT JOIN users u ON p.user_id = u.user_id
+            WHERE p.patient_id IN ({placeholders})
+        ''', list(patient_ids)).fetchall()
+    return {row['patient_id']: dict(row) for row in rows}
+
+
+@database.site_aggregate(database._merge_site_lists)
+def get_all_icu_beds():
+    """Every bed with its occupant's name and latest risk level"""
+    beds = get_bed_board().beds()
+    occupants = _occupants({bed['patient_id'] for bed in beds if bed['patient_id'] is not None})
+    for bed in beds:
+        occupant = occupants.get(bed['patient_id'], {})
+        bed['current_patient_id'] = occupant.get('patient_id')
+        bed['patient_name'] = occupant.get('patient_name')
+        bed['patient_risk'] = occupant.get('patient_risk')
+    return beds
+
+
+def get_available_icu_beds(filters=None):
+    """Available beds with at least the requested equipment, nearest first"""
+    return get_bed_board().search('available', filters)
+
+
+def allocate_bed(patient_id, bed_id, allocated_by='system', allocation_type='automatic',
+                 idempotency_key=None):
+    return get_bed_board().allocate(patient_id, bed_id, allocated_by, allocation_type,
+                                    idempotency_key)
+
+
+def discharge_from_icu(allocation_id, discharge_reason=''):
+    return get_bed_board().discharge(allocation_id, discharge_reason)
+
+
+def update_bed_status(bed_id, status):
+    return get_bed_board().set_status(bed_id, status)
+
+
+def create_icu_bed(bed_data):
+    return get_bed_board().add_bed(bed_data)
@@ -5,18 +5,204 @@ HIPAA-compliant SQLite database with user, patient, and assessment tracking
 
 import sqlite3
 import os
-from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+import json
+import hashlib
+import re
+import queue
+import random
+import threading
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import wraps
 from contextlib import contextmanager
 
+import query_stats
+from password_hashing import hash_password, check_password
+
 DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'surgical_risk.db')
 
+# Read-only functions borrow query_only connections from a small per-file pool
+READ_POOL_ENABLED = os.environ.get('RECOVAI_READ_POOL', '1') == '1'
+READ_POOL_SIZE = int(os.environ.get('RECOVAI_READ_POOL_SIZE', '4'))
+
+# Retries of a write transaction that found the database busy, and the first backoff
+BUSY_RETRIES = int(os.environ.get('RECOVAI_BUSY_RETRIES', '5'))
+BUSY_BACKOFF_SECONDS = 0.01
+
+# Multi-site mode: with RECOVAI_SITES=site_a,site_b each hospital site gets its own
+# database file next to DATABASE_PATH and every request selects one with use_site()
+SITES = [site.strip() for site in os.environ.get('RECOVAI_SITES', '').split(',') if site.strip()]
+
+# Selecting ALL_SITES makes admin aggregates fan out across every shard
+ALL_SITES = '*'
+
+_site = contextvars.ContextVar('recovai_site', default=None)
+
+
+class SiteRequiredError(RuntimeError):
+    """Raised in multi-site mode when a query runs without a single site selected"""
+
+
+def shard_path(site):
+    """Database file for one site"""
+    if site not in SITES:
+        raise ValueError(f'Unknown site: {site}')
+    return f'{os.path.splitext(DATABASE_PATH)[0]}_{site}.db'
+
+
+def current_site():
+    return _site.get()
+
+
+def current_database_path():
+    """Database file for the selected site (DATABASE_PATH when not in multi-site mode)"""
+    if not SITES:
+        return DATABASE_PATH
+    site = _site.get()
+    if site is None or site == ALL_SITES:
+        raise SiteRequiredError('No site selected for this database operation')
+    return shard_path(site)
+
+
+def set_site(site):
+    """Select the site for the current context; returns a token for reset_site()"""
+    if site != ALL_SITES:
+        shard_path(site)
+    return _site.set(site)
+
+
+def reset_site(token):
+    _site.reset(token)
+
 
 @contextmanager
-def get_db_connection():
-    """Context manager for database connections"""
-    conn = sqlite3.connect(DATABASE_PATH)
+def use_site(site):
+    """Run the block against one site's database (or ALL_SITES for aggregates)"""
+    token = set_site(site)
+    try:
+        yield
+    finally:
+        reset_site(token)
+
+
+# Per-thread state: the connection shared by an active unit_of_work(), and
+# whether the running function was marked @read_only
+_local = threading.local()
+
+
+def _connect(path=None, read_only=False, cross_thread=False):
+    """
+    Open a new connection to the database
+    query_only connections may cross threads; so may others opened with
+    cross_thread=True, whose owner must serialise access itself.
+    """
+    conn = sqlite3.connect(
+        path or current_database_path(),
+        factory=query_stats.connection_factory(),
+        check_same_thread=not (read_only or cross_thread)
+    )
     conn.row_factory = sqlite3.Row
+    if read_only:
+        conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+class _ReadPool:
+    """Fixed-size pool of query_only connections to one database file"""
+    
+    def __init__(self, path, size):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+    
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return _connect(self.path, read_only=True)
+        except Exception:
+            self._slots.release()
+            raise
+    
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+        self._slots.release()
+    
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_read_pools = {}
+_read_pools_lock = threading.Lock()
+
+
+def _read_pool():
+    """The read pool for the current database file"""
+    path = current_database_path()
+    pool = _read_pools.get(path)
+    if pool is None:
+        with _read_pools_lock:
+            pool = _read_pools.setdefault(path, _ReadPool(path, READ_POOL_SIZE))
+    return pool
+
+
+def close_read_pools():
+    """Close every idle pooled read connection"""
+    with _read_pools_lock:
+        for pool in _read_pools.values():
+            pool.close()
+        _read_pools.clear()
+
+
+def read_only(fn):
+    """Route the function's queries to the read pool (unless a unit of work is active)"""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, 'read_only', False):
+            return fn(*args, **kwargs)
+        _local.read_only = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.read_only = False
+    wrapper.read_only = True
+    return wrapper
+
+
+@contextmanager
+def get_db_connection(read_only=False):
+    """
+    Context manager for database connections
+    Inside a unit_of_work() the shared connection is reused and left for the
+    unit of work to commit or roll back. With read_only=True, or inside a
+    @read_only function, a pooled query_only connection is used.
+    """
+    shared = getattr(_local, 'conn', None)
+    if shared is not None:
+        yield shared
+        return
+    
+    if READ_POOL_ENABLED and (read_only or getattr(_local, 'read_only', False)):
+        pool = _read_pool()
+        conn = pool.acquire()
+        try:
+            yield conn
+        finally:
+            pool.release(conn)
+        return
+    
+    conn = _connect()
     try:
         yield conn
         conn.commit()
@@ -27,11 +213,433 @@ def get_db_connection():
         conn.close()
 
 
+@contextmanager
+def unit_of_work():
+    """
+    Run several data functions on one connection and commit once
+    Every database function called on this thread inside the block shares the
+    connection; the block commits on success and rolls back everything on error.
+    Nested units of work join the outermost one.
+    """
+    shared = getattr(_local, 'conn', None)
+    if shared is not None:
+        yield shared
+        return
+    
+    with get_db_connection() as conn:
+        # Reads of archived symptom logs need it attached before the transaction starts
+        _attach_symptom_archive(conn)
+        _local.conn = conn
+        try:
+            yield conn
+        finally:
+            _local.conn = None
+
+
+def _is_busy(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def run_immediate(conn, fn, *args, retries=None):
+    """
+    Run fn(*args) in a BEGIN IMMEDIATE transaction on conn and commit
+    The write lock is taken before fn reads anything, so nothing can change
+    between its checks and its writes. While the database stays busy past the
+    connection's timeout, the whole transaction is retried with exponential
+    backoff and jitter, then the error is raised.
+    """
+    retries = BUSY_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = fn(*args)
+            conn.commit()
+            return result
+        except Exception as e:
+            conn.rollback()
+            if not _is_busy(e) or attempt == retries:
+                raise
+            time.sleep(BUSY_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def bind_thread_connection(conn):
+    """
+    Make conn the connection every database function uses on this thread
+    Used by long-lived worker threads; the caller owns commits and closing.
+    Pass None to unbind.
+    """
+    _local.conn = conn
+
+
+def acquire_lease(name, holder, seconds):
+    """
+    Take or renew the lease on a background job for seconds; True if holder has it
+    A lease held by someone else is only taken over once it has expired, so
+    one holder at a time runs the job, across threads and processes.
+    """
+    now = time.time()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO job_leases (name, holder, acquired_at, expires_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                acquired_at = CASE WHEN holder = excluded.holder THEN acquired_at
+                                   ELSE excluded.acquired_at END,
+                holder = excluded.holder,
+                expires_at = excluded.expires_at
+            WHERE holder = excluded.holder OR expires_at < excluded.acquired_at
+        ''', (name, holder, now, now + seconds))
+        return cursor.rowcount > 0
+
+
+def release_lease(name, holder):
+    """Give up a lease, if holder still has it"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM job_leases WHERE name = ? AND holder = ?', (name, holder))
+        return cursor.rowcount > 0
+
+
+_fan_out_executor = None
+_fan_out_lock = threading.Lock()
+
+
+def _run_on_site(site, fn, args, kwargs):
+    with use_site(site):
+        return fn(*args, **kwargs)
+
+
+def fan_out(fn, *args, **kwargs):
+    """Run fn against every site's database in parallel; returns {site: result}"""
+    global _fan_out_executor
+    if _fan_out_executor is None:
+        with _fan_out_lock:
+            if _fan_out_executor is None:
+                _fan_out_executor = ThreadPoolExecutor(
+                    max_workers=max(1, len(SITES)), thread_name_prefix='db-fan-out'
+                )
+    futures = {site: _fan_out_executor.submit(_run_on_site, site, fn, args, kwargs)
+               for site in SITES}
+    return {site: future.result() for site, future in futures.items()}
+
+
+def site_aggregate(merge):
+    """
+    With ALL_SITES selected, run the function on every shard in parallel and
+    combine the per-site results with merge({site: result})
+    """
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if SITES and _site.get() == ALL_SITES:
+                return merge(fan_out(fn, *args, **kwargs))
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def _merge_site_lists(results, sort_key=None):
+    """Concatenate per-site lists of dicts, tagging each row with its site"""
+    merged = [dict(row, site=site) for site, rows in results.items() for row in rows]
+    if sort_key is not None:
+        merged.sort(key=sort_key)
+    return merged
+
+
+def _merge_capacity(results):
+    counts = ['total_beds', 'available_beds', 'occupied_beds', 'maintenance_beds', 'cleaning_beds']
+    data = {key: sum(result[key] for result in results.values()) for key in counts}
+    data['occupied'] = data['occupied_beds']
+    total = data['total_beds']
+    data['utilization_rate'] = round((data['occupied_beds'] / total) * 100, 1) if total else 0
+    data['sites'] = results
+    return data
+
+
+def _merge_analytics(results):
+    results = {site: result for site, result in results.items() if result}
+    parts = list(results.values())
+    discharges = sum(p['total_admissions'] for p in parts)
+    
+    def total(key):
+        values = [p[key] for p in parts if p[key] is not None]
+        return sum(values) if values else None
+    
+    stays = [p for p in parts if p['avg_stay_duration'] is not None]
+    mins = [p['min_stay'] for p in parts if p['min_stay'] is not None]
+    maxes = [p['max_stay'] for p in parts if p['max_stay'] is not None]
+    return {
+        'avg_stay_duration': sum(p['avg_stay_duration'] * p['total_admissions'] for p in stays) / discharges
+        if stays and discharges else None,
+        'min_stay': min(mins) if mins else None,
+        'max_stay': max(maxes) if maxes else None,
+        'total_admissions': discharges,
+        'total_revenue': total('total_revenue'),
+        'readmissions': total('readmissions'),
+        'new_admissions': sum(p['new_admissions'] for p in parts),
+        'bed_days': sum(p['bed_days'] for p in parts),
+        'sites': results
+    }
+
+
+def _insert_many(cursor, query, rows):
+    """
+    Insert rows with a single executemany and return their generated IDs in order.
+    All our tables use AUTOINCREMENT keys and the write lock is held for the whole
+    statement, so the new IDs are the contiguous range ending at last_insert_rowid().
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+    cursor.executemany(query, rows)
+    last_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+
+def _json_value(value, _str=str, _float=float, _encode_str=json.encoder.encode_basestring):
+    """JSON text for one SQLite value (NULL, TEXT, INTEGER or REAL)"""
+    if value is None:
+        return 'null'
+    value_type = type(value)
+    if value_type is _str:
+        return _encode_str(value)
+    if value_type is _float:
+        return _float.__repr__(value)
+    return repr(value)
+
+
+def iter_json_array(query, params=(), chunk_size=500):
+    """
+    Stream a read query as the text of a JSON array of objects
+    Rows are fetched chunk by chunk as plain tuples and formatted straight into
+    a per-query object template, so no per-row dict is ever built.
+    """
+    with get_db_connection(read_only=True) as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(query, params)
+        template = '{' + ','.join(
+            json.dumps(col[0]).replace('%', '%%') + ':%s' for col in cursor.description
+        ) + '}'
+        
+        separator = '['
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield separator + ','.join([template % tuple(map(_json_value, row)) for row in rows])
+            separator = ','
+        yield ']' if separator == ',' else '[]'
+
+
+def _equipment_class_sql(ref):
+    """SQL expression classifying a bed row (NEW/OLD/table alias) by its most specialised equipment"""
+    return f'''CASE
+        WHEN {ref}.has_ecmo = 1 THEN 'ecmo'
+        WHEN {ref}.has_dialysis = 1 THEN 'dialysis'
+        WHEN {ref}.has_ventilator = 1 THEN 'ventilator'
+        WHEN {ref}.isolation_room = 1 THEN 'isolation'
+        ELSE 'standard'
+    END'''
+
+
+def _capacity_delta_sql(ref, sign):
+    """UPDATE applying +1/-1 for a bed row to its icu_capacity counters"""
+    return f'''
+        UPDATE icu_capacity SET
+            total_beds = total_beds {sign} 1,
+            available_beds = available_beds {sign} ({ref}.status = 'available'),
+            occupied_beds = occupied_beds {sign} ({ref}.status = 'occupied'),
+            maintenance_beds = maintenance_beds {sign} ({ref}.status = 'maintenance'),
+            cleaning_beds = cleaning_beds {sign} ({ref}.status = 'cleaning')
+        WHERE floor_number = {ref}.floor_number
+        AND equipment_class = {_equipment_class_sql(ref)};
+    '''
+
+
+def _icu_capacity_triggers():
+    """Triggers that keep icu_capacity in step with every icu_beds change"""
+    ensure_row = '''
+        INSERT OR IGNORE INTO icu_capacity (floor_number, equipment_class)
+        VALUES (NEW.floor_number, {equipment_class});
+    '''.format(equipment_class=_equipment_class_sql('NEW'))
+    return [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_capacity_bed_insert
+        AFTER INSERT ON icu_beds
+        BEGIN
+            {ensure_row}
+            {_capacity_delta_sql('NEW', '+')}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_capacity_bed_delete
+        AFTER DELETE ON icu_beds
+        BEGIN
+            {_capacity_delta_sql('OLD', '-')}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_capacity_bed_update
+        AFTER UPDATE OF status, floor_number, has_ventilator, has_dialysis, has_ecmo, isolation_room
+        ON icu_beds
+        BEGIN
+            {_capacity_delta_sql('OLD', '-')}
+            {ensure_row}
+            {_capacity_delta_sql('NEW', '+')}
+        END
+        ''',
+    ]
+
+
+# Millisecond UTC timestamps, so events of one second keep their order in time
+ICU_EVENT_TIME = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+# A bed's state as the ICU ledger records it
+ICU_EVENT_COLUMNS = 'bed_id, status, patient_id, floor_number, room_number, equipment_class'
+
+
+def _icu_event_values(ref):
+    return f"{ref}.bed_id, {ref}.status, {ref}.patient_id, {ref}.floor_number, " \
+           f"{ref}.room_number, {_equipment_class_sql(ref)}"
+
+
+def _icu_event_triggers():
+    """
+    Triggers appending every icu_beds transition to the icu_events ledger,
+    and a snapshot every ICU_SNAPSHOT_EVERY_EVENTS events
+    """
+    insert = f'INSERT INTO icu_events (occurred_at, event_type, {ICU_EVENT_COLUMNS})'
+    return [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_events_bed_insert
+        AFTER INSERT ON icu_beds
+        BEGIN
+            {insert} VALUES ({ICU_EVENT_TIME}, 'created', {_icu_event_values('NEW')});
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_events_bed_update
+        AFTER UPDATE OF status, patient_id, floor_number, room_number,
+                        has_ventilator, has_dialysis, has_ecmo, isolation_room
+        ON icu_beds
+        WHEN OLD.status IS NOT NEW.status OR OLD.patient_id IS NOT NEW.patient_id
+          OR OLD.floor_number IS NOT NEW.floor_number OR OLD.room_number IS NOT NEW.room_number
+          OR {_equipment_class_sql('OLD')} IS NOT {_equipment_class_sql('NEW')}
+        BEGIN
+            {insert} VALUES ({ICU_EVENT_TIME}, 'updated', {_icu_event_values('NEW')});
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_events_bed_delete
+        AFTER DELETE ON icu_beds
+        BEGIN
+            {insert} VALUES ({ICU_EVENT_TIME}, 'removed', {_icu_event_values('OLD')});
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_events_snapshot
+        AFTER INSERT ON icu_events
+        WHEN NEW.event_id % {ICU_SNAPSHOT_EVERY_EVENTS} = 0
+        BEGIN
+            {ICU_SNAPSHOT_INSERT.strip()};
+        END
+        ''',
+    ]
+
+
+def _icu_waitlist_triggers():
+    """
+    Triggers counting icu_waitlist writes in icu_waitlist_changes, so the
+    waitlist queue reloads on changes to its own table only
+    """
+    bump = 'UPDATE icu_waitlist_changes SET changes = changes + 1;'
+    return [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_waitlist_count_insert
+        AFTER INSERT ON icu_waitlist
+        BEGIN
+            {bump}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_waitlist_count_update
+        AFTER UPDATE OF patient_id, prediction_id, priority, status, added_at ON icu_waitlist
+        BEGIN
+            {bump}
+        END
+        ''',
+        f'''
+        CREATE TRIGGER IF NOT EXISTS icu_waitlist_count_delete
+        AFTER DELETE ON icu_waitlist
+        BEGIN
+            {bump}
+        END
+        ''',
+    ]
+
+
+# Compact snapshot of every bed, as of the newest ledger event; a single
+# statement, so the beds and MAX(event_id) are read at the same point
+ICU_SNAPSHOT_INSERT = f'''
+    INSERT INTO icu_snapshots (taken_at, last_event_id, bed_count, state)
+    SELECT
+        {ICU_EVENT_TIME},
+        (SELECT COALESCE(MAX(event_id), 0) FROM icu_events),
+        COUNT(*),
+        COALESCE(json_group_array(json_array({_icu_event_values('b')})), '[]')
+    FROM icu_beds b
+'''
+
+# Ledger events between snapshots, which bounds the replay of a time-travel query
+ICU_SNAPSHOT_EVERY_EVENTS = 500
+
+
+ICU_CAPACITY_FROM_BEDS = f'''
+    SELECT
+        b.floor_number,
+        {_equipment_class_sql('b')} as equipment_class,
+        COUNT(*) as total_beds,
+        SUM(b.status = 'available') as available_beds,
+        SUM(b.status = 'occupied') as occupied_beds,
+        SUM(b.status = 'maintenance') as maintenance_beds,
+        SUM(b.status = 'cleaning') as cleaning_beds
+    FROM icu_beds b
+    GROUP BY b.floor_number, equipment_class
+'''
+
+
+def _rebuild_icu_capacity(cursor):
+    """Recompute every icu_capacity counter from icu_beds"""
+    cursor.execute('DELETE FROM icu_capacity')
+    cursor.execute('''
+        INSERT INTO icu_capacity (
+            floor_number, equipment_class, total_beds, available_beds,
+            occupied_beds, maintenance_beds, cleaning_beds
+        )
+    ''' + ICU_CAPACITY_FROM_BEDS)
+
+
 def init_database():
-    """Initialize database with all required tables"""
+    """Initialize database with all required tables (every site's shard in multi-site mode)"""
+    if SITES and _site.get() in (None, ALL_SITES):
+        for site in SITES:
+            with use_site(site):
+                init_database()
+        return
+    
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
+        # Lets db_maintenance return free pages in small steps; only takes effect
+        # on a new database (existing ones are converted by db_maintenance)
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        
+        # WAL lets pooled readers run alongside the writer
+        cursor.execute('PRAGMA journal_mode = WAL')
+        
         # Users table (doctors and patients)
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -102,9 +710,24 @@ def init_database():
                 transfusion_risk REAL NOT NULL,
                 recommendations TEXT,
                 contributing_factors TEXT,
-                FOREIGN KEY (patient_id) REFERENCES patients(patient_id)
+                recommendation_set_id TEXT,
+                FOREIGN KEY (patient_id) REFERENCES patients(patient_id),
+                FOREIGN KEY (recommendation_set_id) REFERENCES recommendation_sets(set_id)
+            )
+        ''')
+        
+        # Recommendation JSON is shared by every assessment with the same risk
+        # categories, so it is stored once, keyed by its sha256
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS recommendation_sets (
+                set_id TEXT PRIMARY KEY,
+                recommendations TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        columns = [row['name'] for row in cursor.execute('PRAGMA table_info(risk_assessments)')]
+        if 'recommendation_set_id' not in columns:
+            cursor.execute('ALTER TABLE risk_assessments ADD COLUMN recommendation_set_id TEXT')
         
         # Lifestyle plans table
         cursor.execute('''
@@ -213,10 +836,24 @@ def init_database():
                 total_cost REAL,
                 readmitted INTEGER DEFAULT 0 CHECK(readmitted IN (0, 1)),
                 notes TEXT,
+                idempotency_key TEXT,
                 FOREIGN KEY (patient_id) REFERENCES patients(patient_id),
                 FOREIGN KEY (bed_id) REFERENCES icu_beds(bed_id)
             )
         ''')
+        columns = [row['name'] for row in cursor.execute('PRAGMA table_info(bed_allocations)')]
+        if 'idempotency_key' not in columns:
+            cursor.execute('ALTER TABLE bed_allocations ADD COLUMN idempotency_key TEXT')
+        # A retried allocation request finds its first allocation instead of making another
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_bed_allocations_idempotency_key
+            ON bed_allocations (idempotency_key) WHERE idempotency_key IS NOT NULL
+        ''')
+        # Open stays by bed, however long the allocation history grows
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_bed_allocations_active_bed
+            ON bed_allocations (bed_id) WHERE actual_discharge IS NULL
+        ''')
         
         # ICU waitlist table
         cursor.execute('''
@@ -235,14 +872,167 @@ def init_database():
             )
         ''')
         
+        # ICU capacity counters per floor and equipment class, kept by triggers
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS icu_capacity (
+                floor_number INTEGER NOT NULL,
+                equipment_class TEXT NOT NULL,
+                total_beds INTEGER NOT NULL DEFAULT 0,
+                available_beds INTEGER NOT NULL DEFAULT 0,
+                occupied_beds INTEGER NOT NULL DEFAULT 0,
+                maintenance_beds INTEGER NOT NULL DEFAULT 0,
+                cleaning_beds INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (floor_number, equipment_class)
+            )
+        ''')
+        for trigger_sql in _icu_capacity_triggers():
+            cursor.execute(trigger_sql)
+        _rebuild_icu_capacity(cursor)
+        
+        # Per-day, per-floor ICU statistics, updated on allocation and discharge
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS icu_daily_stats (
+                stat_date TEXT NOT NULL,
+                floor_number INTEGER NOT NULL,
+                admissions INTEGER NOT NULL DEFAULT 0,
+                discharges INTEGER NOT NULL DEFAULT 0,
+                bed_days REAL NOT NULL DEFAULT 0,
+                revenue REAL NOT NULL DEFAULT 0,
+                readmissions INTEGER NOT NULL DEFAULT 0,
+                total_los REAL NOT NULL DEFAULT 0,
+                min_los REAL,
+                max_los REAL,
+                PRIMARY KEY (stat_date, floor_number)
+            )
+        ''')
+        # Backfill from existing allocation history the first time
+        if not cursor.execute('SELECT 1 FROM icu_daily_stats LIMIT 1').fetchone():
+            _rebuild_icu_daily_stats(cursor)
+        
+        # History of db_maintenance runs
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task TEXT NOT NULL,
+                status TEXT NOT NULL CHECK(status IN ('ok', 'error')),
+                started_at TIMESTAMP NOT NULL,
+                duration_ms REAL,
+                size_before INTEGER,
+                size_after INTEGER,
+                details TEXT
+            )
+        ''')
+        
+        # Append-only ledger of bed transitions, with periodic snapshots (icu_ledger)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS icu_events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                occurred_at TEXT NOT NULL,
+                event_type TEXT NOT NULL CHECK(event_type IN ('created', 'updated', 'removed')),
+                bed_id INTEGER NOT NULL,
+                status TEXT,
+                patient_id INTEGER,
+                floor_number INTEGER,
+                room_number TEXT,
+                equipment_class TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_icu_events_occurred
+            ON icu_events (occurred_at)
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_icu_events_bed
+            ON icu_events (bed_id, event_id)
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS icu_snapshots (
+                snapshot_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                taken_at TEXT NOT NULL,
+                last_event_id INTEGER NOT NULL,
+                bed_count INTEGER NOT NULL,
+                state TEXT NOT NULL
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_icu_snapshots_taken
+            ON icu_snapshots (taken_at)
+        ''')
+        for trigger_sql in _icu_event_triggers():
+            cursor.execute(trigger_sql)
+        # Beds that predate the ledger start it as a baseline snapshot
+        if not cursor.execute('SELECT 1 FROM icu_snapshots LIMIT 1').fetchone() and \
+                not cursor.execute('SELECT 1 FROM icu_events LIMIT 1').fetchone() and \
+                cursor.execute('SELECT 1 FROM icu_beds LIMIT 1').fetchone():
+            cursor.execute(ICU_SNAPSHOT_INSERT)
+        
+        # Single-runner leases of background jobs (acquire_lease)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                acquired_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        
+        # Symptom history and red-flag lookups are always per patient, newest first
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_symptom_logs_patient_logged
+            ON symptom_logs (patient_id, logged_at)
+        ''')
+        
+        # Latest ICU prediction per patient (auto-assignment loads them in bulk)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_icu_predictions_patient_predicted
+            ON icu_predictions (patient_id, predicted_at)
+        ''')
+        
+        # The bed board looks up the latest assessment of each ICU occupant
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_risk_assessments_patient_assessed
+            ON risk_assessments (patient_id, assessed_at)
+        ''')
+
+        # Upcoming scheduled surgeries by date (ICU forecasts and recommendations)
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_patients_status_surgery_date
+            ON patients (status, surgery_date)
+        ''')
+
+        # Write counter of icu_waitlist, which the waitlist queue checks before reloading
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS icu_waitlist_changes (
+                id INTEGER PRIMARY KEY CHECK(id = 1),
+                changes INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('INSERT OR IGNORE INTO icu_waitlist_changes (id) VALUES (1)')
+        for trigger_sql in _icu_waitlist_triggers():
+            cursor.execute(trigger_sql)
+        
+        # One waiting entry per patient, which every allocation closes. Older
+        # databases may hold several; all but the first are cancelled.
+        cursor.execute('''
+            UPDATE icu_waitlist SET status = 'cancelled'
+            WHERE status = 'waiting' AND waitlist_id NOT IN (
+                SELECT MIN(waitlist_id) FROM icu_waitlist WHERE status = 'waiting' GROUP BY patient_id
+            )
+        ''')
+        cursor.execute('DROP INDEX IF EXISTS idx_icu_waitlist_waiting_patient')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_icu_waitlist_one_waiting
+            ON icu_waitlist (patient_id) WHERE status = 'waiting'
+        ''')
+
         print("✅ Database initialized successfully")
 
 
 def create_user(email, password, user_type, full_name, department=None):
     """Create a new user (doctor or patient)"""
+    password_hash = hash_password(password)
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        password_hash = generate_password_hash(password)
         cursor.execute('''
             INSERT INTO users (email, password_hash, user_type, full_name, department)
             VALUES (?, ?, ?, ?, ?)
@@ -250,16 +1040,18 @@ def create_user(email, password, user_type, full_name, department=None):
         return cursor.lastrowid
 
 
+@read_only
 def verify_user(email, password):
     """Verify user credentials and return user data"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
         user = cursor.fetchone()
-        
-        if user and check_password_hash(user['password_hash'], password):
-            return dict(user)
-        return None
+    
+    # Hash outside the with block so the pooled connection is not held while hashing
+    if user and check_password(user['password_hash'], password):
+        return dict(user)
+    return None
 
 
 def create_patient(user_id, assigned_doctor_id, patient_data):
@@ -282,6 +1074,7 @@ def create_patient(user_id, assigned_doctor_id, patient_data):
         return cursor.lastrowid
 
 
+@read_only
 def get_patient_by_id(patient_id):
     """Retrieve patient details by patient_id"""
     with get_db_connection() as conn:
@@ -291,6 +1084,7 @@ def get_patient_by_id(patient_id):
         return dict(patient) if patient else None
 
 
+@read_only
 def get_patient_by_user_id(user_id):
     """Retrieve patient details by user_id"""
     with get_db_connection() as conn:
@@ -300,6 +1094,7 @@ def get_patient_by_user_id(user_id):
         return dict(patient) if patient else None
 
 
+@read_only
 def get_patients_by_doctor(doctor_id):
     """Get all patients assigned to a specific doctor, sorted by risk level (highest first)"""
     with get_db_connection() as conn:
@@ -332,67 +1127,161 @@ def get_patients_by_doctor(doctor_id):
         return [dict(row) for row in cursor.fetchall()]
 
 
+ALL_PATIENTS_QUERY = '''
+    SELECT 
+        p.*, 
+        u.full_name as patient_name, 
+        u.email,
+        ra.overall_risk,
+        ra.assessed_at,
+        doc.full_name as doctor_name
+    FROM patients p
+    JOIN users u ON p.user_id = u.user_id
+    LEFT JOIN users doc ON p.assigned_doctor_id = doc.user_id
+    LEFT JOIN (
+        SELECT patient_id, overall_risk, assessed_at,
+               ROW_NUMBER() OVER (PARTITION BY patient_id ORDER BY assessed_at DESC) as rn
+        FROM risk_assessments
+    ) ra ON p.patient_id = ra.patient_id AND ra.rn = 1
+    ORDER BY 
+        CASE 
+            WHEN ra.overall_risk = 'CRITICAL' THEN 1
+            WHEN ra.overall_risk = 'HIGH' THEN 2
+            WHEN ra.overall_risk = 'MODERATE' THEN 3
+            WHEN ra.overall_risk = 'LOW' THEN 4
+            ELSE 5
+        END,
+        p.surgery_date ASC
+'''
+
+
+_RISK_ORDER = {'CRITICAL': 1, 'HIGH': 2, 'MODERATE': 3, 'LOW': 4}
+
+
+@site_aggregate(lambda results: _merge_site_lists(
+    results, lambda p: (_RISK_ORDER.get(p['overall_risk'], 5), p['surgery_date'])
+))
+@read_only
 def get_all_patients():
     """Get all patients, sorted by risk level (highest first)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT 
-                p.*, 
-                u.full_name as patient_name, 
-                u.email,
-                ra.overall_risk,
-                ra.assessed_at,
-                doc.full_name as doctor_name
-            FROM patients p
-            JOIN users u ON p.user_id = u.user_id
-            LEFT JOIN users doc ON p.assigned_doctor_id = doc.user_id
-            LEFT JOIN (
-                SELECT patient_id, overall_risk, assessed_at,
-                       ROW_NUMBER() OVER (PARTITION BY patient_id ORDER BY assessed_at DESC) as rn
-                FROM risk_assessments
-            ) ra ON p.patient_id = ra.patient_id AND ra.rn = 1
-            ORDER BY 
-                CASE 
-                    WHEN ra.overall_risk = 'CRITICAL' THEN 1
-                    WHEN ra.overall_risk = 'HIGH' THEN 2
-                    WHEN ra.overall_risk = 'MODERATE' THEN 3
-                    WHEN ra.overall_risk = 'LOW' THEN 4
-                    ELSE 5
-                END,
-                p.surgery_date ASC
-        ''')
+        cursor.execute(ALL_PATIENTS_QUERY)
         return [dict(row) for row in cursor.fetchall()]
 
 
+def stream_all_patients_json(chunk_size=500):
+    """
+    get_all_patients() as streamed JSON array text, without building row dicts
+    With ALL_SITES selected the sites are streamed one after another, each row
+    tagged with its site.
+    """
+    if not (SITES and _site.get() == ALL_SITES):
+        return iter_json_array(ALL_PATIENTS_QUERY, chunk_size=chunk_size)
+    return _stream_sites_json(
+        f'SELECT *, ? as site FROM ({ALL_PATIENTS_QUERY})', chunk_size
+    )
+
+
+def _stream_sites_json(query, chunk_size):
+    """Concatenate one JSON array per site into a single array"""
+    empty = True
+    for site in SITES:
+        with use_site(site):
+            for chunk in iter_json_array(query, (site,), chunk_size):
+                if chunk in ('[]', ']'):
+                    continue
+                # Drop each site's opening bracket; the first row opens the merged array
+                yield ('[' if empty else ',') + chunk[1:]
+                empty = False
+    yield '[]' if empty else ']'
+
+
+RISK_ASSESSMENT_INSERT = '''
+    INSERT INTO risk_assessments 
+    (patient_id, overall_risk, mortality_risk, aki_risk, cardiovascular_risk, 
+     transfusion_risk, recommendation_set_id, contributing_factors)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Risk assessments with their recommendations resolved, whether stored in a
+# recommendation set or (before migration) inline; usable as a table name
+RISK_ASSESSMENTS_RESOLVED = '''(
+    SELECT ra.assessment_id, ra.patient_id, ra.assessed_at, ra.overall_risk,
+           ra.mortality_risk, ra.aki_risk, ra.cardiovascular_risk, ra.transfusion_risk,
+           COALESCE(rs.recommendations, ra.recommendations) as recommendations,
+           ra.contributing_factors
+    FROM risk_assessments ra
+    LEFT JOIN recommendation_sets rs ON rs.set_id = ra.recommendation_set_id
+)'''
+
+
+def recommendation_set_id(recommendations):
+    """Content address of a recommendations JSON string"""
+    if recommendations is None:
+        return None
+    return hashlib.sha256(recommendations.encode('utf-8')).hexdigest()
+
+
+def _store_recommendation_sets(cursor, recommendations):
+    """Insert the recommendation sets that are not stored yet"""
+    cursor.executemany(
+        'INSERT OR IGNORE INTO recommendation_sets (set_id, recommendations) VALUES (?, ?)',
+        {recommendation_set_id(text): text for text in recommendations if text is not None}.items()
+    )
+
+
+def _risk_assessment_row(patient_id, overall_risk, risks, recommendations, contributing_factors):
+    """Build the parameter tuple for a risk_assessments insert"""
+    return (
+        patient_id, 
+        overall_risk,
+        risks.get('mortality'),
+        risks['aki'],
+        risks['cardiovascular'],
+        risks['transfusion'],
+        recommendation_set_id(recommendations),
+        contributing_factors
+    )
+
+
+def _insert_risk_assessments(cursor, assessments):
+    """Insert assessment dicts and their recommendation sets; returns the new ids"""
+    assessments = list(assessments)
+    _store_recommendation_sets(cursor, (a['recommendations'] for a in assessments))
+    return _insert_many(
+        cursor, RISK_ASSESSMENT_INSERT, (_risk_assessment_row(**a) for a in assessments)
+    )
+
+
 def save_risk_assessment(patient_id, overall_risk, risks, recommendations, contributing_factors):
     """Save a risk assessment to the database"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO risk_assessments 
-            (patient_id, overall_risk, mortality_risk, aki_risk, cardiovascular_risk, 
-             transfusion_risk, recommendations, contributing_factors)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            patient_id, 
-            overall_risk,
-            risks.get('mortality'),
-            risks['aki'],
-            risks['cardiovascular'],
-            risks['transfusion'],
-            recommendations,
-            contributing_factors
+        _store_recommendation_sets(cursor, [recommendations])
+        cursor.execute(RISK_ASSESSMENT_INSERT, _risk_assessment_row(
+            patient_id, overall_risk, risks, recommendations, contributing_factors
         ))
         return cursor.lastrowid
 
 
+def save_risk_assessment_bulk(assessments):
+    """
+    Save many risk assessments in one transaction
+    assessments: iterable of dicts with the same keys as save_risk_assessment's arguments
+    Returns the new assessment_ids in input order
+    """
+    with get_db_connection() as conn:
+        return _insert_risk_assessments(conn.cursor(), assessments)
+
+
+@read_only
 def get_latest_risk_assessment(patient_id):
     """Get the most recent risk assessment for a patient"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM risk_assessments 
+        cursor.execute(f'''
+            SELECT * FROM {RISK_ASSESSMENTS_RESOLVED}
             WHERE patient_id = ? 
             ORDER BY assessed_at DESC 
             LIMIT 1
@@ -401,6 +1290,64 @@ def get_latest_risk_assessment(patient_id):
         return dict(assessment) if assessment else None
 
 
+def _used_bytes(cursor):
+    """Bytes of database pages in use (free-list pages excluded)"""
+    page_size = cursor.execute('PRAGMA page_size').fetchone()[0]
+    page_count = cursor.execute('PRAGMA page_count').fetchone()[0]
+    free_pages = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+    return (page_count - free_pages) * page_size
+
+
+def migrate_recommendation_sets(batch_size=1000):
+    """
+    Move inline recommendation JSON on risk_assessments into recommendation_sets
+    Safe to re-run; reports the recommendation bytes and database pages saved.
+    Freed pages are reused by later writes (VACUUM returns them to the OS).
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        used_before = _used_bytes(cursor)
+        inline_bytes = cursor.execute(
+            'SELECT COALESCE(SUM(LENGTH(CAST(recommendations AS BLOB))), 0) FROM risk_assessments'
+        ).fetchone()[0]
+        
+        migrated = 0
+        last_id = 0
+        while True:
+            cursor.execute('''
+                SELECT assessment_id, recommendations FROM risk_assessments
+                WHERE assessment_id > ? AND recommendations IS NOT NULL
+                ORDER BY assessment_id
+                LIMIT ?
+            ''', (last_id, batch_size))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            _store_recommendation_sets(cursor, (row['recommendations'] for row in rows))
+            cursor.executemany('''
+                UPDATE risk_assessments
+                SET recommendation_set_id = ?, recommendations = NULL
+                WHERE assessment_id = ?
+            ''', ((recommendation_set_id(row['recommendations']), row['assessment_id']) for row in rows))
+            migrated += len(rows)
+            last_id = rows[-1]['assessment_id']
+        
+        sets, set_bytes = cursor.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(recommendations AS BLOB))), 0) FROM recommendation_sets'
+        ).fetchone()
+        used_after = _used_bytes(cursor)
+        
+        print(f"✅ Migrated {migrated} assessment(s) into {sets} recommendation set(s)")
+        return {
+            'assessments_migrated': migrated,
+            'recommendation_sets': sets,
+            'inline_bytes_before': inline_bytes,
+            'recommendation_set_bytes': set_bytes,
+            'used_bytes_before': used_before,
+            'used_bytes_after': used_after
+        }
+
+
 def save_lifestyle_plan(patient_id, plan_data):
     """Save a lifestyle plan for a patient"""
     with get_db_connection() as conn:
@@ -421,6 +1368,7 @@ def save_lifestyle_plan(patient_id, plan_data):
         return cursor.lastrowid
 
 
+@read_only
 def get_lifestyle_plan(patient_id):
     """Get the most recent lifestyle plan for a patient"""
     with get_db_connection() as conn:
@@ -435,6 +1383,7 @@ def get_lifestyle_plan(patient_id):
         return dict(plan) if plan else None
 
 
+@read_only
 def get_doctor_info(doctor_id):
     """Get doctor information"""
     with get_db_connection() as conn:
@@ -495,6 +1444,7 @@ def update_patient_vitals(patient_id, vitals):
         return cursor.rowcount > 0
 
 
+@read_only
 def get_patient_risk_summary(doctor_id):
     """Get summary of patient risk distribution for a doctor's dashboard"""
     with get_db_connection() as conn:
@@ -535,9 +1485,9 @@ def get_patient_risk_summary(doctor_id):
 
 def create_admin_user(email, password, full_name, role='admin'):
     """Create a new admin user"""
+    password_hash = hash_password(password)
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        password_hash = generate_password_hash(password)
         cursor.execute('''
             INSERT INTO admin_users (email, password_hash, full_name, role)
             VALUES (?, ?, ?, ?)
@@ -545,16 +1495,18 @@ def create_admin_user(email, password, full_name, role='admin'):
         return cursor.lastrowid
 
 
+@read_only
 def verify_admin_user(email, password):
     """Verify admin credentials and return admin data"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM admin_users WHERE email = ?', (email,))
         admin = cursor.fetchone()
-        
-        if admin and check_password_hash(admin['password_hash'], password):
-            return dict(admin)
-        return None
+    
+    # Hash outside the with block so the pooled connection is not held while hashing
+    if admin and check_password(admin['password_hash'], password):
+        return dict(admin)
+    return None
 
 
 def create_icu_bed(bed_data):
@@ -580,6 +1532,8 @@ def create_icu_bed(bed_data):
         return cursor.lastrowid
 
 
+@site_aggregate(_merge_site_lists)
+@read_only
 def get_all_icu_beds():
     """Get all ICU beds with current status"""
     with get_db_connection() as conn:
@@ -603,6 +1557,7 @@ def get_all_icu_beds():
         return [dict(row) for row in cursor.fetchall()]
 
 
+@read_only
 def get_available_icu_beds(filters=None):
     """Get available ICU beds with optional equipment filters"""
     with get_db_connection() as conn:
@@ -627,59 +1582,118 @@ def get_available_icu_beds(filters=None):
         return [dict(row) for row in cursor.fetchall()]
 
 
+@site_aggregate(_merge_capacity)
+@read_only
 def get_icu_capacity():
-    """Get current ICU capacity statistics - Fixed at 100 total beds"""
+    """Get current ICU capacity statistics from the trigger-maintained counters"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
             SELECT 
-                SUM(CASE WHEN status = 'occupied' THEN 1 ELSE 0 END) as occupied
-            FROM icu_beds
+                COALESCE(SUM(total_beds), 0) as total_beds,
+                COALESCE(SUM(available_beds), 0) as available_beds,
+                COALESCE(SUM(occupied_beds), 0) as occupied_beds,
+                COALESCE(SUM(maintenance_beds), 0) as maintenance_beds,
+                COALESCE(SUM(cleaning_beds), 0) as cleaning_beds
+            FROM icu_capacity
         ''')
-        result = cursor.fetchone()
+        data = dict(cursor.fetchone())
         
-        if result:
-            data = dict(result)
-            # Fixed total beds to 100
-            data['total_beds'] = 100
-            occupied = data['occupied'] or 0
-            data['available_beds'] = 100 - occupied
-            data['occupied_beds'] = occupied
-            data['utilization_rate'] = round((occupied / 100) * 100, 1)
-            return data
-        
-        # Default if no data
-        return {
-            'total_beds': 100,
-            'available_beds': 100,
-            'occupied_beds': 0,
-            'utilization_rate': 0
-        }
+        data['occupied'] = data['occupied_beds']
+        total = data['total_beds']
+        data['utilization_rate'] = round((data['occupied_beds'] / total) * 100, 1) if total else 0
+        return data
+
+
+@site_aggregate(_merge_site_lists)
+@read_only
+def get_icu_capacity_breakdown():
+    """Get ICU capacity counters per floor and equipment class"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM icu_capacity
+            WHERE total_beds > 0
+            ORDER BY floor_number, equipment_class
+        ''')
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def reconcile_icu_capacity(repair=False):
+    """
+    Compare the icu_capacity counters with a full count of icu_beds
+    Returns the counter rows that drifted; with repair=True they are rebuilt
+    """
+    columns = ['total_beds', 'available_beds', 'occupied_beds', 'maintenance_beds', 'cleaning_beds']
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(ICU_CAPACITY_FROM_BEDS)
+        expected = {(r['floor_number'], r['equipment_class']): dict(r) for r in cursor.fetchall()}
+        cursor.execute('SELECT * FROM icu_capacity')
+        actual = {(r['floor_number'], r['equipment_class']): dict(r) for r in cursor.fetchall()}
+        
+        drift = []
+        for key in sorted(set(expected) | set(actual)):
+            want = expected.get(key, {})
+            have = actual.get(key, {})
+            diffs = {c: {'counter': have.get(c, 0), 'actual': want.get(c, 0)}
+                     for c in columns if have.get(c, 0) != want.get(c, 0)}
+            if diffs:
+                drift.append({'floor_number': key[0], 'equipment_class': key[1], 'diffs': diffs})
+        
+        if drift and repair:
+            _rebuild_icu_capacity(cursor)
+        
+        return drift
+
+
+ICU_PREDICTION_INSERT = '''
+    INSERT INTO icu_predictions (
+        patient_id, assessment_id, icu_needed, icu_probability, risk_level,
+        predicted_icu_days, ventilator_needed, dialysis_needed, priority_score
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def _icu_prediction_row(patient_id, assessment_id, prediction_data):
+    """Build the parameter tuple for an icu_predictions insert"""
+    return (
+        patient_id,
+        assessment_id,
+        prediction_data.get('icu_needed', 0),
+        prediction_data.get('icu_probability', 0),
+        prediction_data.get('risk_level', 'LOW'),
+        prediction_data.get('predicted_icu_days', 0),
+        prediction_data.get('ventilator_needed', 0),
+        prediction_data.get('dialysis_needed', 0),
+        prediction_data.get('priority_score', 50)
+    )
 
 
 def save_icu_prediction(patient_id, assessment_id, prediction_data):
     """Save ICU need prediction for a patient"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO icu_predictions (
-                patient_id, assessment_id, icu_needed, icu_probability, risk_level,
-                predicted_icu_days, ventilator_needed, dialysis_needed, priority_score
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            patient_id,
-            assessment_id,
-            prediction_data.get('icu_needed', 0),
-            prediction_data.get('icu_probability', 0),
-            prediction_data.get('risk_level', 'LOW'),
-            prediction_data.get('predicted_icu_days', 0),
-            prediction_data.get('ventilator_needed', 0),
-            prediction_data.get('dialysis_needed', 0),
-            prediction_data.get('priority_score', 50)
+        cursor.execute(ICU_PREDICTION_INSERT, _icu_prediction_row(
+            patient_id, assessment_id, prediction_data
         ))
         return cursor.lastrowid
 
 
+def save_icu_prediction_bulk(predictions):
+    """
+    Save many ICU predictions in one transaction
+    predictions: iterable of dicts with patient_id, assessment_id and prediction_data
+    Returns the new prediction_ids in input order
+    """
+    with get_db_connection() as conn:
+        return _insert_many(
+            conn.cursor(), ICU_PREDICTION_INSERT,
+            (_icu_prediction_row(**p) for p in predictions)
+        )
+
+
+@read_only
 def get_icu_prediction(patient_id):
     """Get the most recent ICU prediction for a patient"""
     with get_db_connection() as conn:
@@ -694,33 +1708,107 @@ def get_icu_prediction(patient_id):
         return dict(prediction) if prediction else None
 
 
-def allocate_bed(patient_id, bed_id, allocated_by='system', allocation_type='automatic'):
-    """Allocate an ICU bed to a patient"""
+@read_only
+def get_icu_predictions(patient_ids, chunk_size=500):
+    """Most recent ICU prediction of each patient, in one query per chunk; returns {patient_id: prediction}"""
+    patient_ids = list(patient_ids)
+    predictions = {}
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        # Check if bed is available
-        cursor.execute('SELECT status FROM icu_beds WHERE bed_id = ?', (bed_id,))
-        bed = cursor.fetchone()
-        
-        if not bed or bed['status'] != 'available':
-            return None
-        
-        # Update bed status
-        cursor.execute('''
-            UPDATE icu_beds 
-            SET status = 'occupied', patient_id = ?, admitted_at = CURRENT_TIMESTAMP
-            WHERE bed_id = ?
-        ''', (patient_id, bed_id))
-        
-        # Create allocation record
-        cursor.execute('''
-            INSERT INTO bed_allocations (
-                patient_id, bed_id, allocated_by, allocation_type
-            ) VALUES (?, ?, ?, ?)
-        ''', (patient_id, bed_id, allocated_by, allocation_type))
-        
-        return cursor.lastrowid
+        for start in range(0, len(patient_ids), chunk_size):
+            chunk = patient_ids[start:start + chunk_size]
+            cursor.execute(f'''
+                SELECT * FROM (
+                    SELECT *, ROW_NUMBER() OVER (
+                        PARTITION BY patient_id ORDER BY predicted_at DESC, prediction_id DESC
+                    ) as rn
+                    FROM icu_predictions
+                    WHERE patient_id IN ({', '.join('?' * len(chunk))})
+                )
+                WHERE rn = 1
+            ''', chunk)
+            for row in cursor.fetchall():
+                prediction = dict(row)
+                del prediction['rn']
+                predictions[prediction['patient_id']] = prediction
+    return predictions
+
+
+def _occupy_bed(cursor, bed_id, patient_id, allocated_by, allocation_type, idempotency_key=None):
+    """
+    Mark a bed occupied by a patient and record the allocation; returns the
+    allocation_id, or None if the bed is no longer available
+    """
+    # Conditional on the status, so of two allocators racing for a bed only one updates it
+    cursor.execute('''
+        UPDATE icu_beds 
+        SET status = 'occupied', patient_id = ?, admitted_at = CURRENT_TIMESTAMP
+        WHERE bed_id = ? AND status = 'available'
+    ''', (patient_id, bed_id))
+    if cursor.rowcount == 0:
+        return None
+    
+    cursor.execute('''
+        INSERT INTO bed_allocations (
+            patient_id, bed_id, allocated_by, allocation_type, idempotency_key
+        ) VALUES (?, ?, ?, ?, ?)
+    ''', (patient_id, bed_id, allocated_by, allocation_type, idempotency_key))
+    allocation_id = cursor.lastrowid
+
+    # The patient leaves the ICU waitlist; the waitlist queue sees this through data_version
+    cursor.execute('''
+        UPDATE icu_waitlist SET status = 'allocated', allocated_at = CURRENT_TIMESTAMP
+        WHERE patient_id = ? AND status = 'waiting'
+    ''', (patient_id,))
+
+    cursor.execute('''
+        SELECT DATE(a.allocated_at) as stat_date, b.floor_number
+        FROM bed_allocations a JOIN icu_beds b ON a.bed_id = b.bed_id
+        WHERE a.allocation_id = ?
+    ''', (allocation_id,))
+    admitted = cursor.fetchone()
+    cursor.execute(ICU_DAILY_STATS_UPSERT, (
+        admitted['stat_date'], admitted['floor_number'], 1, 0, 0, 0, 0, 0, None, None
+    ))
+    
+    return allocation_id
+
+
+def _allocate(conn, patient_id, bed_id, allocated_by, allocation_type, idempotency_key):
+    cursor = conn.cursor()
+    if idempotency_key is not None:
+        cursor.execute('SELECT allocation_id FROM bed_allocations WHERE idempotency_key = ?',
+                       (idempotency_key,))
+        existing = cursor.fetchone()
+        if existing:
+            return existing['allocation_id']
+    return _occupy_bed(cursor, bed_id, patient_id, allocated_by, allocation_type, idempotency_key)
+
+
+def allocate_bed(patient_id, bed_id, allocated_by='system', allocation_type='automatic',
+                 idempotency_key=None):
+    """
+    Allocate an ICU bed to a patient; returns the allocation_id, or None if the bed is not available
+    Runs in a BEGIN IMMEDIATE transaction (retried while the database is busy).
+    A request repeated with the same idempotency_key gets the first
+    allocation_id back instead of a second allocation.
+    """
+    shared = getattr(_local, 'conn', None)
+    if shared is not None:
+        # Inside the caller's transaction; the conditional UPDATE still settles any race
+        return _allocate(shared, patient_id, bed_id, allocated_by, allocation_type, idempotency_key)
+    
+    conn = _connect()
+    try:
+        # Optimistic read first: a bed that is already taken costs no write lock
+        if idempotency_key is None:
+            bed = conn.execute('SELECT status FROM icu_beds WHERE bed_id = ?', (bed_id,)).fetchone()
+            if not bed or bed['status'] != 'available':
+                return None
+        return run_immediate(conn, _allocate, conn, patient_id, bed_id, allocated_by,
+                             allocation_type, idempotency_key)
+    finally:
+        conn.close()
 
 
 def discharge_from_icu(allocation_id, discharge_reason=''):
@@ -737,18 +1825,21 @@ def discharge_from_icu(allocation_id, discharge_reason=''):
         ''', (allocation_id,))
         allocation = cursor.fetchone()
         
-        if not allocation:
+        # Discharging twice would bill again and free a bed someone else may now occupy
+        if not allocation or allocation['actual_discharge'] is not None:
             return False
         
-        # Calculate duration and cost
+        # Calculate duration and cost (conditional too: a concurrent discharge may have won)
         cursor.execute('''
             UPDATE bed_allocations 
             SET actual_discharge = CURRENT_TIMESTAMP,
                 duration_days = CAST((julianday(CURRENT_TIMESTAMP) - julianday(allocated_at)) AS REAL),
                 discharge_reason = ?,
                 total_cost = CAST((julianday(CURRENT_TIMESTAMP) - julianday(allocated_at)) AS REAL) * ?
-            WHERE allocation_id = ?
+            WHERE allocation_id = ? AND actual_discharge IS NULL
         ''', (discharge_reason, allocation['bed_cost_per_day'], allocation_id))
+        if cursor.rowcount == 0:
+            return False
         
         # Update bed status
         cursor.execute('''
@@ -757,9 +1848,130 @@ def discharge_from_icu(allocation_id, discharge_reason=''):
             WHERE bed_id = ?
         ''', (allocation['bed_id'],))
         
+        cursor.execute(f'{COMPLETED_STAYS_QUERY} AND a.allocation_id = ?', (allocation_id,))
+        _record_completed_stays(cursor, cursor.fetchall())
+        
         return True
 
 
+# ========================================
+# ICU DAILY STATISTICS ROLLUP
+# ========================================
+
+# Adds one contribution to a (stat_date, floor_number) row of the rollup
+ICU_DAILY_STATS_UPSERT = '''
+    INSERT INTO icu_daily_stats (
+        stat_date, floor_number, admissions, discharges, bed_days, revenue,
+        readmissions, total_los, min_los, max_los
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (stat_date, floor_number) DO UPDATE SET
+        admissions = admissions + excluded.admissions,
+        discharges = discharges + excluded.discharges,
+        bed_days = bed_days + excluded.bed_days,
+        revenue = revenue + excluded.revenue,
+        readmissions = readmissions + excluded.readmissions,
+        total_los = total_los + excluded.total_los,
+        min_los = MIN(COALESCE(min_los, excluded.min_los), COALESCE(excluded.min_los, min_los)),
+        max_los = MAX(COALESCE(max_los, excluded.max_los), COALESCE(excluded.max_los, max_los))
+'''
+
+COMPLETED_STAYS_QUERY = '''
+    SELECT a.allocated_at, a.actual_discharge, a.duration_days, a.total_cost,
+           a.readmitted, b.floor_number
+    FROM bed_allocations a
+    JOIN icu_beds b ON a.bed_id = b.bed_id
+    WHERE a.actual_discharge IS NOT NULL
+'''
+
+
+def _stay_bed_days(allocated_at, discharged_at):
+    """Split a stay into (date, bed_days) pieces, one per calendar day it covers"""
+    try:
+        start = datetime.fromisoformat(allocated_at)
+        end = datetime.fromisoformat(discharged_at)
+    except (TypeError, ValueError):
+        return []
+    pieces = []
+    while start < end:
+        next_midnight = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        piece_end = min(end, next_midnight)
+        pieces.append((start.date().isoformat(), (piece_end - start).total_seconds() / 86400))
+        start = piece_end
+    return pieces
+
+
+def _completed_stay_rows(stay):
+    """Rollup contributions of one completed stay: bed-days per day plus the discharge day"""
+    floor = stay['floor_number']
+    los = stay['duration_days'] or 0
+    rows = [(day, floor, 0, 0, bed_days, 0, 0, 0, None, None)
+            for day, bed_days in _stay_bed_days(stay['allocated_at'], stay['actual_discharge'])]
+    rows.append((stay['actual_discharge'][:10], floor, 0, 1, 0, stay['total_cost'] or 0,
+                 1 if stay['readmitted'] else 0, los, los, los))
+    return rows
+
+
+def _record_completed_stays(cursor, stays):
+    rows = [row for stay in stays for row in _completed_stay_rows(stay)]
+    if rows:
+        cursor.executemany(ICU_DAILY_STATS_UPSERT, rows)
+
+
+def _rebuild_icu_daily_stats(cursor, since=None):
+    """Recompute the rollup from bed_allocations for days on or after since (all days if None)"""
+    since = since or '0000-00-00'
+    cursor.execute('DELETE FROM icu_daily_stats WHERE stat_date >= ?', (since,))
+    
+    cursor.execute('''
+        INSERT INTO icu_daily_stats (stat_date, floor_number, admissions)
+        SELECT DATE(a.allocated_at), b.floor_number, COUNT(*)
+        FROM bed_allocations a
+        JOIN icu_beds b ON a.bed_id = b.bed_id
+        WHERE DATE(a.allocated_at) >= ?
+        GROUP BY DATE(a.allocated_at), b.floor_number
+    ''', (since,))
+    
+    # Stays that ended before since contributed nothing to the recomputed days.
+    # Contributions are summed per (day, floor) first so each row is written once.
+    totals = {}
+    stays = cursor.connection.cursor()
+    stays.execute(f'{COMPLETED_STAYS_QUERY} AND DATE(a.actual_discharge) >= ?', (since,))
+    while True:
+        chunk = stays.fetchmany(1000)
+        if not chunk:
+            break
+        for stay in chunk:
+            for row in _completed_stay_rows(stay):
+                if row[0] < since:
+                    continue
+                total = totals.get(row[:2])
+                if total is None:
+                    totals[row[:2]] = list(row[2:])
+                    continue
+                for i in range(6):
+                    total[i] += row[2 + i]
+                if row[8] is not None:
+                    total[6] = row[8] if total[6] is None else min(total[6], row[8])
+                    total[7] = row[9] if total[7] is None else max(total[7], row[9])
+    cursor.executemany(ICU_DAILY_STATS_UPSERT, (key + tuple(total) for key, total in totals.items()))
+
+
+def refresh_icu_daily_stats(days=7):
+    """
+    Catch-up job: recompute the last N days of the rollup from bed_allocations
+    Repairs any writes that bypassed allocate/discharge. days=None rebuilds everything.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        since = None
+        if days is not None:
+            since = cursor.execute("SELECT DATE('now', '-' || ? || ' days')", (days,)).fetchone()[0]
+        _rebuild_icu_daily_stats(cursor, since)
+        return cursor.execute(
+            'SELECT COUNT(*) FROM icu_daily_stats WHERE stat_date >= ?', (since or '0000-00-00',)
+        ).fetchone()[0]
+
+
 def update_bed_status(bed_id, status):
     """Update ICU bed status"""
     with get_db_connection() as conn:
@@ -772,17 +1984,82 @@ def update_bed_status(bed_id, status):
         return cursor.rowcount > 0
 
 
+# A patient already waiting keeps their entry and place in time, and takes the
+# new prediction and priority
+ICU_WAITLIST_INSERT = '''
+    INSERT INTO icu_waitlist (patient_id, prediction_id, priority, added_at)
+    VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))
+    ON CONFLICT (patient_id) WHERE status = 'waiting'
+    DO UPDATE SET prediction_id = excluded.prediction_id, priority = excluded.priority
+    RETURNING waitlist_id
+'''
+
+
 def add_to_icu_waitlist(patient_id, prediction_id, priority):
-    """Add patient to ICU waitlist"""
+    """Add patient to ICU waitlist; returns the patient's waiting entry"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(ICU_WAITLIST_INSERT, (patient_id, prediction_id, priority, None))
+        return cursor.fetchone()[0]
+
+
+def add_to_icu_waitlist_bulk(entries):
+    """
+    Add many patients to the ICU waitlist in one transaction
+    entries: iterable of dicts with patient_id, prediction_id and priority
+    Returns the waitlist_ids in input order; entries of the same patient share one
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # RETURNING rules out executemany, and an upsert the contiguous-ID trick of _insert_many
+        return [
+            cursor.execute(ICU_WAITLIST_INSERT,
+                           (e['patient_id'], e['prediction_id'], e['priority'], None)).fetchone()[0]
+            for e in entries
+        ]
+
+
+@read_only
+def get_bed_allocations(limit=50):
+    """Most recent ICU bed allocations with patient name, room and active/discharged status"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            INSERT INTO icu_waitlist (patient_id, prediction_id, priority)
-            VALUES (?, ?, ?)
-        ''', (patient_id, prediction_id, priority))
-        return cursor.lastrowid
+            SELECT
+                a.*,
+                u.full_name as patient_name,
+                b.room_number,
+                b.floor_number,
+                CASE WHEN a.actual_discharge IS NULL THEN 'active' ELSE 'discharged' END as status
+            FROM bed_allocations a
+            JOIN patients p ON p.patient_id = a.patient_id
+            JOIN users u ON u.user_id = p.user_id
+            LEFT JOIN icu_beds b ON b.bed_id = a.bed_id
+            ORDER BY a.allocation_id DESC
+            LIMIT ?
+        ''', (limit,))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+@read_only
+def get_active_allocation(bed_id):
+    """The open allocation of a bed, or None"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT * FROM bed_allocations
+            WHERE bed_id = ? AND actual_discharge IS NULL
+            ORDER BY allocation_id DESC
+            LIMIT 1
+        ''', (bed_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
 
 
+@site_aggregate(lambda results: _merge_site_lists(
+    results, lambda p: (-p['priority_score'], p['surgery_date'])
+))
+@read_only
 def get_icu_waitlist():
     """Get current ICU waitlist sorted by priority - returns patients needing ICU beds"""
     with get_db_connection() as conn:
@@ -828,29 +2105,62 @@ def get_icu_waitlist():
         return [dict(row) for row in cursor.fetchall()]
 
 
+@site_aggregate(_merge_analytics)
+@read_only
 def get_icu_analytics(days=30):
-    """Get ICU analytics for the last N days"""
+    """
+    Get ICU analytics for the last N days from the daily rollup
+    Stay statistics and total_admissions cover stays discharged in the window.
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        # Average ICU stay duration
         cursor.execute('''
             SELECT 
-                AVG(duration_days) as avg_stay_duration,
-                MIN(duration_days) as min_stay,
-                MAX(duration_days) as max_stay,
-                COUNT(*) as total_admissions,
-                SUM(total_cost) as total_revenue,
-                SUM(CASE WHEN readmitted = 1 THEN 1 ELSE 0 END) as readmissions
-            FROM bed_allocations
-            WHERE actual_discharge IS NOT NULL
-            AND actual_discharge >= datetime('now', '-' || ? || ' days')
+                SUM(total_los) / NULLIF(SUM(discharges), 0) as avg_stay_duration,
+                MIN(min_los) as min_stay,
+                MAX(max_los) as max_stay,
+                COALESCE(SUM(discharges), 0) as total_admissions,
+                SUM(CASE WHEN discharges > 0 THEN revenue END) as total_revenue,
+                SUM(CASE WHEN discharges > 0 THEN readmissions END) as readmissions,
+                COALESCE(SUM(admissions), 0) as new_admissions,
+                COALESCE(SUM(bed_days), 0) as bed_days
+            FROM icu_daily_stats
+            WHERE stat_date >= DATE('now', '-' || ? || ' days')
         ''', (days,))
         
         result = cursor.fetchone()
         return dict(result) if result else None
 
 
+@read_only
+def get_icu_daily_trend(days=365, floor_number=None):
+    """Per-day ICU admissions, discharges, bed-days, revenue and average stay for the last N days"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        floor_filter = 'AND floor_number = ?' if floor_number is not None else ''
+        params = (days,) if floor_number is None else (days, floor_number)
+        cursor.execute(f'''
+            SELECT 
+                stat_date,
+                SUM(admissions) as admissions,
+                SUM(discharges) as discharges,
+                ROUND(SUM(bed_days), 3) as bed_days,
+                SUM(revenue) as revenue,
+                SUM(readmissions) as readmissions,
+                SUM(total_los) / NULLIF(SUM(discharges), 0) as avg_stay_duration
+            FROM icu_daily_stats
+            WHERE stat_date >= DATE('now', '-' || ? || ' days')
+            {floor_filter}
+            GROUP BY stat_date
+            ORDER BY stat_date
+        ''', params)
+        
+        return [dict(row) for row in cursor.fetchall()]
+
+
+@read_only
 def get_icu_forecast(days=7):
     """Get ICU demand forecast for next N days"""
     with get_db_connection() as conn:
@@ -874,6 +2184,7 @@ def get_icu_forecast(days=7):
         return [dict(row) for row in cursor.fetchall()]
 
 
+@read_only
 def get_expected_discharges_today():
     """Get beds expected to be discharged today"""
     with get_db_connection() as conn:
@@ -899,85 +2210,233 @@ def get_expected_discharges_today():
 # SYMPTOM TRACKING FUNCTIONS
 # ========================================
 
+SYMPTOM_LOG_INSERT = '''
+    INSERT INTO symptom_logs (
+        patient_id, pain_level, temperature, wound_condition,
+        sleep_quality, hours_slept, swelling, redness, discharge,
+        nausea, dizziness, shortness_of_breath, notes, red_flag_alert
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def _symptom_log_row(patient_id, symptom_data):
+    """Build the parameter tuple for a symptom_logs insert"""
+    return (
+        patient_id,
+        symptom_data.get('painLevel'),
+        symptom_data.get('temperature'),
+        symptom_data.get('woundCondition'),
+        symptom_data.get('sleepQuality'),
+        symptom_data.get('hoursSlept'),
+        1 if symptom_data.get('swelling') else 0,
+        1 if symptom_data.get('redness') else 0,
+        1 if symptom_data.get('discharge') else 0,
+        1 if symptom_data.get('nausea') else 0,
+        1 if symptom_data.get('dizziness') else 0,
+        1 if symptom_data.get('shortnessOfBreath') else 0,
+        symptom_data.get('notes'),
+        1 if symptom_data.get('redFlagAlert') else 0
+    )
+
+
 def save_symptom_log(patient_id, symptom_data):
     """Save a symptom log entry for a patient"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO symptom_logs (
-                patient_id, pain_level, temperature, wound_condition,
-                sleep_quality, hours_slept, swelling, redness, discharge,
-                nausea, dizziness, shortness_of_breath, notes, red_flag_alert
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            patient_id,
-            symptom_data.get('painLevel'),
-            symptom_data.get('temperature'),
-            symptom_data.get('woundCondition'),
-            symptom_data.get('sleepQuality'),
-            symptom_data.get('hoursSlept'),
-            1 if symptom_data.get('swelling') else 0,
-            1 if symptom_data.get('redness') else 0,
-            1 if symptom_data.get('discharge') else 0,
-            1 if symptom_data.get('nausea') else 0,
-            1 if symptom_data.get('dizziness') else 0,
-            1 if symptom_data.get('shortnessOfBreath') else 0,
-            symptom_data.get('notes'),
-            1 if symptom_data.get('redFlagAlert') else 0
-        ))
+        cursor.execute(SYMPTOM_LOG_INSERT, _symptom_log_row(patient_id, symptom_data))
         return cursor.lastrowid
 
 
-def get_symptom_history(patient_id, limit=30):
-    """Get symptom log history for a patient"""
+# Months of symptom logs kept in the main table; older months live in the archive file
+SYMPTOM_HOT_MONTHS = 3
+
+
+def _symptom_archive_path():
+    """Archive database file that sits next to the main database"""
+    return os.path.splitext(current_database_path())[0] + '_symptom_archive.db'
+
+
+# Both symptom log partitions; usable wherever a table name is expected. Rows
+# still in the main table win: archiving copies and deletes in two files,
+# which WAL does not commit atomically, so a crash can leave a row in both.
+SYMPTOM_LOGS_ALL = '''(
+    SELECT * FROM main.symptom_logs
+    UNION ALL
+    SELECT * FROM symptom_archive.symptom_logs a
+    WHERE NOT EXISTS (SELECT 1 FROM main.symptom_logs m WHERE m.log_id = a.log_id)
+)'''
+
+
+def _symptom_archive_schema(conn):
+    """CREATE TABLE of the archive: main.symptom_logs with its key and checks, no foreign key"""
+    sql = conn.execute(
+        "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = 'symptom_logs'"
+    ).fetchone()[0]
+    sql = re.sub(r',\s*FOREIGN KEY[^,]*?REFERENCES\s+\w+\s*\(\w+\)', '', sql)
+    sql = sql.replace(' AUTOINCREMENT', '')
+    return re.sub(r'^CREATE TABLE( IF NOT EXISTS)?\s+"?symptom_logs"?',
+                  'CREATE TABLE IF NOT EXISTS symptom_archive.symptom_logs', sql)
+
+
+def _attach_symptom_archive(conn, create=False):
+    """
+    Attach the symptom archive to this connection so SYMPTOM_LOGS_ALL can be queried
+    Returns False if there is no archive yet. With create=True the archive file and
+    table are created. Must be called outside a transaction (SQLite cannot ATTACH
+    inside one).
+    """
+    attached = [row[1] for row in conn.execute('PRAGMA database_list')]
+    if 'symptom_archive' not in attached:
+        path = _symptom_archive_path()
+        if not create and not os.path.exists(path):
+            return False
+        conn.execute("ATTACH DATABASE ? AS symptom_archive", (path,))
+    
+    if create:
+        columns = conn.execute('PRAGMA symptom_archive.table_info(symptom_logs)').fetchall()
+        if columns and not any(column['pk'] for column in columns):
+            # Archives created before the key: rebuild, dropping duplicated rows
+            conn.execute('DROP INDEX IF EXISTS symptom_archive.idx_symptom_logs_patient_logged')
+            conn.execute('ALTER TABLE symptom_archive.symptom_logs RENAME TO symptom_logs_unkeyed')
+            conn.execute(_symptom_archive_schema(conn))
+            conn.execute('''
+                INSERT OR IGNORE INTO symptom_archive.symptom_logs
+                SELECT * FROM symptom_archive.symptom_logs_unkeyed
+            ''')
+            conn.execute('DROP TABLE symptom_archive.symptom_logs_unkeyed')
+        else:
+            conn.execute(_symptom_archive_schema(conn))
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS symptom_archive.idx_symptom_logs_patient_logged
+            ON symptom_logs (patient_id, logged_at)
+        ''')
+    return True
+
+
+def _symptom_archive_readable(conn):
+    """
+    Whether SYMPTOM_LOGS_ALL can be read on conn, attaching the archive if
+    needed; inside a transaction only an archive attached beforehand counts
+    """
+    if not conn.in_transaction:
+        return _attach_symptom_archive(conn)
+    if any(row[1] == 'symptom_archive' for row in conn.execute('PRAGMA database_list')):
+        return True
+    if os.path.exists(_symptom_archive_path()):
+        print("⚠️  Symptom archive cannot be attached inside a transaction; "
+              "reading recent symptom logs only")
+    return False
+
+
+def archive_symptom_logs(hot_months=SYMPTOM_HOT_MONTHS):
+    """
+    Move whole months of symptom logs older than the hot window into the archive file
+    Returns the number of rows moved per month
+    """
     with get_db_connection() as conn:
+        _attach_symptom_archive(conn, create=True)
         cursor = conn.cursor()
+        
+        cutoff = cursor.execute(
+            "SELECT DATE('now', 'start of month', '-' || ? || ' months')", (hot_months,)
+        ).fetchone()[0]
+        
         cursor.execute('''
-            SELECT 
-                log_id,
-                DATE(logged_at) as date,
-                TIME(logged_at) as time,
-                pain_level as painLevel,
-                temperature,
-                wound_condition as woundCondition,
-                sleep_quality as sleepQuality,
-                hours_slept as hoursSlept,
-                swelling,
-                redness,
-                discharge,
-                nausea,
-                dizziness,
-                shortness_of_breath as shortnessOfBreath,
-                notes,
-                red_flag_alert as redFlagAlert
-            FROM symptom_logs
-            WHERE patient_id = ?
-            ORDER BY logged_at DESC
-            LIMIT ?
-        ''', (patient_id, limit))
-        return [dict(row) for row in cursor.fetchall()]
+            SELECT strftime('%Y-%m', logged_at) as month, COUNT(*) as rows_moved
+            FROM main.symptom_logs
+            WHERE logged_at < ?
+            GROUP BY month
+            ORDER BY month
+        ''', (cutoff,))
+        months = [dict(row) for row in cursor.fetchall()]
+        
+        if months:
+            # Rows left behind by an interrupted earlier run are already archived
+            cursor.execute('''
+                INSERT OR IGNORE INTO symptom_archive.symptom_logs
+                SELECT * FROM main.symptom_logs WHERE logged_at < ?
+            ''', (cutoff,))
+            cursor.execute('DELETE FROM main.symptom_logs WHERE logged_at < ?', (cutoff,))
+        
+        return {'cutoff': cutoff, 'months': months}
+
+
+@read_only
+def get_symptom_history(patient_id, limit=30):
+    """
+    Get symptom log history for a patient
+    Reads the hot table first and only unions in the archive when the hot rows
+    cannot fill the requested history
+    """
+    query = '''
+        SELECT 
+            log_id,
+            DATE(logged_at) as date,
+            TIME(logged_at) as time,
+            pain_level as painLevel,
+            temperature,
+            wound_condition as woundCondition,
+            sleep_quality as sleepQuality,
+            hours_slept as hoursSlept,
+            swelling,
+            redness,
+            discharge,
+            nausea,
+            dizziness,
+            shortness_of_breath as shortnessOfBreath,
+            notes,
+            red_flag_alert as redFlagAlert
+        FROM {table}
+        WHERE patient_id = ?
+        ORDER BY logged_at DESC
+        LIMIT ?
+    '''
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query.format(table='symptom_logs'), (patient_id, limit))
+        rows = cursor.fetchall()
+        
+        if len(rows) < limit and _symptom_archive_readable(conn):
+            cursor.execute(query.format(table=SYMPTOM_LOGS_ALL), (patient_id, limit))
+            rows = cursor.fetchall()
+        
+        return [dict(row) for row in rows]
 
 
+@read_only
 def get_recent_red_flags(patient_id, days=7):
     """Get recent red flag symptom alerts for a patient"""
+    query = '''
+        SELECT 
+            log_id,
+            logged_at,
+            pain_level,
+            temperature,
+            wound_condition,
+            discharge,
+            shortness_of_breath,
+            notes
+        FROM {table}
+        WHERE patient_id = ?
+        AND red_flag_alert = 1
+        AND logged_at >= datetime('now', '-' || ? || ' days')
+        ORDER BY logged_at DESC
+    '''
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT 
-                log_id,
-                logged_at,
-                pain_level,
-                temperature,
-                wound_condition,
-                discharge,
-                shortness_of_breath,
-                notes
-            FROM symptom_logs
-            WHERE patient_id = ?
-            AND red_flag_alert = 1
-            AND logged_at >= datetime('now', '-' || ? || ' days')
-            ORDER BY logged_at DESC
-        ''', (patient_id, days))
+        
+        # The window reaches into the archive when the patient's newest archived log is in it
+        table = 'symptom_logs'
+        if _symptom_archive_readable(conn):
+            cursor.execute('''
+                SELECT MAX(logged_at) >= datetime('now', '-' || ? || ' days')
+                FROM symptom_archive.symptom_logs
+                WHERE patient_id = ?
+            ''', (days, patient_id))
+            if cursor.fetchone()[0]:
+                table = SYMPTOM_LOGS_ALL
+        
+        cursor.execute(query.format(table=table), (patient_id, days))
         return [dict(row) for row in cursor.fetchall()]
 
 
@@ -1010,161 +2469,4 @@ def update_patient_surgery_info(patient_id, surgery_data):
         return cursor.rowcount > 0
 
 
-def auto_allocate_beds_by_criticality():
-    """Automatically allocate ICU beds to patients based on criticality"""
-    try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            print("📊 Checking for patients needing ICU beds...")
-            
-            # Get waiting patients ordered by criticality
-            cursor.execute('''
-                SELECT 
-                    p.patient_id,
-                    u.full_name as patient_name,
-                    ra.overall_risk,
-                    CASE 
-                        WHEN ra.overall_risk = 'CRITICAL' THEN 1
-                        WHEN ra.overall_risk = 'HIGH' THEN 2
-                        WHEN ra.overall_risk = 'MODERATE' THEN 3
-                        ELSE 4
-                    END as priority_order
-                FROM patients p
-                JOIN users u ON p.user_id = u.user_id
-                LEFT JOIN (
-                    SELECT patient_id, overall_risk,
-                           ROW_NUMBER() OVER (PARTITION BY patient_id ORDER BY assessed_at DESC) as rn
-                    FROM risk_assessments
-                ) ra ON p.patient_id = ra.patient_id AND ra.rn = 1
-                WHERE p.patient_id NOT IN (
-                    SELECT patient_id FROM icu_beds WHERE patient_id IS NOT NULL AND status = 'occupied'
-                )
-                AND p.status = 'scheduled'
-                AND ra.overall_risk IN ('CRITICAL', 'HIGH', 'MODERATE')
-                ORDER BY priority_order ASC, p.surgery_date ASC
-            ''')
-            
-            waiting_patients = [dict(row) for row in cursor.fetchall()]
-            print(f"👥 Found {len(waiting_patients)} patients needing beds")
-            
-            if not waiting_patients:
-                print("⚠️  No patients in queue")
-                return []
-            
-            # Get current occupied count - Fixed SQL
-            cursor.execute("SELECT COUNT(*) as occupied FROM icu_beds WHERE status = 'occupied' AND patient_id IS NOT NULL")
-            result = cursor.fetchone()
-            occupied = result['occupied'] if result else 0
-            print(f"🏥 Current occupied beds: {occupied}")
-            
-            # Calculate available beds (out of 100 total)
-            available_count = 100 - occupied
-            print(f"✅ Available beds: {available_count}")
-            
-            if available_count <= 0:
-                print("❌ No beds available!")
-                return []  # No beds available
-            
-            # Allocate beds to highest priority patients
-            allocated = []
-            for i, patient in enumerate(waiting_patients):
-                if i >= available_count:
-                    print(f"⚠️  Reached capacity limit at {i} allocations")
-                    break  # No more beds available
-                
-                # Create a bed record for this patient
-                bed_number = occupied + i + 1
-                print(f"🛏️  Allocating bed ICU-{bed_number} to {patient['patient_name']} (Risk: {patient['overall_risk']})")
-                
-                cursor.execute('''
-                    INSERT INTO icu_beds (
-                        room_number, floor_number, status, patient_id, admitted_at
-                    ) VALUES (?, ?, 'occupied', ?, CURRENT_TIMESTAMP)
-                ''', (f"ICU-{bed_number}", 1, patient['patient_id']))
-                
-                allocated.append({
-                    'patient_id': patient['patient_id'],
-                    'patient_name': patient['patient_name'],
-                    'risk_level': patient['overall_risk'],
-                    'bed_number': f"ICU-{bed_number}"
-                })
-            
-            conn.commit()
-            print(f"✅ Successfully allocated {len(allocated)} beds")
-            return allocated
-            
-    except Exception as e:
-        print(f"❌ Database error in auto_allocate_beds_by_criticality: {e}")
-        import traceback
-        traceback.print_exc()
-        raise
-
-
-def allocate_one_bed_manually():
-    """Allocate one bed to the highest priority patient"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Get highest priority patient waiting
-        cursor.execute('''
-            SELECT 
-                p.patient_id,
-                u.full_name as patient_name,
-                ra.overall_risk,
-                CASE 
-                    WHEN ra.overall_risk = 'CRITICAL' THEN 1
-                    WHEN ra.overall_risk = 'HIGH' THEN 2
-                    WHEN ra.overall_risk = 'MODERATE' THEN 3
-                    ELSE 4
-                END as priority_order
-            FROM patients p
-            JOIN users u ON p.user_id = u.user_id
-            LEFT JOIN (
-                SELECT patient_id, overall_risk,
-                       ROW_NUMBER() OVER (PARTITION BY patient_id ORDER BY assessed_at DESC) as rn
-                FROM risk_assessments
-            ) ra ON p.patient_id = ra.patient_id AND ra.rn = 1
-            WHERE p.patient_id NOT IN (
-                SELECT patient_id FROM icu_beds WHERE patient_id IS NOT NULL AND status = 'occupied'
-            )
-            AND p.status = 'scheduled'
-            AND ra.overall_risk IN ('CRITICAL', 'HIGH', 'MODERATE', 'LOW')
-            ORDER BY priority_order ASC, p.surgery_date ASC
-            LIMIT 1
-        ''')
-        
-        patient = cursor.fetchone()
-        
-        if not patient:
-            return None  # No patients waiting
-        
-        patient = dict(patient)
-        
-        # Get current occupied count
-        cursor.execute("SELECT COUNT(*) as occupied FROM icu_beds WHERE status = 'occupied' AND patient_id IS NOT NULL")
-        result = cursor.fetchone()
-        occupied = result['occupied'] if result else 0
-        
-        # Check if beds available
-        if occupied >= 100:
-            return None  # No beds available
-        
-        # Allocate bed
-        bed_number = occupied + 1
-        cursor.execute('''
-            INSERT INTO icu_beds (
-                room_number, floor_number, status, patient_id, admitted_at
-            ) VALUES (?, ?, 'occupied', ?, CURRENT_TIMESTAMP)
-        ''', (f"ICU-{bed_number}", 1, patient['patient_id']))
-        
-        conn.commit()
-        
-        return {
-            'patient_id': patient['patient_id'],
-            'patient_name': patient['patient_name'],
-            'risk_level': patient['overall_risk'],
-            'bed_number': f"ICU-{bed_number}"
-        }
-
 
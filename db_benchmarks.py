@@ -0,0 +1,1038 @@
+"""
+Benchmarks for the database layer
+Each benchmark runs against a throwaway database seeded with synthetic data,
+never against surgical_risk.db.
+
+Run: python db_benchmarks.py <benchmark> [--patients N]
+     python db_benchmarks.py --list
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.dirname(__file__))
+
+import database
+
+RISK_LEVELS = ['LOW', 'MODERATE', 'HIGH', 'CRITICAL']
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Register a benchmark under a command-line name"""
+    def register(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return register
+
+
+@contextmanager
+def seeded_database(patients=1000, beds=100, seed=42):
+    """Point database.py at a temporary database filled with synthetic data"""
+    rng = random.Random(seed)
+    original_path = database.DATABASE_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DATABASE_PATH = os.path.join(tmp, 'bench.db')
+        try:
+            database.init_database()
+            with database.get_db_connection() as conn:
+                cursor = conn.cursor()
+                doctor_ids = database._insert_many(cursor, '''
+                    INSERT INTO users (email, password_hash, user_type, full_name, department)
+                    VALUES (?, 'x', 'doctor', ?, 'Surgery')
+                ''', ((f'doctor{i}@bench', f'Doctor {i}') for i in range(20)))
+                user_ids = database._insert_many(cursor, '''
+                    INSERT INTO users (email, password_hash, user_type, full_name)
+                    VALUES (?, 'x', 'patient', ?)
+                ''', ((f'patient{i}@bench', f'Patient {i}') for i in range(patients)))
+                today = datetime.now()
+                patient_ids = database._insert_many(cursor, '''
+                    INSERT INTO patients (
+                        user_id, assigned_doctor_id, surgery_type, surgery_date, age, gender,
+                        bmi, asa_class, emergency_surgery, hemoglobin, platelets, creatinine,
+                        albumin, blood_loss, diabetes, hypertension
+                    ) VALUES (?, ?, 'General Surgery', ?, ?, ?, ?, ?, 0, 13.0, 250, 1.0, 4.0, 200, ?, ?)
+                ''', ((
+                    user_id, rng.choice(doctor_ids),
+                    (today + timedelta(days=rng.randint(-30, 30))).strftime('%Y-%m-%d'),
+                    rng.randint(20, 90), rng.randint(0, 1), round(rng.uniform(18, 40), 1),
+                    rng.randint(1, 5), rng.randint(0, 1), rng.randint(0, 1)
+                ) for user_id in user_ids))
+                database._insert_risk_assessments(cursor, (
+                    {'patient_id': patient_id, 'overall_risk': rng.choice(RISK_LEVELS),
+                     'risks': {'aki': rng.uniform(0, 60), 'cardiovascular': rng.uniform(0, 60),
+                               'transfusion': rng.uniform(0, 60)},
+                     'recommendations': '{}', 'contributing_factors': '{}'}
+                    for patient_id in patient_ids
+                ))
+                database._insert_many(cursor, database.ICU_PREDICTION_INSERT, (
+                    database._icu_prediction_row(patient_id, None, {
+                        'icu_needed': rng.randint(0, 1),
+                        'icu_probability': round(rng.uniform(0, 100), 1),
+                        'risk_level': rng.choice(RISK_LEVELS),
+                        'predicted_icu_days': round(rng.uniform(1, 10), 1),
+                        'ventilator_needed': int(rng.random() < 0.3),
+                        'dialysis_needed': int(rng.random() < 0.1),
+                        'priority_score': rng.randint(1, 100)
+                    }) for patient_id in patient_ids
+                ))
+                database._insert_many(cursor, '''
+                    INSERT INTO icu_beds (
+                        room_number, floor_number, proximity_to_nursing_station,
+                        has_ventilator, has_dialysis, has_ecmo, isolation_room, bed_cost_per_day
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', ((
+                    f'B{i:04d}', 1 + i % 4, rng.randint(1, 10), int(rng.random() < 0.5),
+                    int(rng.random() < 0.2), int(rng.random() < 0.05), int(rng.random() < 0.1),
+                    rng.choice([2500.0, 3500.0, 4500.0])
+                ) for i in range(beds)))
+            yield database.DATABASE_PATH
+        finally:
+            database.DATABASE_PATH = original_path
+
+
+def summarize(label, samples_ms):
+    """Print p50/p99/max of a list of millisecond samples"""
+    samples_ms = sorted(samples_ms)
+    p99 = samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.99))]
+    print(f"  {label:<28} p50={statistics.median(samples_ms):8.2f} ms  "
+          f"p99={p99:8.2f} ms  max={samples_ms[-1]:8.2f} ms  n={len(samples_ms)}")
+
+
+@benchmark('async-latency')
+def bench_async_latency(args):
+    """Event-loop lag while heavy dashboard queries run, blocking vs AsyncDatabase"""
+    import asyncio
+    from async_database import AsyncDatabase
+
+    tick_ms = 5
+
+    async def measure_lag(workload):
+        lags = []
+        done = asyncio.Event()
+
+        async def ticker():
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(tick_ms / 1000)
+                lags.append((time.perf_counter() - start) * 1000 - tick_ms)
+
+        tick_task = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        await workload()
+        elapsed = time.perf_counter() - started
+        done.set()
+        await tick_task
+        return lags, elapsed
+
+    async def blocking_workload():
+        for _ in range(args.queries):
+            database.get_all_patients()
+            await asyncio.sleep(0)
+
+    async def async_workload(adb):
+        await asyncio.gather(*[adb.get_all_patients() for _ in range(args.queries)])
+
+    with seeded_database(patients=args.patients):
+        print(f"{args.queries} x get_all_patients() over {args.patients} patients")
+
+        lags, elapsed = asyncio.run(measure_lag(blocking_workload))
+        summarize(f'blocking ({elapsed:.2f}s)', lags)
+
+        adb = AsyncDatabase()
+        try:
+            lags, elapsed = asyncio.run(measure_lag(lambda: async_workload(adb)))
+        finally:
+            adb.close()
+        summarize(f'AsyncDatabase ({elapsed:.2f}s)', lags)
+
+
+@benchmark('read-contention')
+def bench_read_contention(args):
+    """Allocation latency while dashboard reads poll, rollback journal vs WAL + read pool"""
+    import sqlite3
+    import threading
+
+    def run(label, journal_mode, pool_enabled):
+        with database.get_db_connection() as conn:
+            conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+            bed_ids = [r['bed_id'] for r in conn.execute('SELECT bed_id FROM icu_beds')]
+            patient_ids = [r['patient_id'] for r in conn.execute('SELECT patient_id FROM patients')]
+        database.close_read_pools()
+        database.READ_POOL_ENABLED = pool_enabled
+
+        stop = threading.Event()
+        write_ms, read_ms, errors = [], [], []
+
+        def writer(beds):
+            i = 0
+            while not stop.is_set():
+                bed_id = beds[i % len(beds)]
+                start = time.perf_counter()
+                try:
+                    allocation_id = database.allocate_bed(patient_ids[i % len(patient_ids)], bed_id)
+                    database.discharge_from_icu(allocation_id, 'benchmark')
+                    database.update_bed_status(bed_id, 'available')
+                    write_ms.append((time.perf_counter() - start) * 1000)
+                except sqlite3.OperationalError as e:
+                    errors.append(str(e))
+                i += 1
+
+        def reader():
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    database.get_all_icu_beds()
+                    database.get_icu_capacity()
+                    database.get_icu_waitlist()
+                    read_ms.append((time.perf_counter() - start) * 1000)
+                except sqlite3.OperationalError as e:
+                    errors.append(str(e))
+
+        threads = [threading.Thread(target=writer, args=(bed_ids[w::args.writers],))
+                   for w in range(args.writers)]
+        threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+
+        print(f"{label}: {len(write_ms)} allocation cycles, {len(read_ms)} dashboard reads, "
+              f"{len(errors)} lock errors")
+        if write_ms:
+            summarize('allocation cycle', write_ms)
+        if read_ms:
+            summarize('dashboard read', read_ms)
+
+    with seeded_database(patients=args.patients, beds=args.beds):
+        print(f"{args.writers} writers, {args.readers} readers, {args.duration}s each, "
+              f"{args.patients} patients, {args.beds} beds")
+        run('rollback journal, no read pool', 'DELETE', False)
+        run('WAL + query_only read pool', 'WAL', True)
+        database.close_read_pools()
+        database.READ_POOL_ENABLED = True
+
+
+@benchmark('compact-rows')
+def bench_compact_rows(args):
+    """Memory and latency of dict rows + json.dumps vs streamed tuple rows, all patients"""
+    import json
+    import tracemalloc
+
+    def dict_path():
+        return len(json.dumps({'patients': database.get_all_patients()}))
+
+    def stream_path():
+        size = 0
+        for chunk in database.stream_all_patients_json():
+            size += len(chunk)
+        return size
+
+    with seeded_database(patients=args.patients):
+        print(f"All-patients response over {args.patients} patients")
+        for label, fn in [('dict rows + json.dumps', dict_path), ('streamed tuple rows', stream_path)]:
+            # Time without tracemalloc (it slows allocation-heavy code), then measure memory
+            start = time.perf_counter()
+            size = fn()
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"  {label:<28} {elapsed * 1000:8.0f} ms  peak {peak / 2**20:7.1f} MiB  "
+                  f"({size / 2**20:.1f} MiB of JSON)")
+
+
+@benchmark('icu-analytics')
+def bench_icu_analytics(args):
+    """get_icu_analytics over raw bed_allocations vs the icu_daily_stats rollup"""
+    rng = random.Random(7)
+    legacy_query = '''
+        SELECT AVG(duration_days), MIN(duration_days), MAX(duration_days), COUNT(*),
+               SUM(total_cost), SUM(CASE WHEN readmitted = 1 THEN 1 ELSE 0 END)
+        FROM bed_allocations
+        WHERE actual_discharge IS NOT NULL
+        AND actual_discharge >= datetime('now', '-' || ? || ' days')
+    '''
+
+    def timed(fn, repeat=20):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples
+
+    with seeded_database(patients=args.patients, beds=args.beds):
+        now = datetime.utcnow()
+        with database.get_db_connection() as conn:
+            cursor = conn.cursor()
+            bed_ids = [r[0] for r in cursor.execute('SELECT bed_id FROM icu_beds')]
+            patient_ids = [r[0] for r in cursor.execute('SELECT patient_id FROM patients')]
+            allocations = []
+            for _ in range(args.allocations):
+                start = now - timedelta(days=rng.uniform(1, 730))
+                stay = rng.uniform(0.5, 12)
+                end = min(now, start + timedelta(days=stay))
+                allocations.append((
+                    rng.choice(patient_ids), rng.choice(bed_ids),
+                    start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S'),
+                    (end - start).total_seconds() / 86400, stay * 3500, int(rng.random() < 0.05)
+                ))
+            cursor.executemany('''
+                INSERT INTO bed_allocations (
+                    patient_id, bed_id, allocated_at, actual_discharge, duration_days,
+                    total_cost, readmitted
+                ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', allocations)
+
+        start = time.perf_counter()
+        database.refresh_icu_daily_stats(days=None)
+        print(f"{args.allocations} historical allocations; rollup rebuilt in "
+              f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+        def legacy():
+            with database.get_db_connection() as conn:
+                conn.execute(legacy_query, (365,)).fetchone()
+
+        summarize('raw bed_allocations, 365d', timed(legacy))
+        summarize('rollup analytics, 365d', timed(lambda: database.get_icu_analytics(365)))
+        summarize('rollup daily trend, 365d', timed(lambda: database.get_icu_daily_trend(365)))
+
+
+def _sharded_writer(site, patient_id, duration, path, sites, result):
+    """Process body for the sharded-writes benchmark"""
+    database.DATABASE_PATH = path
+    database.SITES = sites
+    if site:
+        database.set_site(site)
+    count = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        database.save_symptom_log(patient_id, {'painLevel': 3, 'temperature': 37.2})
+        count += 1
+    result.put(count)
+
+
+@benchmark('sharded-writes')
+def bench_sharded_writes(args):
+    """Symptom-log write throughput from worker processes, one database file vs one shard per site"""
+    import multiprocessing
+
+    original_sites = database.SITES
+
+    def run(label, sites):
+        database.SITES = sites
+        database.init_database()
+        patient_ids = {}
+        for site in sites or [None]:
+            with (database.use_site(site) if site else database.unit_of_work()):
+                user_id = database.create_user(f'bench@{site}', 'x', 'patient', 'Bench')
+                patient_ids[site] = database.create_patient(user_id, None, {
+                    'surgery_type': 'General Surgery', 'surgery_date': '2026-01-01', 'age': 60,
+                    'gender': 1, 'bmi': 25.0, 'asa_class': 2, 'emergency_surgery': 0,
+                    'hemoglobin': 13.0, 'platelets': 250, 'creatinine': 1.0, 'albumin': 4.0,
+                    'blood_loss': 200
+                })
+        database.close_read_pools()
+
+        result = multiprocessing.Queue()
+        workers = []
+        for i in range(args.writers):
+            site = sites[i % len(sites)] if sites else None
+            workers.append(multiprocessing.Process(target=_sharded_writer, args=(
+                site, patient_ids[site], args.duration, database.DATABASE_PATH, sites, result
+            )))
+        for w in workers:
+            w.start()
+        total = sum(result.get() for _ in workers)
+        for w in workers:
+            w.join()
+        print(f"  {label:<28} {total / args.duration:8.0f} inserts/s")
+
+    with seeded_database(patients=0, beds=0):
+        print(f"{args.writers} writer processes, {args.duration}s each")
+        try:
+            run('single database file', [])
+            run(f'{args.sites} site shards', [f'site{i}' for i in range(args.sites)])
+        finally:
+            database.SITES = original_sites
+
+
+@benchmark('recommendation-dedup')
+def bench_recommendation_dedup(args):
+    """Database size and write time of inline recommendation JSON vs recommendation_sets"""
+    import json
+    from clinical_recs import ClinicalRecommendations
+
+    rng = random.Random(3)
+    categories = ['LOW', 'MODERATE', 'HIGH', 'CRITICAL']
+    assessments = []
+    for i in range(args.assessments):
+        risk_categories = {c: rng.choice(categories) for c in ['aki', 'cardiovascular', 'transfusion']}
+        overall_risk = max(risk_categories.values(), key=categories.index)
+        assessments.append({
+            'patient_id': 1 + i % 100,
+            'overall_risk': overall_risk,
+            'risks': {c: rng.uniform(0, 60) for c in risk_categories},
+            'recommendations': json.dumps(ClinicalRecommendations.generate_recommendations(
+                {'risk_categories': risk_categories, 'overall_risk': overall_risk, 'risks': {}}
+            )),
+            'contributing_factors': json.dumps({'age': f'{rng.randint(20, 90)} years'})
+        })
+
+    def inline(cursor, assessments):
+        cursor.executemany('''
+            INSERT INTO risk_assessments
+            (patient_id, overall_risk, mortality_risk, aki_risk, cardiovascular_risk,
+             transfusion_risk, recommendations, contributing_factors)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', ((a['patient_id'], a['overall_risk'], None, a['risks']['aki'],
+               a['risks']['cardiovascular'], a['risks']['transfusion'],
+               a['recommendations'], a['contributing_factors']) for a in assessments))
+
+    print(f"{args.assessments} risk assessments, "
+          f"{sum(len(a['recommendations']) for a in assessments) / 2**20:.1f} MiB of recommendation JSON")
+    for label, write in [('inline JSON', inline), ('recommendation_sets', database._insert_risk_assessments)]:
+        with seeded_database(patients=100, beds=0):
+            with database.get_db_connection() as conn:
+                cursor = conn.cursor()
+                before = database._used_bytes(cursor)
+                start = time.perf_counter()
+                write(cursor, assessments)
+                conn.commit()
+                elapsed = time.perf_counter() - start
+                grown = database._used_bytes(cursor) - before
+            print(f"  {label:<22} {elapsed * 1000:7.0f} ms  database grew {grown / 2**20:6.1f} MiB")
+
+
+@benchmark('login-burst')
+def bench_login_burst(args):
+    """Concurrent logins plus a dashboard probe, inline hashing vs the hashing thread pool"""
+    import threading
+    import password_hashing
+
+    def run(label, pooled):
+        password_hashing.HASH_POOL_ENABLED = pooled
+        login_ms, probe_ms, overloaded = [], [], []
+        done = threading.Event()
+
+        def login(i):
+            start = time.perf_counter()
+            try:
+                assert database.verify_user(f'user{i}@bench', 'password')
+                login_ms.append((time.perf_counter() - start) * 1000)
+            except password_hashing.HashingOverloaded:
+                overloaded.append(i)
+
+        def probe():
+            while not done.is_set():
+                start = time.perf_counter()
+                database.get_icu_capacity()
+                probe_ms.append((time.perf_counter() - start) * 1000)
+                time.sleep(0.005)
+
+        probe_thread = threading.Thread(target=probe)
+        probe_thread.start()
+        threads = [threading.Thread(target=login, args=(i,)) for i in range(args.logins)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        probe_thread.join()
+
+        print(f"{label}: {len(login_ms) / elapsed:.1f} logins/s, {len(overloaded)} turned away (503)")
+        summarize('login', login_ms)
+        summarize('dashboard probe', probe_ms)
+
+    with seeded_database(patients=0, beds=10):
+        password_hash = password_hashing.generate_password_hash('password')
+        with database.get_db_connection() as conn:
+            conn.executemany(
+                "INSERT INTO users (email, password_hash, user_type, full_name) VALUES (?, ?, 'doctor', 'Bench')",
+                ((f'user{i}@bench', password_hash) for i in range(args.logins))
+            )
+        print(f"{args.logins} concurrent logins, {password_hashing.HASH_WORKERS} hashing workers, "
+              f"{os.cpu_count()} CPUs")
+        try:
+            run('inline hashing', False)
+            run('hashing thread pool', True)
+        finally:
+            password_hashing.shutdown()
+            password_hashing.HASH_POOL_ENABLED = True
+
+
+@benchmark('group-commit')
+def bench_group_commit(args):
+    """Sustained symptom-log inserts/s from concurrent requests, commit per row vs group commit"""
+    import threading
+    from group_commit import GroupCommitWriter
+
+    def run(label, save):
+        stop = threading.Event()
+        counts = [0] * args.writers
+        latencies = [[] for _ in range(args.writers)]
+
+        def client(i):
+            while not stop.is_set():
+                start = time.perf_counter()
+                save(1 + i % 100, {'painLevel': 3, 'temperature': 37.2})
+                latencies[i].append((time.perf_counter() - start) * 1000)
+                counts[i] += 1
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.writers)]
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join()
+        print(f"{label}: {sum(counts) / args.duration:.0f} inserts/s")
+        summarize('request latency', [ms for per_client in latencies for ms in per_client])
+
+    with seeded_database(patients=100, beds=0):
+        print(f"{args.writers} concurrent clients, {args.duration}s each")
+        run('commit per row', database.save_symptom_log)
+        writer = GroupCommitWriter(database.SYMPTOM_LOG_INSERT)
+        try:
+            run('group commit', lambda patient_id, data: writer.insert(
+                database._symptom_log_row(patient_id, data)))
+        finally:
+            writer.close()
+        stats = writer.stats()
+        print(f"  {stats['flushes']} commits, avg batch {stats['avg_batch']}, "
+              f"largest {stats['largest_batch']}")
+
+
+@benchmark('bed-board')
+def bench_bed_board(args):
+    """Bed lookups and allocations through SQL vs the in-memory bed board"""
+    import bed_board
+    rng = random.Random(11)
+    filter_sets = [{}, {'has_ventilator': 1}, {'has_dialysis': 1},
+                   {'has_ventilator': 1, 'isolation_room': 1}, {'has_ecmo': 1}]
+
+    def timed(fn, repeat):
+        samples = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            fn(i)
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples
+
+    with seeded_database(patients=args.patients, beds=args.beds):
+        board = bed_board.get_bed_board()
+        try:
+            repeat = args.queries * 50
+            print(f"{args.beds} beds, {repeat} lookups each")
+            summarize('SQL available, filtered', timed(
+                lambda i: database.get_available_icu_beds(filter_sets[i % 5]), repeat))
+            summarize('board available, filtered', timed(
+                lambda i: board.search('available', filter_sets[i % 5]), repeat))
+            summarize('SQL nearest bed', timed(
+                lambda i: database.get_available_icu_beds(filter_sets[i % 5])[:1], repeat))
+            summarize('board nearest bed', timed(
+                lambda i: board.best_available(filter_sets[i % 5]), repeat))
+
+            # Half the beds get taken, then every bed is tried once more:
+            # the board turns the second round away without touching the database
+            bed_ids = [bed['bed_id'] for bed in board.search('available')]
+            rng.shuffle(bed_ids)
+            summarize('board allocate, free bed', timed(
+                lambda i: board.allocate(1 + i, bed_ids[i]), len(bed_ids) // 2))
+            summarize('SQL allocate, taken bed', timed(
+                lambda i: database.allocate_bed(1 + i, bed_ids[i]), len(bed_ids) // 2))
+            summarize('board allocate, taken bed', timed(
+                lambda i: board.allocate(1 + i, bed_ids[i]), len(bed_ids) // 2))
+
+            summarize('SQL all beds + occupants', timed(
+                lambda i: database.get_all_icu_beds(), args.queries))
+            summarize('board all beds + occupants', timed(
+                lambda i: bed_board.get_all_icu_beds(), args.queries))
+        finally:
+            bed_board.close_bed_boards()
+
+
+@benchmark('bed-assignment')
+def bench_bed_assignment(args):
+    """Greedy vs optimal batch bed assignment, waitlist x available beds"""
+    import bed_assignment
+    rng = random.Random(5)
+    beds = [{
+        'bed_id': i, 'proximity_to_nursing_station': rng.randint(1, 10),
+        'has_ventilator': int(rng.random() < 0.5), 'has_dialysis': int(rng.random() < 0.2),
+        'bed_cost_per_day': rng.choice([2500.0, 3500.0, 4500.0])
+    } for i in range(args.beds)]
+    waitlist = [{'patient_id': i} for i in range(args.waitlist)]
+    predictions = {i: {
+        'risk_level': rng.choice(RISK_LEVELS),
+        'ventilator_needed': int(rng.random() < 0.3), 'dialysis_needed': int(rng.random() < 0.1)
+    } for i in range(args.waitlist)}
+
+    print(f"{args.waitlist} waiting x {args.beds} beds")
+    scipy_available = bed_assignment.SCIPY_AVAILABLE
+    solvers = [('greedy', 'greedy', scipy_available), ('optimal', 'optimal', scipy_available)]
+    if scipy_available:
+        solvers.append(('optimal', 'optimal (numpy fallback)', False))
+    try:
+        for strategy, label, use_scipy in solvers:
+            bed_assignment.SCIPY_AVAILABLE = use_scipy
+            samples = []
+            for _ in range(args.queries):
+                plan = bed_assignment.plan_assignments(waitlist, predictions, beds, strategy)
+                samples.append(plan['solve_ms'])
+            summarize(label, samples)
+            print(f"    total score {plan['total_score']:.1f} "
+                  f"(greedy {plan['greedy_total_score']:.1f}, +{plan['improvement']:.1f})")
+    finally:
+        bed_assignment.SCIPY_AVAILABLE = scipy_available
+
+@benchmark('auto-assign')
+def bench_auto_assign(args):
+    """One /api/icu/auto-assign round: per-patient queries and commits vs bulk load and one transaction"""
+    import bed_assignment
+    import bed_board
+    import query_stats
+
+    def legacy_round():
+        # The endpoint before: a prediction query and a committed allocation per patient,
+        # and the free-bed list rebuilt after every assignment
+        available_beds = database.get_available_icu_beds()
+        assigned = 0
+        for patient in database.get_icu_waitlist():
+            if not available_beds:
+                break
+            prediction = database.get_icu_prediction(patient['patient_id'])
+            scores = bed_assignment.score_matrix([prediction], available_beds)[0]
+            best_bed = available_beds[int(scores.argmax())]
+            if database.allocate_bed(patient['patient_id'], best_bed['bed_id']):
+                assigned += 1
+                available_beds = [b for b in available_beds if b['bed_id'] != best_bed['bed_id']]
+        return assigned
+
+    def bulk_round():
+        return len(bed_assignment.assign_waiting_patients()['assigned'])
+
+    print(f"{args.patients} patients, {args.beds} beds")
+    for label, run in (('per-patient (before)', legacy_round), ('bulk (after)', bulk_round)):
+        with seeded_database(patients=args.patients, beds=args.beds):
+            was_enabled = query_stats.is_enabled()
+            query_stats.enable()
+            query_stats.reset()
+            try:
+                start = time.perf_counter()
+                assigned = run()
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                statements = sum(e['calls'] for e in query_stats.get_query_stats(limit=None)['statements'])
+            finally:
+                bed_board.close_bed_boards()
+                database.close_read_pools()
+                if not was_enabled:
+                    query_stats.disable()
+        print(f"  {label:<22} {elapsed_ms:8.1f} ms  {assigned} assigned  {statements} SQL statements")
+
+
+@benchmark('allocation-race')
+def bench_allocation_race(args):
+    """Concurrent allocators on a few beds: check-then-update vs conditional UPDATE in BEGIN IMMEDIATE"""
+    import threading
+
+    def legacy_allocate(patient_id, bed_id):
+        # allocate_bed before: SELECT status, then an unconditional UPDATE
+        with database.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT status FROM icu_beds WHERE bed_id = ?', (bed_id,))
+            if cursor.fetchone()['status'] != 'available':
+                return None
+            cursor.execute('''
+                UPDATE icu_beds
+                SET status = 'occupied', patient_id = ?, admitted_at = CURRENT_TIMESTAMP
+                WHERE bed_id = ?
+            ''', (patient_id, bed_id))
+            cursor.execute('''
+                INSERT INTO bed_allocations (patient_id, bed_id, allocated_by, allocation_type)
+                VALUES (?, ?, 'system', 'automatic')
+            ''', (patient_id, bed_id))
+            allocation_id = cursor.lastrowid
+            cursor.execute('''
+                SELECT DATE(a.allocated_at) as stat_date, b.floor_number
+                FROM bed_allocations a JOIN icu_beds b ON a.bed_id = b.bed_id
+                WHERE a.allocation_id = ?
+            ''', (allocation_id,))
+            admitted = cursor.fetchone()
+            cursor.execute(database.ICU_DAILY_STATS_UPSERT, (
+                admitted['stat_date'], admitted['floor_number'], 1, 0, 0, 0, 0, 0, None, None
+            ))
+            return allocation_id
+
+    def run(label, allocate):
+        with seeded_database(patients=100, beds=args.beds):
+            with database.get_db_connection() as conn:
+                bed_ids = [r[0] for r in conn.execute('SELECT bed_id FROM icu_beds')]
+            stop = threading.Event()
+            counts = {'allocations': 0, 'double_booked': 0, 'errors': 0}
+            lock = threading.Lock()
+
+            def allocator(n):
+                rng = random.Random(n)
+                while not stop.is_set():
+                    bed_id = rng.choice(bed_ids)
+                    try:
+                        allocation_id = allocate(1 + n, bed_id)
+                        if allocation_id is None:
+                            continue
+                        with database.get_db_connection() as conn:
+                            active = conn.execute('''
+                                SELECT COUNT(*) FROM bed_allocations
+                                WHERE bed_id = ? AND actual_discharge IS NULL
+                            ''', (bed_id,)).fetchone()[0]
+                        database.discharge_from_icu(allocation_id)
+                        database.update_bed_status(bed_id, 'available')
+                    except Exception:
+                        with lock:
+                            counts['errors'] += 1
+                        continue
+                    with lock:
+                        counts['allocations'] += 1
+                        counts['double_booked'] += active > 1
+
+            threads = [threading.Thread(target=allocator, args=(n,)) for n in range(args.writers)]
+            for t in threads:
+                t.start()
+            time.sleep(args.duration)
+            stop.set()
+            for t in threads:
+                t.join()
+            print(f"  {label:<26} {counts['allocations'] / args.duration:7.0f} allocations/s  "
+                  f"{counts['double_booked']} double-booked  {counts['errors']} errors")
+
+    print(f"{args.writers} allocators racing for {args.beds} beds, {args.duration}s each")
+    run('check-then-update (before)', legacy_allocate)
+    run('conditional UPDATE (after)', database.allocate_bed)
+
+
+@benchmark('waitlist-queue')
+def bench_waitlist_queue(args):
+    """ICU queue reads rebuilt by SQL vs the in-memory waitlist heap, and heap operation costs"""
+    import icu_waitlist_queue
+    rng = random.Random(13)
+
+    def timed(fn, repeat):
+        samples = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            fn(i)
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples
+
+    with seeded_database(patients=args.patients, beds=args.beds):
+        with database.get_db_connection() as conn:
+            patient_ids = [row[0] for row in conn.execute(
+                'SELECT patient_id FROM patients ORDER BY RANDOM() LIMIT ?', (args.waitlist,))]
+        waitlist = icu_waitlist_queue.get_waitlist_queue()
+        try:
+            print(f"{args.patients} patients, {len(patient_ids)} waiting, {args.queries} reads each")
+            summarize('enqueue', timed(
+                lambda i: waitlist.enqueue(patient_ids[i], None, rng.randint(1, 100)), len(patient_ids)))
+            summarize('SQL get_icu_waitlist', timed(lambda i: database.get_icu_waitlist(), args.queries))
+            summarize('heap get_icu_queue', timed(
+                lambda i: icu_waitlist_queue.get_icu_queue(), args.queries))
+            summarize('heap peek', timed(lambda i: waitlist.peek(), args.queries * 50))
+            waitlist_ids = [e['waitlist_id'] for e in waitlist.snapshot()]
+            summarize('reprioritize', timed(
+                lambda i: waitlist.reprioritize(waitlist_ids[i], rng.randint(1, 100)),
+                len(waitlist_ids) // 2))
+            summarize('dequeue', timed(lambda i: waitlist.dequeue(), len(waitlist_ids) // 2))
+        finally:
+            icu_waitlist_queue.close_waitlist_queues()
+
+
+@benchmark('occupancy-forecast')
+def bench_occupancy_forecast(args):
+    """Monte Carlo occupancy forecast: input queries and the vectorised simulation"""
+    import icu_forecast
+
+    with seeded_database(patients=args.patients, beds=args.beds):
+        with database.get_db_connection() as conn:
+            bed_ids = [row[0] for row in conn.execute('SELECT bed_id FROM icu_beds')]
+            patient_ids = [row[0] for row in conn.execute('SELECT patient_id FROM patients LIMIT ?',
+                                                          (len(bed_ids) * 3 // 4,))]
+        for patient_id, bed_id in zip(patient_ids, bed_ids):
+            database.allocate_bed(patient_id, bed_id)
+
+        inputs = icu_forecast.get_forecast_inputs()
+        print(f"{len(inputs['occupants'])} occupants, {len(inputs['scheduled'])} scheduled "
+              f"in {icu_forecast.HORIZON_DAYS} days, {inputs['capacity']} beds")
+        samples = []
+        for _ in range(args.queries):
+            start = time.perf_counter()
+            icu_forecast.get_forecast_inputs()
+            samples.append((time.perf_counter() - start) * 1000)
+        summarize('input queries', samples)
+        for scenarios in (1000, 10000):
+            samples = []
+            for _ in range(max(1, args.queries // 4)):
+                samples.append(icu_forecast.forecast_icu_occupancy(scenarios=scenarios)['elapsed_ms'])
+            summarize(f'forecast, {scenarios} scenarios', samples)
+        forecast = icu_forecast.forecast_icu_occupancy()
+        print(f"  P(over capacity on any day) {forecast['p_over_capacity_any_day']:.3f}, "
+              f"day {icu_forecast.HORIZON_DAYS} p5-p95 "
+              f"{forecast['days'][-1]['p5']:.0f}-{forecast['days'][-1]['p95']:.0f}")
+
+
+@benchmark('icu-events')
+def bench_icu_events(args):
+    """Dashboards polling bed status vs one change feed pushing to every dashboard"""
+    import threading
+
+    import bed_board
+    import icu_event_stream
+    import query_stats
+
+    ticks = args.queries
+
+    def statements():
+        return sum(e['calls'] for e in query_stats.get_query_stats(limit=None)['statements'])
+
+    with seeded_database(patients=args.patients, beds=args.beds):
+        with database.get_db_connection() as conn:
+            patient_ids = [row[0] for row in conn.execute('SELECT patient_id FROM patients LIMIT ?', (ticks,))]
+        bed_ids = [bed['bed_id'] for bed in bed_board.get_bed_board().search('available')]
+        was_enabled = query_stats.is_enabled()
+        query_stats.enable()
+        try:
+            print(f"{args.dashboards} dashboards, {ticks} polling intervals with one allocation each")
+
+            # Before: every dashboard re-reads all beds and the capacity every interval
+            query_stats.reset()
+            start = time.perf_counter()
+            for tick in range(ticks):
+                bed_board.allocate_bed(patient_ids[tick], bed_ids[tick])
+                for _ in range(args.dashboards):
+                    database.get_all_icu_beds()
+                    database.get_icu_capacity()
+            print(f"  {'polling (before)':<22} {(time.perf_counter() - start) * 1000:8.1f} ms  "
+                  f"{statements()} SQL statements")
+
+            # After: one watcher diffs the bed board and the dashboards share its events
+            stream = icu_event_stream.get_event_stream()
+            seen = [0] * args.dashboards
+
+            def dashboard(n):
+                for chunk in stream.subscribe(heartbeat=1):
+                    if chunk.startswith('id:'):
+                        seen[n] = int(chunk.split('\n', 1)[0].rsplit('-', 1)[1])
+
+            for n in range(args.dashboards):
+                threading.Thread(target=dashboard, args=(n,), daemon=True).start()
+            time.sleep(0.5)
+            query_stats.reset()
+            start = time.perf_counter()
+            for tick in range(ticks):
+                bed_board.discharge_from_icu(tick + 1)
+                bed_board.update_bed_status(bed_ids[tick], 'available')
+                # Every dashboard has the change before the next one
+                stream._refresh()
+                while min(seen) < stream.status()['published']:
+                    time.sleep(0.001)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            print(f"  {'change feed (after)':<22} {elapsed_ms:8.1f} ms  {statements()} SQL statements  "
+                  f"{stream.status()['published']} events to each dashboard")
+        finally:
+            icu_event_stream.close_event_streams()
+            bed_board.close_bed_boards()
+            database.close_read_pools()
+            if not was_enabled:
+                query_stats.disable()
+
+
+@benchmark('icu-ledger')
+def bench_icu_ledger(args):
+    """ICU state at a past timestamp: full ledger replay vs nearest snapshot plus replay"""
+    import icu_ledger
+    rng = random.Random(17)
+    statuses = ['available', 'occupied', 'cleaning', 'maintenance']
+
+    with seeded_database(patients=args.patients, beds=args.beds):
+        with database.get_db_connection() as conn:
+            bed_ids = [row[0] for row in conn.execute('SELECT bed_id FROM icu_beds')]
+            # Real transitions through the triggers, then spread evenly over years of history
+            conn.executemany('UPDATE icu_beds SET status = ? WHERE bed_id = ?', (
+                (rng.choice(statuses), rng.choice(bed_ids)) for _ in range(args.allocations)))
+            conn.execute('''
+                UPDATE icu_events SET occurred_at =
+                    strftime('%Y-%m-%d %H:%M:%f', 'now', '-3 years', '+' || (event_id * 7) || ' minutes')
+            ''')
+            conn.execute('''
+                UPDATE icu_snapshots SET taken_at =
+                    (SELECT occurred_at FROM icu_events WHERE event_id = last_event_id)
+            ''')
+            events, first, last = conn.execute(
+                'SELECT COUNT(*), MIN(occurred_at), MAX(occurred_at) FROM icu_events').fetchone()
+            snapshots = conn.execute('SELECT COUNT(*) FROM icu_snapshots').fetchone()[0]
+        print(f"{events} events from {first[:10]} to {last[:10]}, {snapshots} snapshots, "
+              f"{len(bed_ids)} beds")
+
+        span = (datetime.fromisoformat(last) - datetime.fromisoformat(first)).total_seconds()
+        moments = [icu_ledger.ledger_time(datetime.fromisoformat(first) + timedelta(seconds=rng.uniform(0, span)))
+                   for _ in range(args.queries)]
+
+        def full_replay(at):
+            with database.get_db_connection(read_only=True) as conn:
+                beds = {}
+                for event in icu_ledger._events(conn.cursor(), 0, None, at):
+                    icu_ledger._apply(beds, event)
+                return {bed_id: bed['status'] for bed_id, bed in beds.items()}
+
+        for label, fn in [('full replay (before)', full_replay),
+                          ('snapshot + replay (after)', icu_ledger.get_icu_state_at)]:
+            samples = []
+            for at in moments:
+                start = time.perf_counter()
+                fn(at)
+                samples.append((time.perf_counter() - start) * 1000)
+            summarize(label, samples)
+
+        for at in moments[:5]:
+            state = icu_ledger.get_icu_state_at(at)
+            assert {bed['bed_id']: bed['status'] for bed in state['beds']} == full_replay(at)
+        start = time.perf_counter()
+        series = icu_ledger.get_icu_occupancy_series(moments[0], icu_ledger.ledger_time(
+            datetime.fromisoformat(moments[0]) + timedelta(days=30)), 60)
+        print(f"  30-day hourly series        {(time.perf_counter() - start) * 1000:8.2f} ms  "
+              f"{len(series['points'])} points")
+        database.close_read_pools()
+
+
+@benchmark('auto-allocate')
+def bench_auto_allocate(args):
+    """Background auto-allocation: passes per burst of freed beds and bed-free-to-assignment latency"""
+    import auto_allocator
+    import bed_assignment
+    import bed_board
+    import icu_waitlist_queue
+    rng = random.Random(19)
+    bursts = max(1, args.queries // 2)
+
+    with seeded_database(patients=args.patients, beds=args.beds):
+        board = bed_board.get_bed_board()
+        bed_assignment.assign_waiting_patients()
+        # The worker only assigns patients on the icu_waitlist queue
+        with database.get_db_connection() as conn:
+            waiting = [row[0] for row in conn.execute('''
+                SELECT patient_id FROM patients
+                WHERE patient_id NOT IN (SELECT patient_id FROM icu_beds WHERE patient_id IS NOT NULL)
+                LIMIT ?
+            ''', (args.waitlist,))]
+        for patient_id in waiting:
+            icu_waitlist_queue.add_to_icu_waitlist(patient_id, None, rng.randint(1, 100))
+        allocator = auto_allocator.AutoAllocator(database.DATABASE_PATH)
+        auto_allocator._allocators[database.DATABASE_PATH] = allocator
+        try:
+            allocator.start()
+            print(f"{board.count('occupied')} of {args.beds} beds occupied, {bursts} bursts of discharges, "
+                  f"debounce {allocator.debounce}s")
+            freed = 0
+            for _ in range(bursts):
+                with database.get_db_connection() as conn:
+                    stays = [tuple(row) for row in conn.execute('''
+                        SELECT a.allocation_id, a.bed_id FROM bed_allocations a
+                        JOIN icu_beds b ON b.bed_id = a.bed_id AND b.patient_id = a.patient_id
+                        WHERE b.status = 'occupied' AND a.actual_discharge IS NULL
+                    ''')]
+                for allocation_id, bed_id in rng.sample(stays, min(len(stays), rng.randint(1, 8))):
+                    board.discharge(allocation_id)
+                    board.set_status(bed_id, 'available')
+                    freed += 1
+                    time.sleep(rng.uniform(0, 0.2))
+                time.sleep(allocator.debounce + 1)
+            status = allocator.status()
+            latency = status['bed_free_to_assignment_seconds'] or {}
+            print(f"  {freed} beds freed, {status['passes']} assignment passes, {status['assigned']} assigned")
+            print(f"  bed free to assignment      p50={latency.get('p50', 0):6.2f} s  "
+                  f"p95={latency.get('p95', 0):6.2f} s  max={latency.get('max', 0):6.2f} s")
+        finally:
+            auto_allocator.stop_auto_allocators()
+            icu_waitlist_queue.close_waitlist_queues()
+            bed_board.close_bed_boards()
+            database.close_read_pools()
+
+
+@benchmark('icu-recommendations')
+def bench_icu_recommendations(args):
+    """Capacity recommendations: every patient filtered in Python vs indexed window queries"""
+    import bed_assignment
+    import bed_board
+    import icu_recommendations
+
+    def legacy_postpone():
+        # The endpoint's old loop over get_all_patients()
+        candidates = []
+        for patient in database.get_all_patients():
+            if patient.get('surgery_date'):
+                surgery_date = datetime.fromisoformat(patient['surgery_date'].replace('Z', '+00:00'))
+                days_until = (surgery_date.date() - datetime.now().date()).days
+                if 0 <= days_until <= 7 and patient.get('overall_risk', 'MODERATE') in ['LOW', 'MODERATE']:
+                    candidates.append(patient)
+        return candidates
+
+    for patients in (args.patients // 4, args.patients):
+        with seeded_database(patients=patients, beds=args.beds):
+            bed_assignment.assign_waiting_patients()
+            bed_board.close_bed_boards()
+            print(f"{patients} patients")
+            for label, fn in [('Python filter (before)', legacy_postpone),
+                              ('SQL window (after)', icu_recommendations.get_icu_recommendations)]:
+                samples = []
+                for _ in range(args.queries):
+                    start = time.perf_counter()
+                    fn()
+                    samples.append((time.perf_counter() - start) * 1000)
+                summarize(label, samples)
+            result = icu_recommendations.get_icu_recommendations()
+            print(f"  utilization {result['capacity']['utilization_rate']}%, "
+                  f"{len(icu_recommendations.get_postpone_candidates())} postpone candidates")
+            database.close_read_pools()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Database layer benchmarks')
+    parser.add_argument('benchmark', nargs='?', choices=sorted(BENCHMARKS))
+    parser.add_argument('--list', action='store_true', help='list benchmarks')
+    parser.add_argument('--patients', type=int, default=20000)
+    parser.add_argument('--beds', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--allocations', type=int, default=200000)
+    parser.add_argument('--sites', type=int, default=4)
+    parser.add_argument('--assessments', type=int, default=20000)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--waitlist', type=int, default=500)
+    parser.add_argument('--dashboards', type=int, default=50)
+    args = parser.parse_args()
+
+    if args.list or not args.benchmark:
+        for name, fn in sorted(BENCHMARKS.items()):
+            print(f"{name:<20} {fn.__doc__}")
+        return
+
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+"""
+Database maintenance
+Keeps planner statistics fresh, hands free pages back to the file system in
+small steps and checks integrity, recording every run in maintenance_runs.
+
+Tasks (run in this order by run_maintenance):
+  optimize            bounded ANALYZE of tables without statistics or whose
+                      size changed STALE_ROW_FACTOR-fold, then PRAGMA optimize
+  incremental_vacuum  free pages in steps of VACUUM_STEP_PAGES, one short
+                      write transaction each, up to a page budget
+  checkpoint          PRAGMA wal_checkpoint(TRUNCATE) so the file shrinks
+  quick_check         PRAGMA quick_check
+  archive_symptoms    archive_symptom_logs()         (optional)
+  icu_daily_stats     refresh_icu_daily_stats()      (optional)
+
+A MaintenanceScheduler thread runs the default tasks every
+RECOVAI_MAINTENANCE_INTERVAL_HOURS (0 disables it).
+"""
+
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import database
+
+MAINTENANCE_INTERVAL_HOURS = float(os.environ.get('RECOVAI_MAINTENANCE_INTERVAL_HOURS', '24'))
+
+# Pages freed per incremental_vacuum transaction, and per run
+VACUUM_STEP_PAGES = 256
+VACUUM_PAGE_BUDGET = 20000
+
+# Rows sampled per index by ANALYZE
+ANALYSIS_LIMIT = 1000
+# Tables are analyzed again once their row count grew or shrank this many times
+STALE_ROW_FACTOR = 10
+
+DEFAULT_TASKS = ['optimize', 'incremental_vacuum', 'checkpoint', 'quick_check']
+OPTIONAL_TASKS = ['archive_symptoms', 'icu_daily_stats']
+
+
+def _file_size():
+    """Bytes on disk for the current database, including its WAL"""
+    path = database.current_database_path()
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def _page_stats(conn):
+    return {
+        'page_size': conn.execute('PRAGMA page_size').fetchone()[0],
+        'page_count': conn.execute('PRAGMA page_count').fetchone()[0],
+        'freelist_count': conn.execute('PRAGMA freelist_count').fetchone()[0]
+    }
+
+
+def _stale_tables(conn):
+    """
+    Indexed tables with rows but no statistics, or whose row count moved
+    STALE_ROW_FACTOR-fold since they were analyzed
+    The rowid span (two b-tree seeks) bounds the row count from above, so a
+    table is only counted when its span says it may have grown that much.
+    """
+    analyzed = {}
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+        # The first number of every stat is the table's row count at ANALYZE time
+        analyzed = dict(conn.execute(
+            'SELECT tbl, MAX(CAST(stat AS INTEGER)) FROM sqlite_stat1 GROUP BY tbl'
+        ).fetchall())
+    stale = []
+    for (table,) in conn.execute('''
+        SELECT DISTINCT tbl_name FROM sqlite_master
+        WHERE type = 'index' AND tbl_name NOT LIKE 'sqlite_%'
+        ORDER BY tbl_name
+    ''').fetchall():
+        # Separate subqueries: MIN and MAX in one SELECT would scan the table
+        span = conn.execute(f'''
+            SELECT COALESCE((SELECT MAX(rowid) FROM "{table}")
+                            - (SELECT MIN(rowid) FROM "{table}") + 1, 0)
+        ''').fetchone()[0]
+        before = analyzed.get(table)
+        if before is None:
+            if span:
+                stale.append(table)
+        elif span * STALE_ROW_FACTOR < before:
+            stale.append(table)
+        elif span > before * STALE_ROW_FACTOR:
+            # Deleted rows leave gaps in the span; count before re-analyzing
+            rows = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+            if rows > before * STALE_ROW_FACTOR:
+                stale.append(table)
+    return stale
+
+
+def _optimize(full_analyze=False, **_):
+    # PRAGMA optimize alone only re-analyzes tables this connection's queries
+    # used (before SQLite 3.46), so on a fresh connection it never analyzes
+    # anything; stale tables are found and analyzed explicitly
+    with database.get_db_connection() as conn:
+        if full_analyze:
+            conn.execute('ANALYZE')
+            analyzed = None
+        else:
+            conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+            analyzed = _stale_tables(conn)
+            for table in analyzed:
+                conn.execute(f'ANALYZE "{table}"')
+            conn.execute('PRAGMA optimize')
+        stat_rows = conn.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).fetchone()[0]
+    return {'full_analyze': full_analyze, 'analyzed_tables': analyzed, 'has_statistics': bool(stat_rows)}
+
+
+def _incremental_vacuum(page_budget=VACUUM_PAGE_BUDGET, **_):
+    with database.get_db_connection() as conn:
+        mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        before = _page_stats(conn)
+    if mode != 2:
+        return {'skipped': 'auto_vacuum is not INCREMENTAL; run convert_to_incremental_vacuum() once',
+                'freelist_count': before['freelist_count']}
+
+    freed = 0
+    steps = 0
+    while freed < page_budget:
+        with database.get_db_connection() as conn:
+            free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if not free:
+                break
+            step = min(VACUUM_STEP_PAGES, free, page_budget - freed)
+            # Every row of the result frees one page, so it must be read to the end
+            conn.execute(f'PRAGMA incremental_vacuum({step})').fetchall()
+        freed += step
+        steps += 1
+
+    with database.get_db_connection() as conn:
+        after = _page_stats(conn)
+    return {'pages_freed': freed, 'steps': steps,
+            'freelist_before': before['freelist_count'], 'freelist_after': after['freelist_count']}
+
+
+def _checkpoint(**_):
+    with database.get_db_connection() as conn:
+        busy, log_frames, checkpointed = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    return {'busy': bool(busy), 'log_frames': log_frames, 'checkpointed_frames': checkpointed}
+
+
+def _quick_check(**_):
+    with database.get_db_connection(read_only=True) as conn:
+        problems = [row[0] for row in conn.execute('PRAGMA quick_check')]
+    if problems != ['ok']:
+        raise RuntimeError('quick_check failed: ' + '; '.join(problems[:10]))
+    return {'result': 'ok'}
+
+
+def _archive_symptoms(**_):
+    return database.archive_symptom_logs()
+
+
+def _icu_daily_stats(**_):
+    return {'rows_recomputed': database.refresh_icu_daily_stats()}
+
+
+TASKS = {
+    'optimize': _optimize,
+    'incremental_vacuum': _incremental_vacuum,
+    'checkpoint': _checkpoint,
+    'quick_check': _quick_check,
+    'archive_symptoms': _archive_symptoms,
+    'icu_daily_stats': _icu_daily_stats
+}
+
+
+def _record_run(task, status, started_at, duration_ms, size_before, size_after, details):
+    with database.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO maintenance_runs (
+                task, status, started_at, duration_ms, size_before, size_after, details
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (task, status, started_at, duration_ms, size_before, size_after,
+              json.dumps(details, default=str)))
+        return cursor.lastrowid
+
+
+def run_maintenance(tasks=None, **options):
+    """
+    Run maintenance tasks on the current database and record each run
+    options: full_analyze=True for a full ANALYZE, page_budget for the vacuum
+    Returns one record per task; a failing task does not stop the others.
+    """
+    tasks = tasks or DEFAULT_TASKS
+    unknown = set(tasks) - set(TASKS)
+    if unknown:
+        raise ValueError(f'Unknown maintenance tasks: {", ".join(sorted(unknown))}')
+
+    results = []
+    for task in tasks:
+        started_at = datetime.now().isoformat(timespec='seconds')
+        size_before = _file_size()
+        start = time.perf_counter()
+        try:
+            details = TASKS[task](**options)
+            status = 'ok'
+        except Exception as e:
+            details = {'error': str(e)}
+            status = 'error'
+            print(f"⚠️  Maintenance task {task} failed: {e}")
+        duration_ms = round((time.perf_counter() - start) * 1000, 3)
+        size_after = _file_size()
+
+        run_id = _record_run(task, status, started_at, duration_ms, size_before, size_after, details)
+        results.append({
+            'run_id': run_id, 'task': task, 'status': status, 'started_at': started_at,
+            'duration_ms': duration_ms, 'size_before': size_before, 'size_after': size_after,
+            'details': details
+        })
+    return results
+
+
+def run_maintenance_all_sites(tasks=None, **options):
+    """run_maintenance on every site shard in multi-site mode, else on the single database"""
+    if not database.SITES:
+        return {None: run_maintenance(tasks, **options)}
+    results = {}
+    for site in database.SITES:
+        with database.use_site(site):
+            results[site] = run_maintenance(tasks, **options)
+    return results
+
+
+def convert_to_incremental_vacuum():
+    """
+    Switch an existing database to auto_vacuum=INCREMENTAL
+    Needs one full VACUUM, which rewrites the file and locks it meanwhile.
+    """
+    with database.get_db_connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return False
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.commit()
+        conn.execute('VACUUM')
+        return True
+
+
+def get_maintenance_status(limit=20):
+    """Current file and page statistics, the last run of each task and recent runs"""
+    with database.get_db_connection(read_only=True) as conn:
+        pages = _page_stats(conn)
+        pages['auto_vacuum'] = {0: 'none', 1: 'full', 2: 'incremental'}[
+            conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        ]
+        recent = [dict(row) for row in conn.execute('''
+            SELECT * FROM maintenance_runs ORDER BY run_id DESC LIMIT ?
+        ''', (limit,))]
+        last = [dict(row) for row in conn.execute('''
+            SELECT task, status, MAX(started_at) as started_at, duration_ms
+            FROM maintenance_runs
+            GROUP BY task
+        ''')]
+    for run in recent:
+        run['details'] = json.loads(run['details']) if run['details'] else None
+
+    return {
+        'file_size': _file_size(),
+        'pages': pages,
+        'last_runs': last,
+        'recent_runs': recent,
+        'scheduler': _scheduler.status() if _scheduler else None
+    }
+
+
+class MaintenanceScheduler:
+    """Daemon thread running the default maintenance tasks at a fixed interval"""
+
+    def __init__(self, interval_hours=MAINTENANCE_INTERVAL_HOURS, first_delay_minutes=10):
+        self.interval = timedelta(hours=interval_hours)
+        self.next_run = datetime.now() + timedelta(minutes=first_delay_minutes)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='db-maintenance', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def status(self):
+        return {'interval_hours': self.interval.total_seconds() / 3600,
+                'next_run': self.next_run.isoformat(timespec='seconds')}
+
+    def _run(self):
+        while not self._stop.wait(max(0, (self.next_run - datetime.now()).total_seconds())):
+            try:
+                run_maintenance_all_sites()
+            except Exception as e:
+                print(f"⚠️  Scheduled maintenance failed: {e}")
+            self.next_run = datetime.now() + self.interval
+
+
+_scheduler = None
+
+
+def start_scheduler():
+    """Start the maintenance thread once per process (no-op when the interval is 0)"""
+    global _scheduler
+    if _scheduler is None and MAINTENANCE_INTERVAL_HOURS > 0:
+        _scheduler = MaintenanceScheduler().start()
+    return _scheduler
@@ -21,11 +21,48 @@ export default function ICUDashboard() {
   useEffect(() => {
     if (admin) {
       fetchICUData();
-      const interval = setInterval(fetchICUData, 30000);
-      return () => clearInterval(interval);
+
+      // Live bed, capacity and waitlist changes; EventSource reconnects by itself
+      // and resumes from the last event it received
+      const events = new EventSource('http://localhost:5000/api/admin/icu-events', {
+        withCredentials: true,
+      });
+      events.addEventListener('snapshot', (e) => {
+        const snapshot = JSON.parse(e.data);
+        setIcuData((prev) => ({
+          ...prev,
+          status: snapshot.capacity || prev.status,
+          beds: snapshot.beds,
+          waitlist: snapshot.waitlist,
+        }));
+        setLoading(false);
+      });
+      events.addEventListener('bed', (e) => {
+        const bed = JSON.parse(e.data);
+        setIcuData((prev) => ({ ...prev, beds: mergeBed(prev.beds, bed) }));
+      });
+      events.addEventListener('capacity', (e) => {
+        const capacity = JSON.parse(e.data);
+        setIcuData((prev) => ({ ...prev, status: capacity }));
+      });
+      events.addEventListener('waitlist', (e) => {
+        const waitlist = JSON.parse(e.data);
+        setIcuData((prev) => ({ ...prev, waitlist }));
+      });
+      return () => events.close();
     }
   }, [admin]);
 
+  const mergeBed = (beds, bed) => {
+    const others = beds.filter((b) => b.bed_id !== bed.bed_id);
+    if (bed.removed) {
+      return others;
+    }
+    return [...others, bed].sort((a, b) =>
+      a.floor_number - b.floor_number || String(a.room_number).localeCompare(String(b.room_number))
+    );
+  };
+
   const checkAuth = async () => {
     try {
       const response = await fetch('http://localhost:5000/api/admin/check-session', {
@@ -93,7 +130,7 @@ export default function ICUDashboard() {
       
       if (response.ok) {
         alert(`✅ Bed allocated successfully!\n${data.message}`);
-        fetchICUData(); // Refresh data
+        // The event stream delivers the new bed and waitlist state
       } else {
         alert('Failed to allocate bed: ' + (data.error || 'Unknown error'));
       }
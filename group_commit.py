@@ -0,0 +1,206 @@
+"""
+Group-commit writer for high-volume inserts
+Concurrent requests hand their rows to one background thread, which inserts
+everything that arrived within GROUP_COMMIT_MS (or GROUP_COMMIT_ROWS rows) in
+a single transaction. One commit and one fsync then cover the whole batch
+instead of one per row.
+
+Callers block until the transaction holding their row has committed, so a
+request is only acknowledged once its row is durable. A caller that waited
+COMMIT_TIMEOUT_SECONDS withdraws its row if it is still queued, and otherwise
+waits for its batch to finish: an error always means the row was not written.
+"""
+
+import atexit
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import database
+
+GROUP_COMMIT_MS = float(os.environ.get('RECOVAI_GROUP_COMMIT_MS', '5'))
+GROUP_COMMIT_ROWS = int(os.environ.get('RECOVAI_GROUP_COMMIT_ROWS', '256'))
+
+# How long a request waits for its row to be taken into a batch
+COMMIT_TIMEOUT_SECONDS = 10
+
+
+class GroupCommitWriter:
+    """Background thread inserting rows from many callers in shared transactions"""
+
+    def __init__(self, query, max_delay_ms=GROUP_COMMIT_MS, max_rows=GROUP_COMMIT_ROWS):
+        self.query = query
+        self.max_delay = max_delay_ms / 1000
+        self.max_rows = max_rows
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Database path -> connection owned by the writer thread (one per site shard)
+        self._connections = {}
+        self._stats_lock = threading.Lock()
+        self._started_at = None
+        self._rows = 0
+        self._flushes = 0
+        self._largest_batch = 0
+        self._flush_seconds = 0.0
+
+    def submit(self, row):
+        """Queue a row; returns a Future resolving to its rowid once committed"""
+        future = Future()
+        path = database.current_database_path()
+        self._ensure_started()
+        self._queue.put((path, row, future))
+        return future
+
+    def insert(self, row, timeout=COMMIT_TIMEOUT_SECONDS):
+        """
+        Insert a row and wait until its transaction has committed; returns the rowid
+        Raises TimeoutError, with the row withdrawn, if it was still queued after
+        timeout seconds; a row already being written is waited for to the end.
+        """
+        future = self.submit(row)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            if future.cancel():
+                raise TimeoutError(f'Row not written: still queued after {timeout} s') from None
+            return future.result()
+
+    def close(self):
+        """Flush everything queued and stop the writer thread"""
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def stats(self):
+        with self._stats_lock:
+            elapsed = time.monotonic() - self._started_at if self._started_at else 0
+            return {
+                'rows': self._rows,
+                'flushes': self._flushes,
+                'avg_batch': round(self._rows / self._flushes, 1) if self._flushes else 0,
+                'largest_batch': self._largest_batch,
+                'avg_flush_ms': round(self._flush_seconds / self._flushes * 1000, 3) if self._flushes else 0,
+                'inserts_per_sec': round(self._rows / elapsed, 1) if elapsed else 0
+            }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            by_path = {}
+            for path, row, future in batch:
+                # False when the caller timed out and withdrew the row
+                if future.set_running_or_notify_cancel():
+                    by_path.setdefault(path, []).append((row, future))
+            for path, items in by_path.items():
+                self._flush(path, items)
+
+        for conn in self._connections.values():
+            conn.close()
+        self._connections.clear()
+
+    def _connection(self, path):
+        conn = self._connections.get(path)
+        if conn is None:
+            conn = self._connections[path] = database._connect(path)
+        return conn
+
+    def _flush(self, path, items):
+        start = time.monotonic()
+        try:
+            conn = self._connection(path)
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+
+        try:
+            row_ids = database._insert_many(conn.cursor(), self.query, [row for row, _ in items])
+            conn.commit()
+        except sqlite3.Error:
+            # One bad row (e.g. a CHECK constraint) must not fail everyone else's insert
+            conn.rollback()
+            self._flush_one_by_one(conn, items)
+        except Exception as e:
+            conn.rollback()
+            for _, future in items:
+                future.set_exception(e)
+        else:
+            for (_, future), row_id in zip(items, row_ids):
+                future.set_result(row_id)
+
+        with self._stats_lock:
+            if self._started_at is None:
+                self._started_at = start
+            self._rows += len(items)
+            self._flushes += 1
+            self._largest_batch = max(self._largest_batch, len(items))
+            self._flush_seconds += time.monotonic() - start
+
+    def _flush_one_by_one(self, conn, items):
+        for row, future in items:
+            try:
+                row_id = conn.execute(self.query, row).lastrowid
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                future.set_exception(e)
+            else:
+                future.set_result(row_id)
+
+
+_symptom_writer = None
+_symptom_writer_lock = threading.Lock()
+
+
+def symptom_writer():
+    """The shared group-commit writer for symptom logs"""
+    global _symptom_writer
+    if _symptom_writer is None:
+        with _symptom_writer_lock:
+            if _symptom_writer is None:
+                _symptom_writer = GroupCommitWriter(database.SYMPTOM_LOG_INSERT)
+                atexit.register(_symptom_writer.close)
+    return _symptom_writer
+
+
+def save_symptom_log(patient_id, symptom_data):
+    """
+    database.save_symptom_log through the group-commit writer; returns the log_id
+    once the row is committed. Inside a unit of work the row joins that
+    transaction instead.
+    """
+    if getattr(database._local, 'conn', None) is not None:
+        return database.save_symptom_log(patient_id, symptom_data)
+    return symptom_writer().insert(database._symptom_log_row(patient_id, symptom_data))
@@ -0,0 +1,274 @@
+"""
+ICU change feed for Server-Sent Events
+One watcher thread per database turns changes of the bed board and the
+waitlist queue into events, which every connected dashboard then reads from
+a shared ring buffer. Database work happens once per change, however many
+dashboards are open; a subscriber only waits on a condition.
+
+Events (data is JSON):
+  snapshot   {'beds', 'capacity', 'waitlist'}: full state, sent on connect
+  bed        one bed with its occupant's name and risk, after any change to it
+  capacity   bed counts as get_icu_capacity returns them, after bed changes
+  waitlist   the whole waiting queue in order, after it changes
+
+The watcher wakes when the bed board or the waitlist queue writes (notify())
+and otherwise checks PRAGMA data_version every POLL_SECONDS, so changes made
+by other processes or straight through database.py are published too.
+
+Event IDs are '<stream epoch>-<sequence>'. A client reconnecting with a
+Last-Event-ID still in the buffer gets the events it missed; any other ID
+(too old, or from another process) gets a fresh snapshot.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from itertools import islice
+
+import database
+
+POLL_SECONDS = float(os.environ.get('RECOVAI_EVENT_POLL_SECONDS', '1.0'))
+HEARTBEAT_SECONDS = 15
+EVENT_BUFFER = 1000
+
+
+def _capacity(counts):
+    """get_icu_capacity's fields from the bed board's status counts"""
+    data = {
+        'total_beds': sum(counts.values()),
+        'available_beds': counts.get('available', 0),
+        'occupied_beds': counts.get('occupied', 0),
+        'maintenance_beds': counts.get('maintenance', 0),
+        'cleaning_beds': counts.get('cleaning', 0)
+    }
+    data['occupied'] = data['occupied_beds']
+    total = data['total_beds']
+    data['utilization_rate'] = round((data['occupied_beds'] / total) * 100, 1) if total else 0
+    return data
+
+
+def format_event(event):
+    """One event in text/event-stream framing"""
+    event_id, event_type, data = event
+    return f'id: {event_id}\nevent: {event_type}\ndata: {data}\n\n'
+
+
+class EventStream:
+    """Change feed of one database's beds and waitlist"""
+
+    def __init__(self, path, site=None):
+        self.path = path
+        self.site = site
+        self.epoch = format(int(time.time() * 1000), 'x')
+        self._conn = database._connect(path, cross_thread=True)
+        self._version = None
+        self._condition = threading.Condition()
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._events = deque(maxlen=EVENT_BUFFER)
+        self._sequence = 0
+        self._subscribers = 0
+        self._published = 0
+        # Last published state: board rows and the beds as published, capacity,
+        # [(waitlist_id, priority)] and the waitlist as published
+        self._board_beds = {}
+        self._beds = {}
+        self._capacity = None
+        self._waitlist_keys = None
+        self._waitlist = []
+        with self._site():
+            self._refresh(publish=False)
+        self._thread = threading.Thread(target=self._run, name='icu-events', daemon=True)
+        self._thread.start()
+
+    def _site(self):
+        return database.use_site(self.site) if self.site else nullcontext()
+
+    # ---- watcher ----
+
+    def notify(self):
+        """Check for changes now instead of at the next poll"""
+        self._wake.set()
+
+    def _run(self):
+        with self._site():
+            while not self._stop.is_set():
+                # Idle streams only wake for writes made through this process
+                self._wake.wait(POLL_SECONDS if self._subscribers else None)
+                self._wake.clear()
+                if self._stop.is_set():
+                    return
+                try:
+                    self._refresh()
+                except Exception as e:
+                    print(f"⚠️  ICU event stream refresh failed: {e}")
+
+    def _refresh(self, publish=True):
+        """Diff the bed board and waitlist queue against the last published state"""
+        with self._refresh_lock:
+            self._diff(publish)
+
+    def _diff(self, publish):
+        import bed_board
+        import icu_waitlist_queue
+
+        version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if version == self._version and publish:
+            return
+        self._version = version
+
+        board = bed_board.get_bed_board()
+        beds = {bed['bed_id']: bed for bed in board.beds()}
+        changed = [bed_id for bed_id, bed in beds.items() if self._board_beds.get(bed_id) != bed]
+        removed = [bed_id for bed_id in self._board_beds if bed_id not in beds]
+        occupants = bed_board._occupants({beds[bed_id]['patient_id'] for bed_id in changed
+                                          if beds[bed_id]['patient_id'] is not None})
+        events = []
+        for bed_id in changed:
+            occupant = occupants.get(beds[bed_id]['patient_id'], {})
+            events.append(('bed', dict(beds[bed_id],
+                                       current_patient_id=occupant.get('patient_id'),
+                                       patient_name=occupant.get('patient_name'),
+                                       patient_risk=occupant.get('patient_risk'))))
+        events.extend(('bed', {'bed_id': bed_id, 'removed': True}) for bed_id in removed)
+        capacity = _capacity(board.counts())
+        if capacity != self._capacity:
+            events.append(('capacity', capacity))
+
+        waitlist_keys = [(e['waitlist_id'], e['priority'])
+                         for e in icu_waitlist_queue.get_waitlist_queue().snapshot()]
+        if waitlist_keys != self._waitlist_keys:
+            self._waitlist = icu_waitlist_queue.get_icu_queue()
+            events.append(('waitlist', self._waitlist))
+
+        with self._condition:
+            self._board_beds = beds
+            for event_type, data in events:
+                if event_type == 'bed':
+                    bed_id = data['bed_id']
+                    if data.get('removed'):
+                        self._beds.pop(bed_id, None)
+                    else:
+                        self._beds[bed_id] = data
+                if publish:
+                    self._append(event_type, data)
+            self._capacity = capacity
+            self._waitlist_keys = waitlist_keys
+            if publish and events:
+                self._condition.notify_all()
+
+    def _append(self, event_type, data):
+        self._sequence += 1
+        self._published += 1
+        self._events.append((f'{self.epoch}-{self._sequence}', event_type, json.dumps(data, default=str)))
+
+    # ---- subscribers ----
+
+    def _snapshot(self):
+        beds = sorted(self._beds.values(), key=lambda bed: (bed['floor_number'], bed['room_number']))
+        data = json.dumps({'beds': beds, 'capacity': self._capacity, 'waitlist': self._waitlist},
+                          default=str)
+        return (f'{self.epoch}-{self._sequence}', 'snapshot', data)
+
+    def _missed(self, last_event_id):
+        """Buffered events after last_event_id, or None if they are not all buffered"""
+        epoch, _, sequence = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        sequence = int(sequence)
+        oldest = self._sequence - len(self._events)
+        if sequence < oldest or sequence > self._sequence:
+            return None
+        return list(islice(self._events, sequence - oldest, None))
+
+    def subscribe(self, last_event_id=None, heartbeat=HEARTBEAT_SECONDS):
+        """
+        Generator of text/event-stream chunks for one client: the missed events
+        (or a snapshot), then every new event, with a comment line as heartbeat
+        """
+        with self._condition:
+            self._subscribers += 1
+        self._wake.set()
+        try:
+            # The watcher may have been idle; catch up before the first answer
+            with self._site():
+                self._refresh()
+            with self._condition:
+                missed = self._missed(last_event_id)
+                if missed is None:
+                    missed = [self._snapshot()]
+                sequence = self._sequence
+            yield 'retry: 3000\n\n'
+            for event in missed:
+                yield format_event(event)
+
+            while not self._stop.is_set():
+                with self._condition:
+                    if self._sequence == sequence:
+                        self._condition.wait(heartbeat)
+                    new = self._missed(f'{self.epoch}-{sequence}')
+                    if new is None:
+                        # Fell behind the buffer
+                        new = [self._snapshot()]
+                    sequence = self._sequence
+                if new:
+                    for event in new:
+                        yield format_event(event)
+                else:
+                    yield ': heartbeat\n\n'
+        finally:
+            with self._condition:
+                self._subscribers -= 1
+
+    def status(self):
+        with self._condition:
+            return {'path': self.path, 'subscribers': self._subscribers,
+                    'published': self._published, 'buffered': len(self._events)}
+
+    def close(self):
+        self._stop.set()
+        self._wake.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._thread.join()
+        self._conn.close()
+
+
+_streams = {}
+_streams_lock = threading.Lock()
+
+
+def get_event_stream():
+    """The change feed of the current site's database, started on first use"""
+    path = database.current_database_path()
+    stream = _streams.get(path)
+    if stream is None:
+        with _streams_lock:
+            stream = _streams.get(path)
+            if stream is None:
+                site = database._site.get() if database.SITES else None
+                stream = _streams[path] = EventStream(path, site)
+    return stream
+
+
+def notify(path):
+    """Wake the stream of a database after a write, if it is running"""
+    stream = _streams.get(path)
+    if stream is not None:
+        stream.notify()
+
+
+def event_stream_status():
+    with _streams_lock:
+        return [stream.status() for stream in _streams.values()]
+
+
+def close_event_streams():
+    with _streams_lock:
+        for stream in _streams.values():
+            stream.close()
+        _streams.clear()
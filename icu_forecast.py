@@ -0,0 +1,236 @@
+"""
+Monte Carlo ICU occupancy forecast
+Simulates many scenarios of the next days at once with NumPy. Every stay,
+current or future, has a start, a probability of happening and a lognormal
+length:
+  - current occupants started now, certainly, with a mean remaining stay of
+    expected_discharge - now, or else predicted_icu_days - days already spent
+  - scheduled surgery patients start at noon on the surgery date with their
+    latest icu_probability and a mean stay of predicted_icu_days
+Stays without a prediction use the average stay of the last HISTORY_DAYS in
+icu_daily_stats. Occupancy is counted now for today and at noon of every
+later day of the horizon, which gives per-day percentile bands and the
+probability of more patients than beds (total_beds - maintenance_beds from
+the icu_capacity counters).
+
+A patient is in a bed at time t with probability
+p(t) = P(admitted) * P(start <= t < start + stay), which only falls as t
+grows past the start. Each scenario draws one uniform u per patient and puts
+them in a bed at every counted time with u < p(t): that is exactly one draw
+of whether they are admitted and how long they stay, and no stay has to be
+sampled or binned. A day costs one comparison per (scenario, patient already
+admitted by then).
+"""
+
+
+import math
+import os
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+import database
+
+FORECAST_SCENARIOS = int(os.environ.get('RECOVAI_FORECAST_SCENARIOS', '10000'))
+HORIZON_DAYS = 14
+MAX_HORIZON_DAYS = 60
+MAX_SCENARIOS = 100000
+
+# Spread of lengths of stay (standard deviation / mean)
+LOS_CV = 0.5
+DEFAULT_LOS_DAYS = 3.0
+HISTORY_DAYS = 90
+# Occupants past their expected discharge still need some time to leave
+MIN_REMAINING_DAYS = 0.25
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Days; about ten seconds
+NOON_TOLERANCE = 1e-4
+
+# Largest stays x scenarios block of uniforms drawn at once
+BLOCK_ELEMENTS = 2_000_000
+
+
+def _merge_inputs(results):
+    parts = list(results.values())
+    return {
+        'capacity': sum(p['capacity'] for p in parts),
+        'today': parts[0]['today'],
+        'day_fraction': parts[0]['day_fraction'],
+        'occupants': [row for p in parts for row in p['occupants']],
+        'scheduled': [row for p in parts for row in p['scheduled']],
+        'history_los_days': sum(p['history_los_days'] for p in parts),
+        'history_discharges': sum(p['history_discharges'] for p in parts)
+    }
+
+
+@database.site_aggregate(_merge_inputs)
+@database.read_only
+def get_forecast_inputs(horizon_days=HORIZON_DAYS):
+    """Capacity, current stays and scheduled admissions, in days relative to now (UTC)"""
+    with database.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COALESCE(SUM(total_beds) - SUM(maintenance_beds), 0) as capacity,
+                   DATE('now') as today,
+                   julianday('now') - julianday(DATE('now')) as day_fraction
+            FROM icu_capacity
+        ''')
+        inputs = dict(cursor.fetchone())
+
+        cursor.execute('''
+            SELECT
+                julianday(b.expected_discharge) - julianday('now') as expected_remaining_days,
+                julianday('now') - julianday(b.admitted_at) as elapsed_days,
+                (SELECT ip.predicted_icu_days FROM icu_predictions ip
+                 WHERE ip.patient_id = b.patient_id
+                 ORDER BY ip.predicted_at DESC, ip.prediction_id DESC LIMIT 1) as predicted_icu_days
+            FROM icu_beds b
+            WHERE b.status = 'occupied'
+        ''')
+        inputs['occupants'] = [tuple(row) for row in cursor.fetchall()]
+
+        # Patients already in a bed are counted as occupants
+        cursor.execute('''
+            SELECT
+                julianday(DATE(p.surgery_date)) + 0.5 - julianday('now') as admit_in_days,
+                ip.icu_probability,
+                ip.predicted_icu_days
+            FROM patients p
+            JOIN icu_predictions ip ON ip.prediction_id = (
+                SELECT prediction_id FROM icu_predictions
+                WHERE patient_id = p.patient_id
+                ORDER BY predicted_at DESC, prediction_id DESC LIMIT 1
+            )
+            WHERE p.status = 'scheduled'
+            AND p.surgery_date >= DATE('now')
+            AND p.surgery_date < DATE('now', '+' || ? || ' days')
+            AND ip.icu_probability > 0
+            AND p.patient_id NOT IN (
+                SELECT patient_id FROM icu_beds WHERE status = 'occupied' AND patient_id IS NOT NULL
+            )
+        ''', (horizon_days,))
+        inputs['scheduled'] = [tuple(row) for row in cursor.fetchall()]
+
+        cursor.execute('''
+            SELECT COALESCE(SUM(total_los), 0), COALESCE(SUM(discharges), 0)
+            FROM icu_daily_stats
+            WHERE stat_date >= DATE('now', '-' || ? || ' days')
+        ''', (HISTORY_DAYS,))
+        inputs['history_los_days'], inputs['history_discharges'] = cursor.fetchone()
+        return inputs
+
+
+_erf = np.frompyfunc(math.erf, 1, 1)
+
+
+def _survival(elapsed, mean_stay, los_cv):
+    """P(a lognormal stay with the given mean lasts longer than elapsed days)"""
+    sigma = np.sqrt(np.log1p(los_cv ** 2))
+    mu = np.log(mean_stay) - sigma ** 2 / 2
+    z = (np.log(np.maximum(elapsed, 1e-9)) - mu[:, None]) / (sigma * np.sqrt(2))
+    return 0.5 - 0.5 * _erf(z).astype(float)
+
+
+def occupancy_probabilities(measure_at, start, probability, mean_stay, los_cv=LOS_CV):
+    """
+    probabilities[i, d] = P(stay i has started and not ended at measure_at[d])
+    measure_at, start: days from now; probability: of the stay happening (0-1)
+    """
+    elapsed = np.asarray(measure_at, dtype=float)[None, :] - np.asarray(start, dtype=float)[:, None]
+    in_bed = np.where(elapsed <= 0, 1.0, _survival(elapsed, np.asarray(mean_stay, dtype=float), los_cv))
+    # Admissions are at noon exactly; the tolerance keeps rounding error from moving them a day
+    in_bed[elapsed < -NOON_TOLERANCE] = 0
+    return np.asarray(probability, dtype=float)[:, None] * in_bed
+
+
+def simulate_occupancy(probabilities, scenarios=FORECAST_SCENARIOS, seed=None):
+    """
+    Occupancy of every scenario at each measurement time, from the
+    occupancy_probabilities of the stays; a scenarios x days integer array
+    """
+    rng = np.random.default_rng(seed)
+    stays, days = probabilities.shape
+    in_bed = probabilities > 0
+    # Stays ordered by the first day they can count, so each day compares a prefix
+    first_day = np.where(in_bed.any(axis=1), in_bed.argmax(axis=1), days)
+    order = np.argsort(first_day, kind='stable')
+    thresholds = probabilities[order].astype(np.float32)
+    started = np.searchsorted(first_day[order], np.arange(days), side='right')
+
+    occupancy = np.empty((scenarios, days), dtype=np.int64)
+    block = max(1, BLOCK_ELEMENTS // max(stays, 1))
+    for first in range(0, scenarios, block):
+        n = min(block, scenarios - first)
+        u = rng.random((stays, n), dtype=np.float32)
+        for d in range(days):
+            k = started[d]
+            occupancy[first:first + n, d] = (u[:k] < thresholds[:k, d, None]).sum(axis=0)
+    return occupancy
+
+
+def forecast_icu_occupancy(horizon_days=HORIZON_DAYS, scenarios=FORECAST_SCENARIOS,
+                           capacity=None, los_cv=LOS_CV, seed=None):
+    """
+    Percentile bands of ICU occupancy for today and the next horizon_days - 1
+    days, and the probability of exceeding capacity on each day and on any day
+    """
+    horizon_days = min(max(int(horizon_days), 1), MAX_HORIZON_DAYS)
+    scenarios = min(max(int(scenarios), 1), MAX_SCENARIOS)
+    start = time.perf_counter()
+
+    inputs = get_forecast_inputs(horizon_days)
+    if capacity is None:
+        capacity = inputs['capacity']
+    default_los = (inputs['history_los_days'] / inputs['history_discharges']
+                   if inputs['history_discharges'] else DEFAULT_LOS_DAYS)
+
+    def mean_stay(values):
+        return np.where(np.isnan(values) | (values <= 0), default_los, values)
+
+    occupants = np.array(inputs['occupants'], dtype=float).reshape(-1, 3)
+    predicted_remaining = mean_stay(occupants[:, 2]) - np.nan_to_num(occupants[:, 1])
+    occupant_remaining = np.maximum(
+        np.where(np.isnan(occupants[:, 0]), predicted_remaining, occupants[:, 0]),
+        MIN_REMAINING_DAYS
+    )
+
+    scheduled = np.array(inputs['scheduled'], dtype=float).reshape(-1, 3)
+    # icu_probability is stored as a percentage
+    admit_probability = np.clip(scheduled[:, 1] / 100, 0, 1)
+
+    # Now, then noon of each following day
+    measure_at = np.concatenate([[0.0], 1.5 - inputs['day_fraction'] + np.arange(horizon_days - 1)])
+    probabilities = occupancy_probabilities(
+        measure_at,
+        np.concatenate([np.zeros(len(occupants)), np.maximum(scheduled[:, 0], 0)]),
+        np.concatenate([np.ones(len(occupants)), admit_probability]),
+        np.concatenate([occupant_remaining, mean_stay(scheduled[:, 2])]),
+        los_cv
+    )
+    occupancy = simulate_occupancy(probabilities, scenarios, seed)
+    expected = probabilities.sum(axis=0)
+
+    bands = np.percentile(occupancy, PERCENTILES, axis=0)
+    over = occupancy > capacity
+    # The UTC date the day_fraction and surgery dates were measured against
+    today = date.fromisoformat(inputs['today'])
+    return {
+        'horizon_days': horizon_days,
+        'scenarios': scenarios,
+        'capacity': capacity,
+        'current_occupants': len(occupants),
+        'scheduled_patients': len(scheduled),
+        'expected_admissions': round(float(admit_probability.sum()), 2),
+        'default_los_days': round(default_los, 2),
+        'days': [{
+            'date': (today + timedelta(days=d)).isoformat(),
+            'expected': round(float(expected[d]), 2),
+            **{f'p{p}': float(bands[i, d]) for i, p in enumerate(PERCENTILES)},
+            'p_over_capacity': round(float(over[:, d].mean()), 4)
+        } for d in range(horizon_days)],
+        'p_over_capacity_any_day': round(float(over.any(axis=1).mean()), 4),
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)
+    }
@@ -0,0 +1,203 @@
+"""
+ICU bed ledger and time-travel queries
+Triggers on icu_beds append every transition (created, updated, removed) to
+the icu_events ledger, with the bed's full state after it. Every
+database.ICU_SNAPSHOT_EVERY_EVENTS events another trigger stores the state of
+all beds as one JSON row in icu_snapshots, whoever made the writes.
+
+The state as of a timestamp is the newest snapshot taken at or before it plus
+the events after that snapshot, up to the timestamp. The replay reads one
+event_id range, bounded by the next snapshot, so it costs at most
+ICU_SNAPSHOT_EVERY_EVENTS rows however long the history is.
+
+Timestamps are UTC, like the ledger's; a naive datetime or ISO string is taken
+as UTC and an aware one is converted. History starts at the first event, or at
+the baseline snapshot of beds that existed before the ledger.
+"""
+
+import json
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import database
+from icu_event_stream import _capacity
+
+MAX_SERIES_POINTS = 2000
+MAX_EVENT_ID = 2 ** 63 - 1
+
+BED_FIELDS = ('bed_id', 'status', 'patient_id', 'floor_number', 'room_number', 'equipment_class')
+
+LEDGER_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def ledger_time(value):
+    """A datetime or ISO string as the ledger's 'YYYY-MM-DD HH:MM:SS.fff' UTC text"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime(LEDGER_TIME_FORMAT)[:-3]
+
+
+def take_snapshot():
+    """Store the current state of every bed; returns the snapshot_id"""
+    with database.get_db_connection() as conn:
+        return conn.execute(database.ICU_SNAPSHOT_INSERT).lastrowid
+
+
+def _history_start(cursor):
+    """When the ledger starts knowing every bed, or None for an empty ledger"""
+    baseline = cursor.execute('''
+        SELECT MIN(taken_at) FROM icu_snapshots WHERE last_event_id = 0
+    ''').fetchone()[0]
+    if baseline is not None:
+        return baseline
+    return cursor.execute('SELECT MIN(occurred_at) FROM icu_events').fetchone()[0]
+
+
+def _base_state(cursor, at):
+    """
+    ({bed_id: bed}, last_event_id, snapshot_id, upper event_id bound) of the
+    newest snapshot at or before at; raises ValueError before the ledger starts
+    """
+    start = _history_start(cursor)
+    if start is None or at < start:
+        raise ValueError(f'ICU history starts at {start} UTC' if start else 'ICU history is empty')
+
+    snapshot = cursor.execute('''
+        SELECT snapshot_id, last_event_id, state FROM icu_snapshots
+        WHERE taken_at <= ?
+        ORDER BY taken_at DESC, snapshot_id DESC
+        LIMIT 1
+    ''', (at,)).fetchone()
+    beds, last_event_id, snapshot_id = {}, 0, None
+    if snapshot is not None:
+        snapshot_id, last_event_id = snapshot['snapshot_id'], snapshot['last_event_id']
+        beds = {row[0]: dict(zip(BED_FIELDS, row)) for row in json.loads(snapshot['state'])}
+
+    # No event past the next snapshot can be at or before at
+    upper = cursor.execute('''
+        SELECT last_event_id FROM icu_snapshots
+        WHERE taken_at > ?
+        ORDER BY taken_at, snapshot_id
+        LIMIT 1
+    ''', (at,)).fetchone()
+    return beds, last_event_id, snapshot_id, upper[0] if upper else None
+
+
+def _events(cursor, after_event_id, upper, until):
+    """Ledger rows after after_event_id (up to upper) that occurred at or before until"""
+    return cursor.execute(f'''
+        SELECT event_id, occurred_at, event_type, {database.ICU_EVENT_COLUMNS}
+        FROM icu_events
+        WHERE event_id > ? AND event_id <= ? AND occurred_at <= ?
+        ORDER BY event_id
+    ''', (after_event_id, upper if upper is not None else MAX_EVENT_ID, until))
+
+
+def _apply(beds, event):
+    if event['event_type'] == 'removed':
+        beds.pop(event['bed_id'], None)
+    else:
+        beds[event['bed_id']] = {field: event[field] for field in BED_FIELDS}
+
+
+def _counts(beds):
+    return Counter(bed['status'] for bed in beds.values())
+
+
+def _merge_states(results):
+    return {
+        'as_of': next(iter(results.values()))['as_of'],
+        'snapshot_id': {site: r['snapshot_id'] for site, r in results.items()},
+        'events_replayed': sum(r['events_replayed'] for r in results.values()),
+        'beds': database._merge_site_lists({site: r['beds'] for site, r in results.items()}),
+        'capacity': database._merge_capacity({site: r['capacity'] for site, r in results.items()})
+    }
+
+
+@database.site_aggregate(_merge_states)
+@database.read_only
+def get_icu_state_at(timestamp):
+    """Every ICU bed and the capacity counts as they were at timestamp"""
+    at = ledger_time(timestamp)
+    with database.get_db_connection() as conn:
+        cursor = conn.cursor()
+        beds, last_event_id, snapshot_id, upper = _base_state(cursor, at)
+        replayed = 0
+        for event in _events(cursor, last_event_id, upper, at):
+            _apply(beds, event)
+            replayed += 1
+
+    return {
+        'as_of': at,
+        'snapshot_id': snapshot_id,
+        'events_replayed': replayed,
+        'beds': sorted(beds.values(), key=lambda bed: (bed['floor_number'], bed['room_number'])),
+        'capacity': _capacity(_counts(beds))
+    }
+
+
+def _merge_series(results):
+    parts = list(results.values())
+    return {
+        'start': parts[0]['start'],
+        'end': parts[0]['end'],
+        'step_minutes': parts[0]['step_minutes'],
+        'points': [
+            dict({key: sum(p['points'][i][key] for p in parts) for key in ('occupied', 'total')},
+                 at=points[0]['at'])
+            for i, points in enumerate(zip(*(p['points'] for p in parts)))
+        ]
+    }
+
+
+@database.site_aggregate(_merge_series)
+@database.read_only
+def get_icu_occupancy_series(start, end, step_minutes=60):
+    """
+    Occupied and total beds at start and every step_minutes until end, from
+    one replay of the ledger; start is moved up to where the history starts
+    """
+    step = timedelta(minutes=step_minutes)
+    if step <= timedelta(0):
+        raise ValueError('step_minutes must be positive')
+    points = []
+    with database.get_db_connection() as conn:
+        cursor = conn.cursor()
+        # A range reaching back before the ledger starts where it does
+        first = max(ledger_time(start), _history_start(cursor) or '')
+        last = ledger_time(end)
+        if last < first:
+            raise ValueError(f'end is before {first}')
+        times = []
+        moment = datetime.strptime(first, LEDGER_TIME_FORMAT)
+        while len(times) < MAX_SERIES_POINTS and ledger_time(moment) <= last:
+            times.append(ledger_time(moment))
+            moment += step
+
+        beds, last_event_id, _, _ = _base_state(cursor, times[0])
+        pending = iter(_events(cursor, last_event_id, None, times[-1]))
+        event = next(pending, None)
+        for at in times:
+            while event is not None and event['occurred_at'] <= at:
+                _apply(beds, event)
+                event = next(pending, None)
+            counts = _counts(beds)
+            points.append({'at': at, 'occupied': counts.get('occupied', 0), 'total': len(beds)})
+
+    return {'start': first, 'end': last, 'step_minutes': step_minutes, 'points': points}
+
+
+def get_ledger_status():
+    """Size of the ledger and where the newest snapshot stands"""
+    with database.get_db_connection(read_only=True) as conn:
+        row = conn.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM icu_events) as events,
+                (SELECT COUNT(*) FROM icu_snapshots) as snapshots,
+                (SELECT MAX(taken_at) FROM icu_snapshots) as last_snapshot_at,
+                (SELECT COALESCE(MAX(event_id), 0) FROM icu_events)
+                    - (SELECT COALESCE(MAX(last_event_id), 0) FROM icu_snapshots) as events_since_snapshot
+        ''').fetchone()
+        return dict(row, history_start=_history_start(conn.cursor()))
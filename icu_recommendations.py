@@ -0,0 +1,177 @@
+"""
+ICU capacity-pressure recommendations
+When utilization passes PRESSURE_UTILIZATION percent, two lists are ranked:
+
+  postpone_elective   elective surgeries of the next WINDOW_DAYS days whose
+                      latest assessment is LOW or MODERATE (none counts as
+                      MODERATE) and whose latest ICU probability is under
+                      POSTPONE_MAX_ICU_PROBABILITY
+  expedite_discharge  occupants who have stayed STEP_DOWN_MIN_DAYS or more,
+                      except CRITICAL ones: candidates for step-down care
+
+Both are single queries that only touch the rows they return: the window is a
+range of idx_patients_status_surgery_date, occupants come from icu_beds, and
+the latest assessment and prediction of each row are index lookups. Stay
+lengths are computed in SQL. The work therefore does not grow with the
+patient history, only with the window and the number of beds.
+
+The scores (0-100, highest first) are computed for all rows at once:
+  postpone  60 * how safe delay is (LOW 1, MODERATE 0.6)
+          + 40 * how far the ICU probability is below the cutoff
+  expedite  50 * stay beyond the predicted ICU days (full at twice the prediction)
+          + 50 * how ready the risk level is for step-down
+"""
+
+import time
+
+import numpy as np
+
+import database
+
+PRESSURE_UTILIZATION = 80
+WINDOW_DAYS = 7
+POSTPONE_MAX_ICU_PROBABILITY = 30
+STEP_DOWN_MIN_DAYS = 3
+DEFAULT_LIMIT = 20
+
+DELAY_SAFETY = {'LOW': 1.0, 'MODERATE': 0.6}
+STEP_DOWN_READINESS = {'LOW': 1.0, 'MODERATE': 0.8, 'HIGH': 0.4}
+
+LATEST_ASSESSMENT = '''
+    SELECT assessment_id FROM risk_assessments
+    WHERE patient_id = {patient} ORDER BY assessed_at DESC, assessment_id DESC LIMIT 1
+'''
+LATEST_PREDICTION = '''
+    SELECT prediction_id FROM icu_predictions
+    WHERE patient_id = {patient} ORDER BY predicted_at DESC, prediction_id DESC LIMIT 1
+'''
+
+
+def _by_score(results):
+    return database._merge_site_lists(results, lambda row: -row['score'])
+
+
+@database.site_aggregate(_by_score)
+@database.read_only
+def get_postpone_candidates(window_days=WINDOW_DAYS, max_icu_probability=POSTPONE_MAX_ICU_PROBABILITY):
+    """Low-risk elective surgeries in the window, with their days until surgery and score"""
+    with database.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT
+                p.patient_id,
+                u.full_name as patient_name,
+                COALESCE(p.surgery_type, 'General Surgery') as surgery_type,
+                p.surgery_date,
+                CAST(julianday(DATE(p.surgery_date)) - julianday(DATE('now')) AS INTEGER) as days_until,
+                COALESCE(ra.overall_risk, 'MODERATE') as risk_level,
+                COALESCE(ip.icu_probability, 0) as icu_probability,
+                ip.predicted_icu_days
+            FROM patients p
+            JOIN users u ON u.user_id = p.user_id
+            LEFT JOIN risk_assessments ra ON ra.assessment_id = (
+                {LATEST_ASSESSMENT.format(patient='p.patient_id')}
+            )
+            LEFT JOIN icu_predictions ip ON ip.prediction_id = (
+                {LATEST_PREDICTION.format(patient='p.patient_id')}
+            )
+            WHERE p.status = 'scheduled'
+            AND p.surgery_date >= DATE('now')
+            AND p.surgery_date < DATE('now', '+' || ? || ' days')
+            AND COALESCE(p.emergency_surgery, 0) = 0
+            AND COALESCE(ra.overall_risk, 'MODERATE') IN ('LOW', 'MODERATE')
+            AND COALESCE(ip.icu_probability, 0) < ?
+        ''', (window_days + 1, max_icu_probability))
+        rows = [dict(row) for row in cursor.fetchall()]
+
+    safety = np.array([DELAY_SAFETY[row['risk_level']] for row in rows], dtype=float)
+    probability = np.array([row['icu_probability'] for row in rows], dtype=float)
+    scores = 60 * safety + 40 * np.clip(1 - probability / max_icu_probability, 0, 1)
+    return _ranked(rows, scores)
+
+
+@database.site_aggregate(_by_score)
+@database.read_only
+def get_step_down_candidates(min_days=STEP_DOWN_MIN_DAYS):
+    """Non-critical ICU occupants with long stays, with their stay length and score"""
+    with database.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT * FROM (
+                SELECT
+                    b.patient_id,
+                    u.full_name as patient_name,
+                    b.bed_id,
+                    b.room_number,
+                    a.allocation_id,
+                    julianday('now') - julianday(COALESCE(a.allocated_at, b.admitted_at)) as stay_days,
+                    ra.overall_risk as risk_level,
+                    ip.predicted_icu_days
+                FROM icu_beds b
+                JOIN patients p ON p.patient_id = b.patient_id
+                JOIN users u ON u.user_id = p.user_id
+                LEFT JOIN bed_allocations a ON a.allocation_id = (
+                    SELECT allocation_id FROM bed_allocations
+                    WHERE bed_id = b.bed_id AND patient_id = b.patient_id AND actual_discharge IS NULL
+                    ORDER BY allocation_id DESC LIMIT 1
+                )
+                LEFT JOIN risk_assessments ra ON ra.assessment_id = (
+                    {LATEST_ASSESSMENT.format(patient='b.patient_id')}
+                )
+                LEFT JOIN icu_predictions ip ON ip.prediction_id = (
+                    {LATEST_PREDICTION.format(patient='b.patient_id')}
+                )
+                WHERE b.status = 'occupied'
+                AND COALESCE(ra.overall_risk, 'MODERATE') != 'CRITICAL'
+            )
+            WHERE stay_days >= ?
+        ''', (min_days,))
+        rows = [dict(row) for row in cursor.fetchall()]
+    return _rank_step_down(rows, min_days)
+
+
+def _rank_step_down(rows, min_days):
+    stay = np.array([row['stay_days'] for row in rows], dtype=float)
+    predicted = np.array([row['predicted_icu_days'] or np.nan for row in rows], dtype=float)
+    # Without a prediction, the minimum stay stands in for it
+    predicted = np.where(np.isnan(predicted) | (predicted <= 0), min_days, predicted)
+    # A level with no readiness (CRITICAL, or one this table does not know) is never ready
+    readiness = np.array([STEP_DOWN_READINESS.get(row['risk_level'] or 'MODERATE', 0.0)
+                          for row in rows], dtype=float)
+    scores = 50 * np.clip(stay / (2 * predicted), 0, 1) + 50 * readiness
+    for row in rows:
+        row['current_stay_days'] = int(row['stay_days'])
+        row['stay_days'] = round(row['stay_days'], 2)
+    return _ranked(rows, scores)
+
+
+def _ranked(rows, scores):
+    for row, score in zip(rows, np.round(scores, 1)):
+        row['score'] = float(score)
+    return [rows[i] for i in np.argsort(-scores, kind='stable')]
+
+
+def get_icu_recommendations(limit=DEFAULT_LIMIT):
+    """Ranked capacity-management recommendations, empty unless ICU utilization is high"""
+    start = time.perf_counter()
+    capacity = database.get_icu_capacity()
+    recommendations = {
+        'postpone_elective': [],
+        'expedite_discharge': [],
+        'transfer_candidates': []
+    }
+    pressure = capacity['utilization_rate'] > PRESSURE_UTILIZATION
+    if pressure:
+        for row in get_postpone_candidates()[:limit]:
+            row['reason'] = 'Low ICU risk, can be safely rescheduled'
+            recommendations['postpone_elective'].append(row)
+        for row in get_step_down_candidates()[:limit]:
+            row['reason'] = 'Extended stay, candidate for step-down care'
+            recommendations['expedite_discharge'].append(row)
+
+    return {
+        'recommendations': recommendations,
+        'capacity': capacity,
+        'pressure': pressure,
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 3)
+    }
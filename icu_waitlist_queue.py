@@ -0,0 +1,454 @@
+"""
+ICU waitlist priority queue
+Holds the waiting rows of icu_waitlist in memory as an indexed binary heap,
+so the queue endpoints no longer rebuild the queue from patients and risk
+assessments on every request.
+
+Priority ages with waiting time: a patient who has waited h hours ranks as
+priority + WAITLIST_AGING_PER_HOUR * h. Since every entry gains the same
+amount per hour, entries are ordered by the fixed key
+priority - WAITLIST_AGING_PER_HOUR * (hours since the epoch at added_at),
+and the heap never needs re-keying as time passes. Ties go to whoever
+joined first.
+
+Changes are written through to icu_waitlist (waiting -> allocated or
+cancelled) in the same way as the bed board: on the queue's own connection,
+with a PRAGMA data_version check before every operation. Rows changed by
+other connections (another worker, an allocation marking the patient's entry
+allocated) are picked up by reloading the waiting rows, but only when the
+icu_waitlist_changes counter moved, which triggers bump on every icu_waitlist
+write; commits to other tables cost one extra read. The table is the recovery
+point after a restart.
+
+  enqueue / dequeue / reprioritize / cancel    O(log n)
+  peek / len / contains                        O(1)
+  ordered snapshot                             O(n log n)
+"""
+
+import os
+import threading
+from datetime import datetime, timezone
+
+import auto_allocator
+import database
+import icu_event_stream
+
+WAITLIST_AGING_PER_HOUR = float(os.environ.get('RECOVAI_WAITLIST_AGING_PER_HOUR', '1.0'))
+
+MIN_PRIORITY = 1
+MAX_PRIORITY = 100
+
+
+class IndexedHeap:
+    """
+    Binary min-heap of (key, item_id) with a position index, so any item can
+    be re-keyed or removed in O(log n)
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._position = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, item_id):
+        return item_id in self._position
+
+    def key(self, item_id):
+        return self._heap[self._position[item_id]][0]
+
+    def peek(self):
+        """(key, item_id) of the smallest item, or None"""
+        return self._heap[0] if self._heap else None
+
+    def push(self, item_id, key):
+        if item_id in self._position:
+            raise KeyError(f'{item_id} is already queued')
+        self._heap.append((key, item_id))
+        self._position[item_id] = len(self._heap) - 1
+        self._sift_up(len(self._heap) - 1)
+
+    def pop(self):
+        """Remove and return the smallest (key, item_id)"""
+        if not self._heap:
+            raise IndexError('pop from an empty heap')
+        return self._remove_at(0)
+
+    def update(self, item_id, key):
+        i = self._position[item_id]
+        old_key = self._heap[i][0]
+        self._heap[i] = (key, item_id)
+        if key < old_key:
+            self._sift_up(i)
+        else:
+            self._sift_down(i)
+
+    def remove(self, item_id):
+        return self._remove_at(self._position[item_id])
+
+    def ordered(self):
+        """Every (key, item_id), smallest first, leaving the heap untouched"""
+        return sorted(self._heap)
+
+    def _remove_at(self, i):
+        entry = self._heap[i]
+        last = self._heap.pop()
+        del self._position[entry[1]]
+        if i < len(self._heap):
+            self._heap[i] = last
+            self._position[last[1]] = i
+            self._sift_up(i)
+            self._sift_down(self._position[last[1]])
+        return entry
+
+    def _swap(self, i, j):
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._position[heap[i][1]] = i
+        self._position[heap[j][1]] = j
+
+    def _sift_up(self, i):
+        while i:
+            parent = (i - 1) // 2
+            if self._heap[i] >= self._heap[parent]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i):
+        n = len(self._heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < n and self._heap[child] < self._heap[smallest]:
+                    smallest = child
+            if smallest == i:
+                return
+            self._swap(i, smallest)
+            i = smallest
+
+
+def _parse_timestamp(value):
+    """icu_waitlist timestamps are UTC text from CURRENT_TIMESTAMP"""
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def _clamp(priority):
+    return min(MAX_PRIORITY, max(MIN_PRIORITY, int(priority)))
+
+
+def _changes(conn):
+    return conn.execute('SELECT changes FROM icu_waitlist_changes').fetchone()[0]
+
+
+def _insert_entry(conn, patient_id, prediction_id, priority, added_at):
+    return conn.execute(database.ICU_WAITLIST_INSERT, (
+        patient_id, prediction_id, priority, added_at.strftime('%Y-%m-%d %H:%M:%S')
+    )).fetchone()[0]
+
+
+def _update_entry(conn, waitlist_id, prediction_id, priority):
+    conn.execute('''
+        UPDATE icu_waitlist SET prediction_id = ?, priority = ?
+        WHERE waitlist_id = ? AND status = 'waiting'
+    ''', (prediction_id, priority, waitlist_id))
+
+
+def _update_priority(conn, waitlist_id, priority):
+    conn.execute('''
+        UPDATE icu_waitlist SET priority = ? WHERE waitlist_id = ? AND status = 'waiting'
+    ''', (priority, waitlist_id))
+
+
+def _close_entry(conn, waitlist_id, status):
+    conn.execute('''
+        UPDATE icu_waitlist
+        SET status = ?, allocated_at = CASE WHEN ? = 'allocated' THEN CURRENT_TIMESTAMP END
+        WHERE waitlist_id = ? AND status = 'waiting'
+    ''', (status, status, waitlist_id))
+
+
+class WaitlistQueue:
+    """In-memory priority queue over one database's waiting icu_waitlist rows"""
+
+    def __init__(self, path, aging_per_hour=None):
+        self.path = path
+        self.aging_per_hour = WAITLIST_AGING_PER_HOUR if aging_per_hour is None else aging_per_hour
+        self._lock = threading.RLock()
+        self._conn = database._connect(path, cross_thread=True)
+        self._version = None
+        self._changes = None
+        self._reloads = 0
+        self._heap = IndexedHeap()
+        self._entries = {}
+        self._by_patient = {}
+        self.load()
+
+    # ---- ordering ----
+
+    def _sort_key(self, entry):
+        # Min-heap: the highest aged priority comes out first, then the oldest entry
+        added_hours = entry['added_at'].timestamp() / 3600
+        return (-(entry['priority'] - self.aging_per_hour * added_hours), entry['waitlist_id'])
+
+    def effective_priority(self, entry, now=None):
+        waited = ((now or _now()) - entry['added_at']).total_seconds() / 3600
+        return entry['priority'] + self.aging_per_hour * max(waited, 0)
+
+    # ---- recovery ----
+
+    def load(self):
+        """Rebuild the queue from the waiting rows of icu_waitlist"""
+        with self._lock:
+            version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+            changes = _changes(self._conn)
+            rows = self._conn.execute('''
+                SELECT waitlist_id, patient_id, prediction_id, priority, added_at
+                FROM icu_waitlist
+                WHERE status = 'waiting'
+                ORDER BY waitlist_id
+            ''').fetchall()
+            self._heap = IndexedHeap()
+            self._entries = {}
+            self._by_patient = {}
+            for row in rows:
+                self._add(dict(row, added_at=_parse_timestamp(row['added_at'])))
+            self._version = version
+            self._changes = changes
+            self._reloads += 1
+
+    def _sync(self):
+        version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if version == self._version:
+            return
+        self._version = version
+        if _changes(self._conn) != self._changes:
+            self.load()
+
+    def _add(self, entry):
+        self._entries[entry['waitlist_id']] = entry
+        self._by_patient[entry['patient_id']] = entry['waitlist_id']
+        self._heap.push(entry['waitlist_id'], self._sort_key(entry))
+
+    def _discard(self, waitlist_id):
+        entry = self._entries.pop(waitlist_id)
+        del self._by_patient[entry['patient_id']]
+        self._heap.remove(waitlist_id)
+        return entry
+
+    def _write(self, fn, *args):
+        """
+        Run fn(conn, *args) in a BEGIN IMMEDIATE transaction on the queue's
+        connection; returns (result, applied). Inside a unit of work it joins
+        that transaction instead, applied is False and the heap is left alone:
+        it catches up through data_version once the unit of work commits.
+        """
+        shared = getattr(database._local, 'conn', None)
+        if shared is not None:
+            return fn(shared, *args), False
+
+        def counted():
+            before = _changes(self._conn)
+            return fn(self._conn, *args), before, _changes(self._conn)
+
+        result, before, after = database.run_immediate(self._conn, counted)
+        icu_event_stream.notify(self.path)
+        auto_allocator.notify(self.path)
+        if before != self._changes:
+            # Another connection wrote to icu_waitlist since the last sync
+            self.load()
+            return result, False
+        self._changes = after
+        return result, True
+
+    # ---- operations ----
+
+    def enqueue(self, patient_id, prediction_id, priority):
+        """
+        Add a patient; returns the waitlist_id. A patient already waiting keeps
+        their place in time and takes the new prediction and priority.
+        """
+        priority = _clamp(priority)
+        with self._lock:
+            self._sync()
+            waitlist_id = self._by_patient.get(patient_id)
+            if waitlist_id is not None:
+                _, applied = self._write(_update_entry, waitlist_id, prediction_id, priority)
+                if applied:
+                    entry = self._entries[waitlist_id]
+                    entry['prediction_id'] = prediction_id
+                    entry['priority'] = priority
+                    self._heap.update(waitlist_id, self._sort_key(entry))
+                return waitlist_id
+
+            added_at = _now()
+            waitlist_id, applied = self._write(_insert_entry, patient_id, prediction_id, priority, added_at)
+            if applied:
+                self._add({'waitlist_id': waitlist_id, 'patient_id': patient_id,
+                           'prediction_id': prediction_id, 'priority': priority, 'added_at': added_at})
+            return waitlist_id
+
+    def peek(self):
+        """The entry that would be dequeued next, or None"""
+        with self._lock:
+            self._sync()
+            top = self._heap.peek()
+            return self._public(self._entries[top[1]]) if top else None
+
+    def dequeue(self):
+        """Remove the highest-priority entry and mark it allocated; returns it, or None"""
+        with self._lock:
+            self._sync()
+            top = self._heap.peek()
+            if top is None:
+                return None
+            entry = self._entries[top[1]]
+            _, applied = self._write(_close_entry, entry['waitlist_id'], 'allocated')
+            if applied:
+                self._discard(entry['waitlist_id'])
+            return self._public(entry)
+
+    def reprioritize(self, waitlist_id, priority):
+        """Change the priority of a waiting entry; False if it is not waiting"""
+        priority = _clamp(priority)
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(waitlist_id)
+            if entry is None:
+                return False
+            _, applied = self._write(_update_priority, waitlist_id, priority)
+            if applied:
+                entry['priority'] = priority
+                self._heap.update(waitlist_id, self._sort_key(entry))
+            return True
+
+    def cancel(self, waitlist_id):
+        """Take an entry off the queue; False if it is not waiting"""
+        with self._lock:
+            self._sync()
+            if waitlist_id not in self._entries:
+                return False
+            _, applied = self._write(_close_entry, waitlist_id, 'cancelled')
+            if applied:
+                self._discard(waitlist_id)
+            return True
+
+    # ---- reads ----
+
+    def __len__(self):
+        with self._lock:
+            self._sync()
+            return len(self._heap)
+
+    def waiting_patient(self, patient_id):
+        with self._lock:
+            self._sync()
+            waitlist_id = self._by_patient.get(patient_id)
+            return self._public(self._entries[waitlist_id]) if waitlist_id is not None else None
+
+    def snapshot(self, limit=None):
+        """Waiting entries in queue order with their aged priority and wait time"""
+        with self._lock:
+            self._sync()
+            ordered = self._heap.ordered()[:limit]
+            entries = [self._entries[waitlist_id] for _, waitlist_id in ordered]
+            return [self._public(entry) for entry in entries]
+
+    def _public(self, entry):
+        now = _now()
+        return {
+            'waitlist_id': entry['waitlist_id'],
+            'patient_id': entry['patient_id'],
+            'prediction_id': entry['prediction_id'],
+            'priority': entry['priority'],
+            'priority_score': round(self.effective_priority(entry, now), 1),
+            'added_at': entry['added_at'].strftime('%Y-%m-%d %H:%M:%S'),
+            'wait_hours': round((now - entry['added_at']).total_seconds() / 3600, 1)
+        }
+
+    def status(self):
+        with self._lock:
+            return {'path': self.path, 'waiting': len(self._heap), 'reloads': self._reloads,
+                    'aging_per_hour': self.aging_per_hour}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_waitlist_queue():
+    """The waitlist queue of the current site's database, loaded on first use"""
+    path = database.current_database_path()
+    waitlist = _queues.get(path)
+    if waitlist is None:
+        with _queues_lock:
+            waitlist = _queues.get(path)
+            if waitlist is None:
+                waitlist = _queues[path] = WaitlistQueue(path)
+    return waitlist
+
+
+def load_waitlist_queues():
+    """Recover (or rebuild) every site's queue from icu_waitlist at startup"""
+    if not database.SITES:
+        get_waitlist_queue().load()
+        return
+    for site in database.SITES:
+        with database.use_site(site):
+            get_waitlist_queue().load()
+
+
+def waitlist_queue_status():
+    """Size and reload count of every loaded queue"""
+    with _queues_lock:
+        return [waitlist.status() for waitlist in _queues.values()]
+
+
+def close_waitlist_queues():
+    with _queues_lock:
+        for waitlist in _queues.values():
+            waitlist.close()
+        _queues.clear()
+
+
+def add_to_icu_waitlist(patient_id, prediction_id, priority):
+    """database.add_to_icu_waitlist through the queue; one waiting entry per patient"""
+    return get_waitlist_queue().enqueue(patient_id, prediction_id, priority)
+
+
+@database.site_aggregate(lambda results: database._merge_site_lists(
+    results, lambda p: -p['priority_score']
+))
+def get_icu_queue(limit=None):
+    """The waiting patients in queue order, with name, risk level and ICU probability"""
+    entries = get_waitlist_queue().snapshot(limit)
+    if not entries:
+        return []
+    placeholders = ', '.join('?' * len(entries))
+    with database.get_db_connection(read_only=True) as conn:
+        patients = {row['patient_id']: dict(row) for row in conn.execute(f'''
+            SELECT p.patient_id, u.full_name as patient_name, p.surgery_type, p.surgery_date
+            FROM patients p
+            LEFT JOIN users u ON p.user_id = u.user_id
+            WHERE p.patient_id IN ({placeholders})
+        ''', [e['patient_id'] for e in entries])}
+        predictions = {row['prediction_id']: dict(row) for row in conn.execute(f'''
+            SELECT prediction_id, risk_level, icu_probability
+            FROM icu_predictions
+            WHERE prediction_id IN ({placeholders})
+        ''', [e['prediction_id'] for e in entries])}
+    for entry in entries:
+        entry.update(patients.get(entry['patient_id'], {}))
+        prediction = predictions.get(entry['prediction_id'], {})
+        entry['risk_level'] = prediction.get('risk_level')
+        entry['icu_probability'] = prediction.get('icu_probability')
+    return entries
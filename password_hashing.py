@@ -0,0 +1,76 @@
+"""
+Password hashing on a dedicated thread pool
+Hashing and verifying passwords is deliberately slow CPU work. hashlib's
+scrypt and pbkdf2_hmac release the GIL while they run, so on worker threads
+they use the other cores without stalling the request threads. A thread pool
+also keeps the app out of child processes, which under the spawn start method
+(Windows, macOS) would re-import app.py with all its startup work. The pool is
+created on the first hash.
+
+The number of hashes in flight is bounded: a caller waits up to
+HASH_WAIT_SECONDS for a slot and otherwise gets HashingOverloaded, which the
+API turns into 503 so clients back off instead of piling up.
+
+RECOVAI_HASH_POOL=0 hashes inline (the previous behaviour).
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+HASH_POOL_ENABLED = os.environ.get('RECOVAI_HASH_POOL', '1') == '1'
+HASH_WORKERS = int(os.environ.get('RECOVAI_HASH_WORKERS', str(os.cpu_count() or 1)))
+# Hashes allowed to queue behind the busy workers before callers are turned away
+HASH_MAX_PENDING = int(os.environ.get('RECOVAI_HASH_MAX_PENDING', '64'))
+HASH_WAIT_SECONDS = float(os.environ.get('RECOVAI_HASH_WAIT_SECONDS', '2'))
+
+
+class HashingOverloaded(RuntimeError):
+    """Raised when too many password hashes are already queued"""
+
+
+_executor = None
+_slots = threading.BoundedSemaphore(HASH_WORKERS + HASH_MAX_PENDING)
+_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS,
+                                               thread_name_prefix='password-hash')
+    return _executor
+
+
+def shutdown():
+    """Stop the worker threads"""
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def _run(fn, *args):
+    if not HASH_POOL_ENABLED:
+        return fn(*args)
+    if not _slots.acquire(timeout=HASH_WAIT_SECONDS):
+        raise HashingOverloaded('Password hashing queue is full')
+    try:
+        return _pool().submit(fn, *args).result()
+    finally:
+        _slots.release()
+
+
+def hash_password(password):
+    """werkzeug generate_password_hash on a worker thread"""
+    return _run(generate_password_hash, password)
+
+
+def check_password(password_hash, password):
+    """werkzeug check_password_hash on a worker thread"""
+    return _run(check_password_hash, password_hash, password)
@@ -0,0 +1,256 @@
+"""
+Opt-in SQL instrumentation for the database layer
+Times every statement, counts rows returned (and the parameter sets of
+executemany), keeps per-statement latency histograms keyed by normalized
+SQL and logs slow queries with their plans.
+
+Enable with RECOVAI_QUERY_STATS=1 (threshold via RECOVAI_SLOW_QUERY_MS) or by
+calling enable() before the first connection is opened.
+"""
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is open-ended
+LATENCY_BUCKETS_MS = [0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000]
+
+SLOW_QUERY_LOG_PATH = os.path.join(os.path.dirname(__file__), 'slow_queries.log')
+
+_enabled = os.environ.get('RECOVAI_QUERY_STATS', '0') == '1'
+_slow_query_ms = float(os.environ.get('RECOVAI_SLOW_QUERY_MS', '100'))
+
+_lock = threading.Lock()
+_statements = {}
+_slow_queries = deque(maxlen=100)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+# Statements that EXPLAIN QUERY PLAN can describe
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')
+
+
+def enable(slow_query_ms=None):
+    """Turn instrumentation on for connections opened from now on"""
+    global _enabled, _slow_query_ms
+    _enabled = True
+    if slow_query_ms is not None:
+        _slow_query_ms = float(slow_query_ms)
+
+
+def disable():
+    """Turn instrumentation off for connections opened from now on"""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def connection_factory():
+    """Connection class for sqlite3.connect(factory=...)"""
+    return InstrumentedConnection if _enabled else sqlite3.Connection
+
+
+def normalize_sql(sql):
+    """Collapse whitespace and literals so equivalent statements share one key"""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    return _PLACEHOLDER_LIST.sub('(?, ...)', sql)
+
+
+def _entry(key):
+    entry = _statements.get(key)
+    if entry is None:
+        entry = _statements[key] = {
+            'sql': key,
+            'calls': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'rows': 0,
+            'histogram': [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        }
+    return entry
+
+
+def _record_execution(key, elapsed_ms):
+    bucket = len(LATENCY_BUCKETS_MS)
+    for i, bound in enumerate(LATENCY_BUCKETS_MS):
+        if elapsed_ms <= bound:
+            bucket = i
+            break
+    with _lock:
+        entry = _entry(key)
+        entry['calls'] += 1
+        entry['total_ms'] += elapsed_ms
+        entry['max_ms'] = max(entry['max_ms'], elapsed_ms)
+        entry['histogram'][bucket] += 1
+
+
+def _record_rows(key, count):
+    if key is None or not count:
+        return
+    with _lock:
+        _entry(key)['rows'] += count
+
+
+def _log_slow_query(conn, sql, params, elapsed_ms):
+    """Capture the plan of a slow statement and append it to the slow-query log"""
+    plan = []
+    if sql.lstrip().upper().startswith(_EXPLAINABLE):
+        try:
+            # Plain cursor so the EXPLAIN itself is not instrumented
+            cursor = sqlite3.Cursor(conn)
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            plan = [f'unavailable: {e}']
+
+    record = {
+        'logged_at': datetime.now().isoformat(),
+        'elapsed_ms': round(elapsed_ms, 3),
+        'sql': normalize_sql(sql),
+        'plan': plan
+    }
+    with _lock:
+        _slow_queries.append(record)
+    try:
+        with open(SLOW_QUERY_LOG_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        print(f"⚠️  Could not write slow query log: {e}")
+
+
+class _CountedParams:
+    """Passes executemany parameter sets through one at a time, counting them and keeping the first"""
+
+    __slots__ = ('_params', 'first', 'count')
+
+    def __init__(self, seq_of_params):
+        self._params = iter(seq_of_params)
+        self.first = ()
+        self.count = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        params = next(self._params)
+        if not self.count:
+            self.first = params
+        self.count += 1
+        return params
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that records latency per statement and rows fetched"""
+
+    _stats_key = None
+
+    def _timed(self, method, sql, params, explain_params):
+        """explain_params() gives the parameters to EXPLAIN a slow statement with"""
+        self._stats_key = normalize_sql(sql)
+        start = time.perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            _record_execution(self._stats_key, elapsed_ms)
+            if elapsed_ms >= _slow_query_ms:
+                _log_slow_query(self.connection, sql, explain_params(), elapsed_ms)
+
+    def execute(self, sql, params=()):
+        return self._timed(super().execute, sql, params, lambda: params)
+
+    def executemany(self, sql, seq_of_params):
+        # Streamed to SQLite as it is consumed, so a generator is never held in memory
+        counted = _CountedParams(seq_of_params)
+        try:
+            return self._timed(super().executemany, sql, counted, lambda: counted.first)
+        finally:
+            _record_rows(self._stats_key, counted.count)
+
+    def fetchone(self):
+        row = super().fetchone()
+        _record_rows(self._stats_key, 1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        _record_rows(self._stats_key, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _record_rows(self._stats_key, len(rows))
+        return rows
+
+    def __next__(self):
+        row = super().__next__()
+        _record_rows(self._stats_key, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose cursors (including execute shortcuts) are instrumented"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+
+def _percentile_ms(histogram, calls, fraction):
+    """Upper bucket bound containing the given fraction of calls"""
+    target = calls * fraction
+    seen = 0
+    for i, count in enumerate(histogram):
+        seen += count
+        if seen >= target and count:
+            return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else None
+    return None
+
+
+def get_query_stats(limit=50):
+    """Per-statement statistics sorted by total time, plus recent slow queries"""
+    with _lock:
+        statements = [dict(e, histogram=list(e['histogram'])) for e in _statements.values()]
+        slow = list(_slow_queries)
+
+    for entry in statements:
+        calls = entry['calls']
+        entry['avg_ms'] = round(entry['total_ms'] / calls, 3) if calls else 0
+        entry['p50_ms'] = _percentile_ms(entry['histogram'], calls, 0.5)
+        entry['p95_ms'] = _percentile_ms(entry['histogram'], calls, 0.95)
+        entry['total_ms'] = round(entry['total_ms'], 3)
+        entry['max_ms'] = round(entry['max_ms'], 3)
+    statements.sort(key=lambda e: e['total_ms'], reverse=True)
+
+    return {
+        'enabled': _enabled,
+        'slow_query_ms': _slow_query_ms,
+        'bucket_bounds_ms': LATENCY_BUCKETS_MS,
+        'statements': statements[:limit],
+        'slow_queries': slow[::-1]
+    }
+
+
+def reset():
+    """Clear collected statistics"""
+    with _lock:
+        _statements.clear()
+        _slow_queries.clear()
@@ -0,0 +1,271 @@
+"""
+Columnar research export
+Streams the clinical tables out of the database in fixed-size chunks and writes
+them as typed Parquet (or Arrow IPC) files, so analysts no longer need to copy
+surgical_risk.db. Memory stays bounded by the chunk size whatever the table size.
+
+Exports are incremental: the highest primary key written per table is kept in
+a watermark file and the next run only exports newer rows, as a new part file.
+Rows updated after they were exported (e.g. a discharge on bed_allocations) are
+not re-exported; use --full for a fresh snapshot.
+
+Run: python research_export.py exports/ [--format arrow] [--full] [--tables patients,...]
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import date, datetime
+
+sys.path.append(os.path.dirname(__file__))
+
+import database
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+    pa = None
+    pq = None
+
+CHUNK_SIZE = 10000
+
+WATERMARK_FILE = '_watermarks.json'
+
+# Column types per exported table; the first column is the primary key
+EXPORT_SCHEMAS = {
+    'patients': [
+        ('patient_id', 'int'), ('user_id', 'int'), ('assigned_doctor_id', 'int'),
+        ('surgery_type', 'text'), ('surgery_date', 'date'), ('status', 'text'),
+        ('age', 'int'), ('gender', 'flag'), ('bmi', 'float'), ('asa_class', 'flag'),
+        ('emergency_surgery', 'flag'), ('hemoglobin', 'float'), ('platelets', 'float'),
+        ('creatinine', 'float'), ('albumin', 'float'), ('blood_loss', 'float'),
+        ('diabetes', 'flag'), ('hypertension', 'flag'), ('heart_disease', 'flag'),
+        ('copd', 'flag'), ('kidney_disease', 'flag'), ('liver_disease', 'flag'),
+        ('stroke_history', 'flag'), ('cancer_history', 'flag'), ('immunosuppression', 'flag'),
+        ('smoking_status', 'flag'), ('alcohol_use', 'flag'), ('anticoagulation', 'flag'),
+        ('steroid_use', 'flag'), ('previous_surgeries', 'int'), ('created_at', 'timestamp')
+    ],
+    'risk_assessments': [
+        ('assessment_id', 'int'), ('patient_id', 'int'), ('assessed_at', 'timestamp'),
+        ('overall_risk', 'text'), ('mortality_risk', 'float'), ('aki_risk', 'float'),
+        ('cardiovascular_risk', 'float'), ('transfusion_risk', 'float'),
+        ('recommendations', 'text'), ('contributing_factors', 'text')
+    ],
+    'icu_predictions': [
+        ('prediction_id', 'int'), ('patient_id', 'int'), ('assessment_id', 'int'),
+        ('icu_needed', 'flag'), ('icu_probability', 'float'), ('risk_level', 'text'),
+        ('predicted_icu_days', 'float'), ('ventilator_needed', 'flag'),
+        ('dialysis_needed', 'flag'), ('priority_score', 'int'), ('predicted_at', 'timestamp')
+    ],
+    'bed_allocations': [
+        ('allocation_id', 'int'), ('patient_id', 'int'), ('bed_id', 'int'),
+        ('allocated_by', 'text'), ('allocation_type', 'text'), ('allocated_at', 'timestamp'),
+        ('actual_discharge', 'timestamp'), ('duration_days', 'float'),
+        ('discharge_reason', 'text'), ('total_cost', 'float'), ('readmitted', 'flag'),
+        ('notes', 'text')
+    ],
+    'symptom_logs': [
+        ('log_id', 'int'), ('patient_id', 'int'), ('logged_at', 'timestamp'),
+        ('pain_level', 'flag'), ('temperature', 'float'), ('wound_condition', 'text'),
+        ('sleep_quality', 'flag'), ('hours_slept', 'float'), ('swelling', 'flag'),
+        ('redness', 'flag'), ('discharge', 'flag'), ('nausea', 'flag'), ('dizziness', 'flag'),
+        ('shortness_of_breath', 'flag'), ('notes', 'text'), ('red_flag_alert', 'flag')
+    ]
+}
+
+
+def _arrow_type(name):
+    return {
+        'int': pa.int64(),
+        'flag': pa.int8(),
+        'float': pa.float64(),
+        'text': pa.string(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('us')
+    }[name]
+
+
+def arrow_schema(table):
+    """Typed Arrow schema for an exported table"""
+    return pa.schema([(column, _arrow_type(kind)) for column, kind in EXPORT_SCHEMAS[table]])
+
+
+def _parse_timestamp(value):
+    """SQLite stores timestamps as text in both CURRENT_TIMESTAMP and isoformat styles"""
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_date(value):
+    if value is None or isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(value[:10])
+    except (TypeError, ValueError):
+        return None
+
+
+_CONVERTERS = {'timestamp': _parse_timestamp, 'date': _parse_date}
+
+
+def _record_batch(table, schema, rows):
+    """Turn a chunk of tuple rows into a typed RecordBatch, column by column"""
+    columns = list(zip(*rows))
+    arrays = []
+    for (_, kind), field, values in zip(EXPORT_SCHEMAS[table], schema, columns):
+        convert = _CONVERTERS.get(kind)
+        if convert is not None:
+            values = [convert(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _load_watermarks(out_dir):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_watermarks(out_dir, watermarks):
+    path = os.path.join(out_dir, WATERMARK_FILE)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class _ArrowFileWriter:
+    """Arrow IPC file writer with the same write_batch/close interface as ParquetWriter"""
+
+    def __init__(self, path, schema):
+        self._sink = pa.OSFile(path, 'wb')
+        self._writer = pa.ipc.new_file(self._sink, schema)
+
+    def write_batch(self, batch):
+        self._writer.write_batch(batch)
+
+    def close(self):
+        self._writer.close()
+        self._sink.close()
+
+
+def export_table(table, out_dir, since_id=0, file_format='parquet', chunk_size=CHUNK_SIZE):
+    """
+    Stream rows of one table with a primary key above since_id into a new part file
+    Returns {'table', 'rows', 'first_id', 'last_id', 'path'}; path is None when
+    there were no new rows.
+    """
+    if not PYARROW_AVAILABLE:
+        raise RuntimeError('pyarrow is required for research exports (pip install pyarrow)')
+    if file_format not in ('parquet', 'arrow'):
+        raise ValueError(f'Unknown export format: {file_format}')
+
+    schema = arrow_schema(table)
+    pk = EXPORT_SCHEMAS[table][0][0]
+    table_dir = os.path.join(out_dir, table)
+    os.makedirs(table_dir, exist_ok=True)
+    tmp_path = os.path.join(table_dir, f'.part-{since_id + 1}.tmp')
+
+    writer = None
+    rows_written = 0
+    first_id = last_id = None
+    try:
+        with database.get_db_connection(read_only=True) as conn:
+            source = table
+            if table == 'symptom_logs' and database._attach_symptom_archive(conn):
+                source = database.SYMPTOM_LOGS_ALL
+            elif table == 'risk_assessments':
+                source = database.RISK_ASSESSMENTS_RESOLVED
+
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {', '.join(name for name in schema.names)}
+                FROM {source}
+                WHERE {pk} > ?
+                ORDER BY {pk}
+            ''', (since_id,))
+
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                if writer is None:
+                    first_id = rows[0][0]
+                    if file_format == 'parquet':
+                        writer = pq.ParquetWriter(tmp_path, schema, compression='zstd')
+                    else:
+                        writer = _ArrowFileWriter(tmp_path, schema)
+                writer.write_batch(_record_batch(table, schema, rows))
+                rows_written += len(rows)
+                last_id = rows[-1][0]
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        return {'table': table, 'rows': 0, 'first_id': None, 'last_id': since_id, 'path': None}
+
+    path = os.path.join(table_dir, f'part-{first_id:010d}-{last_id:010d}.{file_format}')
+    os.replace(tmp_path, path)
+    return {'table': table, 'rows': rows_written, 'first_id': first_id, 'last_id': last_id, 'path': path}
+
+
+def export_research_dataset(out_dir, tables=None, file_format='parquet', full=False,
+                            chunk_size=CHUNK_SIZE):
+    """
+    Export each table's rows added since its watermark and advance the watermarks
+    With full=True the watermarks are ignored and every row is exported again.
+    """
+    tables = tables or list(EXPORT_SCHEMAS)
+    unknown = set(tables) - set(EXPORT_SCHEMAS)
+    if unknown:
+        raise ValueError(f'Unknown export tables: {", ".join(sorted(unknown))}')
+
+    os.makedirs(out_dir, exist_ok=True)
+    watermarks = {} if full else _load_watermarks(out_dir)
+
+    results = []
+    for table in tables:
+        result = export_table(table, out_dir, watermarks.get(table, 0), file_format, chunk_size)
+        watermarks[table] = result['last_id']
+        # Save after every table so a failure later on does not re-export this one
+        _save_watermarks(out_dir, watermarks)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export research tables as Parquet/Arrow files')
+    parser.add_argument('out_dir')
+    parser.add_argument('--format', choices=['parquet', 'arrow'], default='parquet')
+    parser.add_argument('--tables', help='comma-separated subset of: ' + ', '.join(EXPORT_SCHEMAS))
+    parser.add_argument('--full', action='store_true', help='ignore watermarks and export everything')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--database', help='database file (defaults to surgical_risk.db)')
+    args = parser.parse_args()
+
+    if args.database:
+        database.DATABASE_PATH = args.database
+
+    tables = args.tables.split(',') if args.tables else None
+    for result in export_research_dataset(args.out_dir, tables, args.format, args.full,
+                                          args.chunk_size):
+        if result['path']:
+            print(f"✅ {result['table']}: {result['rows']} rows "
+                  f"(ids {result['first_id']}-{result['last_id']}) -> {result['path']}")
+        else:
+            print(f"   {result['table']}: no new rows since id {result['last_id']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1008 @@
+"""
+Tests for the database layer
+Run: python -m pytest test_database.py
+"""
+
+import os
+import sqlite3
+import time
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Point the database module at a fresh, empty database file"""
+    monkeypatch.setattr(database, 'DATABASE_PATH', str(tmp_path / 'test.db'))
+    database.init_database()
+    yield database
+    database.close_read_pools()
+
+
+def _make_patient(db, email='patient@example.com'):
+    """Create a patient user and record, returning the patient_id"""
+    user_id = db.create_user(email, 'secret', 'patient', 'Test Patient')
+    return db.create_patient(user_id, None, {
+        'surgery_type': 'Appendectomy', 'surgery_date': '2025-11-15',
+        'age': 50, 'gender': 1, 'bmi': 25.0, 'asa_class': 2, 'emergency_surgery': 0,
+        'hemoglobin': 13.5, 'platelets': 250, 'creatinine': 0.9, 'albumin': 4.0,
+        'blood_loss': 200
+    })
+
+
+def test_bulk_writes_return_ids_in_order(db):
+    patient_id = _make_patient(db)
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+
+    first = db.save_risk_assessment(patient_id, 'LOW', risks, '{}', '{}')
+    assessment_ids = db.save_risk_assessment_bulk(
+        {'patient_id': patient_id, 'overall_risk': level, 'risks': risks,
+         'recommendations': '{}', 'contributing_factors': '{}'}
+        for level in ['LOW', 'HIGH', 'CRITICAL']
+    )
+    assert assessment_ids == [first + 1, first + 2, first + 3]
+
+    prediction_ids = db.save_icu_prediction_bulk(
+        {'patient_id': patient_id, 'assessment_id': aid,
+         'prediction_data': {'icu_needed': 1, 'priority_score': 60 + i}}
+        for i, aid in enumerate(assessment_ids)
+    )
+    patient_ids = [patient_id] + [_make_patient(db, f'w{i}@example.com') for i in range(2)]
+    waitlist_ids = db.add_to_icu_waitlist_bulk(
+        {'patient_id': pid, 'prediction_id': prediction_id, 'priority': 70}
+        for pid, prediction_id in zip(patient_ids, prediction_ids)
+    )
+
+    with db.get_db_connection() as conn:
+        rows = conn.execute(
+            'SELECT assessment_id, overall_risk FROM risk_assessments WHERE assessment_id > ?',
+            (first,)
+        ).fetchall()
+        assert [(r['assessment_id'], r['overall_risk']) for r in rows] == \
+            list(zip(assessment_ids, ['LOW', 'HIGH', 'CRITICAL']))
+        rows = conn.execute('SELECT waitlist_id, prediction_id FROM icu_waitlist').fetchall()
+        assert [(r['waitlist_id'], r['prediction_id']) for r in rows] == \
+            list(zip(waitlist_ids, prediction_ids))
+
+    # A patient already waiting keeps one entry, with the newest prediction
+    assert db.add_to_icu_waitlist(patient_id, prediction_ids[2], 90) == waitlist_ids[0]
+    assert db.add_to_icu_waitlist_bulk([{'patient_id': patient_ids[1], 'prediction_id': None, 'priority': 5}]) == \
+        [waitlist_ids[1]]
+    with db.get_db_connection() as conn:
+        rows = conn.execute('SELECT prediction_id, priority FROM icu_waitlist ORDER BY waitlist_id').fetchall()
+        assert [tuple(r) for r in rows] == [(prediction_ids[2], 90), (None, 5), (prediction_ids[2], 70)]
+
+    assert db.add_to_icu_waitlist_bulk([]) == []
+
+
+def test_unit_of_work_shares_one_connection_and_rolls_back(db):
+    patient_id = _make_patient(db)
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+
+    with db.unit_of_work() as conn:
+        assessment_id = db.save_risk_assessment(patient_id, 'HIGH', risks, '{}', '{}')
+        with db.get_db_connection() as inner:
+            assert inner is conn
+        db.save_icu_prediction(patient_id, assessment_id, {'icu_needed': 1})
+    assert db.get_icu_prediction(patient_id)['assessment_id'] == assessment_id
+
+    with pytest.raises(RuntimeError):
+        with db.unit_of_work():
+            db.save_risk_assessment(patient_id, 'CRITICAL', risks, '{}', '{}')
+            raise RuntimeError('model failure')
+    assert db.get_latest_risk_assessment(patient_id)['assessment_id'] == assessment_id
+
+
+def test_query_instrumentation_records_latency_rows_and_slow_plans(db, tmp_path, monkeypatch):
+    import query_stats
+
+    monkeypatch.setattr(query_stats, 'SLOW_QUERY_LOG_PATH', str(tmp_path / 'slow.log'))
+    query_stats.reset()
+    query_stats.enable(slow_query_ms=0)
+    try:
+        patient_id = _make_patient(db)
+        db.get_patient_by_id(patient_id)
+        db.get_patient_by_id(patient_id)
+        with db.get_db_connection() as conn:
+            conn.executemany("INSERT INTO recommendation_sets (set_id, recommendations) VALUES (?, '{}')",
+                             ((f'set{i}',) for i in range(3)))
+    finally:
+        query_stats.disable()
+
+    stats = query_stats.get_query_stats()
+    entry = next(e for e in stats['statements']
+                 if e['sql'] == 'SELECT * FROM patients WHERE patient_id = ?')
+    assert entry['calls'] == 2
+    assert entry['rows'] == 2
+    assert sum(entry['histogram']) == 2
+    entry = next(e for e in stats['statements'] if e['sql'].startswith('INSERT INTO recommendation_sets'))
+    assert (entry['calls'], entry['rows']) == (1, 3)
+    assert any('patients' in step for q in stats['slow_queries'] for step in q['plan'])
+    assert (tmp_path / 'slow.log').exists()
+    query_stats.reset()
+
+
+def test_async_facade_reads_writes_and_transactions(db):
+    import asyncio
+    from async_database import AsyncDatabase
+
+    patient_id = _make_patient(db)
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+
+    async def scenario(adb):
+        assessment_id = await adb.save_risk_assessment(patient_id, 'HIGH', risks, '{}', '{}')
+        async with adb.transaction() as tx:
+            await tx.save_icu_prediction(patient_id, assessment_id, {'icu_needed': 1})
+            assert (await tx.get_icu_prediction(patient_id))['assessment_id'] == assessment_id
+        try:
+            async with adb.transaction() as tx:
+                await tx.save_risk_assessment(patient_id, 'CRITICAL', risks, '{}', '{}')
+                raise RuntimeError('abort')
+        except RuntimeError:
+            pass
+        latest = await asyncio.gather(*[adb.get_latest_risk_assessment(patient_id) for _ in range(8)])
+        # Reader threads cannot write
+        with pytest.raises(sqlite3.OperationalError):
+            await adb.read(db.save_risk_assessment, patient_id, 'LOW', risks, '{}', '{}')
+        return assessment_id, latest
+
+    adb = AsyncDatabase(readers=2)
+    try:
+        assessment_id, latest = asyncio.run(scenario(adb))
+    finally:
+        adb.close()
+    assert {a['assessment_id'] for a in latest} == {assessment_id}
+    assert db.get_icu_prediction(patient_id)['assessment_id'] == assessment_id
+
+
+def test_symptom_logs_archive_by_month_and_union_on_long_history(db):
+    patient_id = _make_patient(db)
+    for _ in range(3):
+        db.save_symptom_log(patient_id, {'painLevel': 3, 'redFlagAlert': True})
+    with db.get_db_connection() as conn:
+        conn.execute('''
+            UPDATE symptom_logs SET logged_at = datetime('now', '-200 days')
+            WHERE log_id IN (SELECT log_id FROM symptom_logs ORDER BY log_id LIMIT 2)
+        ''')
+
+    result = db.archive_symptom_logs(hot_months=3)
+    assert sum(m['rows_moved'] for m in result['months']) == 2
+    with db.get_db_connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM symptom_logs').fetchone()[0] == 1
+
+    assert len(db.get_symptom_history(patient_id, limit=1)) == 1
+    assert len(db.get_symptom_history(patient_id, limit=30)) == 3
+    assert len(db.get_recent_red_flags(patient_id, days=7)) == 1
+    assert len(db.get_recent_red_flags(patient_id, days=365)) == 3
+
+    # The archive keeps the primary key; a run interrupted between its copy and its
+    # delete leaves rows in both files, which readers and the next run tolerate
+    with db.get_db_connection() as conn:
+        db._attach_symptom_archive(conn)
+        assert [c['name'] for c in conn.execute('PRAGMA symptom_archive.table_info(symptom_logs)')
+                if c['pk']] == ['log_id']
+        conn.execute('INSERT INTO main.symptom_logs SELECT * FROM symptom_archive.symptom_logs')
+    assert len(db.get_symptom_history(patient_id, limit=30)) == 3
+    db.archive_symptom_logs(hot_months=3)
+    assert len(db.get_symptom_history(patient_id, limit=30)) == 3
+
+    # Short windows still find logs archived with a short hot window, also in a unit of work
+    with db.get_db_connection() as conn:
+        conn.execute('''
+            UPDATE symptom_logs SET logged_at = datetime('now', 'start of month', '-1 day')
+            WHERE log_id = (SELECT MAX(log_id) FROM symptom_logs)
+        ''')
+    db.archive_symptom_logs(hot_months=0)
+    assert len(db.get_recent_red_flags(patient_id, days=40)) == 1
+    with db.unit_of_work():
+        db.save_symptom_log(patient_id, {'painLevel': 2})
+        assert len(db.get_recent_red_flags(patient_id, days=40)) == 1
+
+
+def _make_beds(db, count, **features):
+    return [db.create_icu_bed(dict({'room_number': f'R{i}', 'floor_number': 1 + i % 2}, **features))
+            for i in range(count)]
+
+
+def test_icu_capacity_counters_follow_bed_changes(db):
+    bed_ids = _make_beds(db, 4)
+    db.create_icu_bed({'room_number': 'V1', 'floor_number': 2, 'has_ventilator': 1})
+    patient_id = _make_patient(db)
+
+    allocation_id = db.allocate_bed(patient_id, bed_ids[0])
+    db.update_bed_status(bed_ids[1], 'maintenance')
+    capacity = db.get_icu_capacity()
+    assert (capacity['total_beds'], capacity['occupied_beds'], capacity['available_beds'],
+            capacity['maintenance_beds']) == (5, 1, 3, 1)
+    assert capacity['utilization_rate'] == 20.0
+
+    db.discharge_from_icu(allocation_id)
+    assert db.get_icu_capacity()['cleaning_beds'] == 1
+    classes = {(r['floor_number'], r['equipment_class']) for r in db.get_icu_capacity_breakdown()}
+    assert classes == {(1, 'standard'), (2, 'standard'), (2, 'ventilator')}
+    assert db.reconcile_icu_capacity() == []
+
+    with db.get_db_connection() as conn:
+        conn.execute('UPDATE icu_capacity SET available_beds = available_beds + 7')
+    assert db.reconcile_icu_capacity(repair=True)
+    assert db.reconcile_icu_capacity() == []
+
+
+def test_read_only_functions_use_query_only_pool(db):
+    import sqlite3
+
+    @db.read_only
+    def try_write():
+        with db.get_db_connection() as conn:
+            conn.execute("UPDATE users SET full_name = 'x'")
+
+    with pytest.raises(sqlite3.OperationalError):
+        try_write()
+
+    with db.get_db_connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    # Inside a unit of work reads see the pending writes on the shared connection
+    patient_id = _make_patient(db)
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+    with db.unit_of_work():
+        assessment_id = db.save_risk_assessment(patient_id, 'HIGH', risks, '{}', '{}')
+        assert db.get_latest_risk_assessment(patient_id)['assessment_id'] == assessment_id
+
+
+def test_streamed_patient_json_matches_dict_rows(db):
+    import json
+
+    assert json.loads(''.join(db.stream_all_patients_json())) == []
+    for i in range(5):
+        _make_patient(db, f'p{i}@example.com')
+
+    streamed = json.loads(''.join(db.stream_all_patients_json(chunk_size=2)))
+    assert streamed == db.get_all_patients()
+
+
+def test_research_export_is_typed_and_incremental(db, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    import research_export
+
+    out_dir = str(tmp_path / 'export')
+    patient_id = _make_patient(db)
+    db.save_symptom_log(patient_id, {'painLevel': 4})
+
+    results = {r['table']: r for r in research_export.export_research_dataset(out_dir, chunk_size=1)}
+    assert results['patients']['rows'] == 1
+    assert results['bed_allocations']['path'] is None
+    table = pq.read_table(results['patients']['path'])
+    assert str(table.schema.field('surgery_date').type) == 'date32[day]'
+    assert str(table.schema.field('created_at').type) == 'timestamp[us]'
+    assert table.column('bmi').to_pylist() == [25.0]
+
+    _make_patient(db, 'second@example.com')
+    results = {r['table']: r for r in research_export.export_research_dataset(out_dir)}
+    assert (results['patients']['rows'], results['patients']['first_id']) == (1, patient_id + 1)
+    assert results['symptom_logs']['rows'] == 0
+    assert pq.read_table(os.path.join(out_dir, 'patients')).num_rows == 2
+
+
+def test_icu_daily_stats_rollup_matches_allocation_history(db):
+    bed_ids = _make_beds(db, 2)
+    patient_id = _make_patient(db)
+    first = db.allocate_bed(patient_id, bed_ids[0])
+    second = db.allocate_bed(patient_id, bed_ids[1])
+    with db.get_db_connection() as conn:
+        conn.execute('''
+            UPDATE bed_allocations SET allocated_at = datetime('now', '-2 days', '-6 hours')
+            WHERE allocation_id = ?
+        ''', (first,))
+    # The catch-up job moves the admission that was counted today to its backdated day
+    db.refresh_icu_daily_stats(days=7)
+
+    assert db.discharge_from_icu(first, 'recovered')
+    assert not db.discharge_from_icu(first, 'recovered')
+    analytics = db.get_icu_analytics(30)
+    assert analytics['total_admissions'] == 1
+    assert analytics['new_admissions'] == 2
+    assert analytics['avg_stay_duration'] == pytest.approx(2.25, abs=0.01)
+    assert analytics['bed_days'] == pytest.approx(2.25, abs=0.01)
+
+    trend = db.get_icu_daily_trend(30)
+    assert len(trend) in (3, 4)
+    assert sum(day['discharges'] for day in trend) == 1
+
+    with db.get_db_connection() as conn:
+        before = conn.execute('SELECT * FROM icu_daily_stats ORDER BY 1, 2').fetchall()
+    db.refresh_icu_daily_stats(days=None)
+    with db.get_db_connection() as conn:
+        after = conn.execute('SELECT * FROM icu_daily_stats ORDER BY 1, 2').fetchall()
+    assert [tuple(r) for r in after] == [pytest.approx(tuple(r)) for r in before]
+    assert db.discharge_from_icu(second)
+
+
+def test_multi_site_shards_route_and_fan_out(db, monkeypatch):
+    import json
+
+    monkeypatch.setattr(db, 'SITES', ['north', 'south'])
+    db.init_database()
+
+    with pytest.raises(db.SiteRequiredError):
+        db.get_all_patients()
+    with db.use_site('north'):
+        _make_patient(db, 'n@example.com')
+        db.create_icu_bed({'room_number': 'N1', 'floor_number': 1})
+    with db.use_site('south'):
+        _make_patient(db, 's1@example.com')
+        _make_patient(db, 's2@example.com')
+        assert len(db.get_all_patients()) == 2
+
+    with db.use_site(db.ALL_SITES):
+        patients = db.get_all_patients()
+        assert sorted(p['site'] for p in patients) == ['north', 'south', 'south']
+        streamed = json.loads(''.join(db.stream_all_patients_json(chunk_size=1)))
+        assert sorted(p['email'] for p in streamed) == sorted(p['email'] for p in patients)
+        capacity = db.get_icu_capacity()
+        assert capacity['total_beds'] == 1 and capacity['sites']['south']['total_beds'] == 0
+        assert db.get_icu_analytics(30)['total_admissions'] == 0
+
+
+def test_recommendations_are_stored_once_and_migrated(db):
+    patient_id = _make_patient(db)
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+    recommendations = '{"aki": ["Monitor creatinine daily"]}'
+
+    for level in ['HIGH', 'HIGH', 'CRITICAL']:
+        db.save_risk_assessment(patient_id, level, risks, recommendations, '{"age": "50 years"}')
+    assert db.get_latest_risk_assessment(patient_id)['recommendations'] == recommendations
+
+    # Rows written before recommendation sets existed keep their JSON inline until migrated
+    with db.get_db_connection() as conn:
+        conn.execute('''
+            INSERT INTO risk_assessments (patient_id, overall_risk, aki_risk, cardiovascular_risk,
+                                          transfusion_risk, recommendations, assessed_at)
+            VALUES (?, 'LOW', 1, 1, 1, '{"legacy": []}', datetime('now', '+1 minute'))
+        ''', (patient_id,))
+    assert db.get_latest_risk_assessment(patient_id)['recommendations'] == '{"legacy": []}'
+
+    report = db.migrate_recommendation_sets()
+    assert (report['assessments_migrated'], report['recommendation_sets']) == (1, 2)
+    assert db.get_latest_risk_assessment(patient_id)['recommendations'] == '{"legacy": []}'
+    assert db.migrate_recommendation_sets()['assessments_migrated'] == 0
+
+
+def test_password_hashing_runs_on_bounded_pool(db, monkeypatch):
+    import password_hashing
+
+    user_id = db.create_user('doc@example.com', 'secret', 'doctor', 'Dr Test')
+    assert db.verify_user('doc@example.com', 'secret')['user_id'] == user_id
+    assert db.verify_user('doc@example.com', 'wrong') is None
+
+    # With every slot taken, callers are turned away instead of queueing forever
+    monkeypatch.setattr(password_hashing, '_slots', password_hashing.threading.BoundedSemaphore(1))
+    monkeypatch.setattr(password_hashing, 'HASH_WAIT_SECONDS', 0.01)
+    password_hashing._slots.acquire()
+    with pytest.raises(password_hashing.HashingOverloaded):
+        db.verify_user('doc@example.com', 'secret')
+    password_hashing._slots.release()
+    password_hashing.shutdown()
+
+
+def test_group_commit_writer_batches_concurrent_symptom_logs(db):
+    import threading
+    from group_commit import GroupCommitWriter
+
+    patient_id = _make_patient(db)
+    writer = GroupCommitWriter(db.SYMPTOM_LOG_INSERT, max_delay_ms=50, max_rows=100)
+    log_ids = []
+
+    def log(pain):
+        log_ids.append(writer.insert(db._symptom_log_row(patient_id, {'painLevel': pain})))
+
+    threads = [threading.Thread(target=log, args=(i % 10,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # A CHECK violation fails only its own row
+    with pytest.raises(db.sqlite3.IntegrityError):
+        writer.insert(db._symptom_log_row(patient_id, {'painLevel': 42}))
+    writer.close()
+
+    assert len(set(log_ids)) == 20
+    assert writer.stats()['flushes'] < 20
+    with db.get_db_connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM symptom_logs').fetchone()[0] == 20
+
+    # A row still queued when its caller times out is never written; one whose
+    # batch is already being written is waited for
+    writer = GroupCommitWriter(db.SYMPTOM_LOG_INSERT, max_delay_ms=1, max_rows=1)
+    release = threading.Event()
+    flush = writer._flush
+    writer._flush = lambda path, items: (release.wait(), flush(path, items))
+    in_flight = []
+    caller = threading.Thread(target=lambda: in_flight.append(
+        writer.insert(db._symptom_log_row(patient_id, {'painLevel': 1}), timeout=0.01)))
+    caller.start()
+    time.sleep(0.05)
+    with pytest.raises(TimeoutError):
+        writer.insert(db._symptom_log_row(patient_id, {'painLevel': 2}), timeout=0.05)
+    release.set()
+    caller.join()
+    assert writer.insert(db._symptom_log_row(patient_id, {'painLevel': 3})) > in_flight[0]
+    writer.close()
+    with db.get_db_connection() as conn:
+        pains = [r[0] for r in conn.execute('SELECT pain_level FROM symptom_logs WHERE log_id > ?',
+                                            (max(log_ids),))]
+    assert pains == [1, 3]
+
+
+def test_maintenance_vacuums_in_steps_and_records_runs(db, monkeypatch):
+    import db_maintenance
+
+    monkeypatch.setattr(db_maintenance, 'VACUUM_STEP_PAGES', 4)
+    patient_id = _make_patient(db)
+    for _ in range(300):
+        db.save_symptom_log(patient_id, {'painLevel': 3, 'notes': 'x' * 500})
+    with db.get_db_connection() as conn:
+        conn.execute('DELETE FROM symptom_logs')
+
+    runs = {r['task']: r for r in db_maintenance.run_maintenance()}
+    assert all(r['status'] == 'ok' for r in runs.values())
+    vacuum = runs['incremental_vacuum']['details']
+    assert vacuum['pages_freed'] > 4 and vacuum['steps'] > 1 and vacuum['freelist_after'] == 0
+    assert runs['checkpoint']['size_after'] < runs['incremental_vacuum']['size_before']
+
+    status = db_maintenance.get_maintenance_status()
+    assert status['pages']['auto_vacuum'] == 'incremental'
+    assert {r['task'] for r in status['last_runs']} == set(db_maintenance.DEFAULT_TASKS)
+
+
+def test_maintenance_optimize_analyzes_tables_without_statistics(db):
+    import db_maintenance
+
+    _make_beds(db, 20)
+    optimize = db_maintenance.run_maintenance(['optimize'])[0]['details']
+    assert optimize['has_statistics'] and 'icu_beds' in optimize['analyzed_tables']
+    with db.get_db_connection() as conn:
+        stats = dict(conn.execute("SELECT idx, stat FROM sqlite_stat1 WHERE tbl = 'icu_beds'").fetchall())
+    assert stats and all(stat.startswith('20 ') for stat in stats.values())
+
+    # Fresh statistics are left alone until the table grows tenfold
+    assert 'icu_beds' not in db_maintenance.run_maintenance(['optimize'])[0]['details']['analyzed_tables']
+    for i in range(200):
+        db.create_icu_bed({'room_number': f'G{i}', 'floor_number': 1})
+    assert 'icu_beds' in db_maintenance.run_maintenance(['optimize'])[0]['details']['analyzed_tables']
+
+    # ...or shrinks tenfold, which the rowid span shows without counting
+    with db.get_db_connection() as conn:
+        conn.execute('DELETE FROM icu_beds WHERE bed_id > 20')
+    assert 'icu_beds' in db_maintenance.run_maintenance(['optimize'])[0]['details']['analyzed_tables']
+
+
+def test_bed_board_indexes_beds_and_writes_through(db):
+    import bed_board
+
+    for i in range(8):
+        db.create_icu_bed({'room_number': f'R{i}', 'proximity_to_nursing_station': 1 + (i * 3) % 8,
+                           'has_ventilator': i % 2, 'has_dialysis': int(i % 3 == 0)})
+    patient_id = _make_patient(db)
+    board = bed_board.get_bed_board()
+    try:
+        for filters in ({}, {'has_ventilator': 1}, {'has_ventilator': 1, 'has_dialysis': 1}):
+            assert board.search('available', filters) == db.get_available_icu_beds(filters)
+
+        nearest = board.best_available({'has_ventilator': 1})
+        assert nearest == db.get_available_icu_beds({'has_ventilator': 1})[0]
+        allocation_id = bed_board.allocate_bed(patient_id, nearest['bed_id'])
+        assert allocation_id and not board.is_available(nearest['bed_id'])
+        assert bed_board.allocate_bed(patient_id, nearest['bed_id']) is None
+        occupied = [b for b in bed_board.get_all_icu_beds() if b['status'] == 'occupied']
+        assert [b['patient_name'] for b in occupied] == ['Test Patient']
+
+        # Writes from other connections are picked up before the next read
+        reloads = board.status()['reloads']
+        db.update_bed_status(board.search('available')[0]['bed_id'], 'maintenance')
+        assert board.counts() == {'available': 6, 'occupied': 1, 'maintenance': 1}
+        assert board.status()['reloads'] == reloads + 1
+
+        # ...while the board's own writes update it in place
+        assert bed_board.discharge_from_icu(allocation_id)
+        assert board.get(nearest['bed_id'])['status'] == 'cleaning'
+        assert board.status()['reloads'] == reloads + 1
+        assert board.search('available') == db.get_available_icu_beds()
+
+        # A write stuck in its transaction does not hold up reads of the board
+        import threading
+        entered, release = threading.Event(), threading.Event()
+        stuck = threading.Thread(target=board._write, args=([], lambda: entered.set() or release.wait()))
+        stuck.start()
+        assert entered.wait(5)
+        reader = threading.Thread(target=lambda: (board.is_available(nearest['bed_id']), board.counts()))
+        reader.start()
+        reader.join(1)
+        assert not reader.is_alive()
+        release.set()
+        stuck.join()
+    finally:
+        bed_board.close_bed_boards()
+
+
+def test_optimal_bed_assignment_beats_greedy_and_keeps_priority(monkeypatch):
+    import bed_assignment
+
+    beds = [{'bed_id': 1, 'proximity_to_nursing_station': 2, 'has_dialysis': 1},
+            {'bed_id': 2, 'proximity_to_nursing_station': 3},
+            {'bed_id': 3, 'proximity_to_nursing_station': 9}]
+    waitlist = [{'patient_id': p} for p in (10, 20, 30, 40)]
+    predictions = {10: {'risk_level': 'CRITICAL'},
+                   20: {'risk_level': 'HIGH', 'dialysis_needed': 1},
+                   30: {'risk_level': 'LOW'},
+                   40: {'risk_level': 'CRITICAL', 'dialysis_needed': 1}}
+
+    greedy = bed_assignment.plan_assignments(waitlist, predictions, beds, 'greedy')
+    assert [(a['patient']['patient_id'], a['bed']['bed_id']) for a in greedy['assignments']] == \
+        [(10, 1), (20, 2), (30, 3)]
+
+    for scipy_available in (bed_assignment.SCIPY_AVAILABLE, False):
+        monkeypatch.setattr(bed_assignment, 'SCIPY_AVAILABLE', scipy_available)
+        plan = bed_assignment.plan_assignments(waitlist, predictions, beds)
+        # Patient 40 ranks below the bed count, so it is not assigned even though it scores highest
+        assert [(a['patient']['patient_id'], a['bed']['bed_id']) for a in plan['assignments']] == \
+            [(10, 2), (20, 1), (30, 3)]
+        assert plan['total_score'] == greedy['total_score'] + 30 == plan['greedy_total_score'] + 30
+
+
+def test_auto_assignment_bulk_loads_predictions_and_allocates_in_one_round(db):
+    import bed_assignment
+    import bed_board
+
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+    patient_ids = []
+    for i, level in enumerate(['CRITICAL', 'HIGH', 'MODERATE', 'HIGH']):
+        patient_id = _make_patient(db, f'p{i}@example.com')
+        db.save_risk_assessment(patient_id, level, risks, '{}', '{}')
+        db.save_icu_prediction(patient_id, None, {'risk_level': level, 'ventilator_needed': 0})
+        db.save_icu_prediction(patient_id, None, {'risk_level': level, 'ventilator_needed': i % 2})
+        patient_ids.append(patient_id)
+    bed_ids = _make_beds(db, 3)
+
+    predictions = db.get_icu_predictions(patient_ids + [999])
+    assert predictions == {p: db.get_icu_prediction(p) for p in patient_ids}
+
+    try:
+        plan = bed_assignment.assign_waiting_patients('optimal')
+        assigned = {a['patient_id']: a['bed_id'] for a in plan['assigned']}
+        # Three beds go to the three highest-priority patients
+        assert set(assigned) == {patient_ids[0], patient_ids[1], patient_ids[3]}
+        assert sorted(assigned.values()) == bed_ids
+        assert bed_board.get_bed_board().count('available') == 0
+        with db.get_db_connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM bed_allocations').fetchone()[0] == 3
+        assert bed_assignment.assign_waiting_patients()['assigned'] == []
+    finally:
+        bed_board.close_bed_boards()
+
+
+def test_concurrent_allocators_never_double_book(db):
+    import random
+    import threading
+
+    import bed_board
+
+    bed_ids = _make_beds(db, 6)
+    patient_ids = [_make_patient(db, f'p{i}@example.com') for i in range(8)]
+    won = []
+    errors = []
+
+    def allocator(n):
+        rng = random.Random(n)
+        # Half go through the bed board, half straight to the database like another process
+        allocate = bed_board.allocate_bed if n % 2 else db.allocate_bed
+        try:
+            for i in range(40):
+                key = f'{n}-{i}'
+                allocation_id = allocate(patient_ids[n], rng.choice(bed_ids), idempotency_key=key)
+                if allocation_id is None:
+                    continue
+                won.append(allocation_id)
+                assert allocate(patient_ids[n], rng.choice(bed_ids), idempotency_key=key) == allocation_id
+                if rng.random() < 0.9:
+                    assert db.discharge_from_icu(allocation_id)
+                    with db.get_db_connection() as conn:
+                        conn.execute("UPDATE icu_beds SET status = 'available' WHERE bed_id = "
+                                     "(SELECT bed_id FROM bed_allocations WHERE allocation_id = ?)",
+                                     (allocation_id,))
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        threads = [threading.Thread(target=allocator, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert not errors
+        assert len(won) == len(set(won)) > len(bed_ids)
+        with db.get_db_connection() as conn:
+            assert conn.execute('SELECT COUNT(*) FROM bed_allocations').fetchone()[0] == len(won)
+            active = conn.execute('''
+                SELECT bed_id, COUNT(*) as n, MAX(patient_id) as patient_id FROM bed_allocations
+                WHERE actual_discharge IS NULL GROUP BY bed_id
+            ''').fetchall()
+            assert all(row['n'] == 1 for row in active)
+            occupied = conn.execute(
+                "SELECT bed_id, patient_id FROM icu_beds WHERE status = 'occupied'"
+            ).fetchall()
+            assert {tuple(row) for row in occupied} == {(row['bed_id'], row['patient_id']) for row in active}
+    finally:
+        bed_board.close_bed_boards()
+
+
+def test_admin_allocation_takes_patients_from_the_waitlist_queue(db):
+    import bed_assignment
+    import bed_board
+    import icu_waitlist_queue
+
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+    _make_beds(db, 3)
+    first, second, outsider = (_make_patient(db, f'p{i}@example.com') for i in range(3))
+    for patient_id in (first, second, outsider):
+        db.save_risk_assessment(patient_id, 'CRITICAL', risks, '{}', '{}')
+    icu_waitlist_queue.add_to_icu_waitlist(second, None, 50)
+    icu_waitlist_queue.add_to_icu_waitlist(first, None, 90)
+
+    try:
+        # The manual endpoint's single allocation goes to the head of the queue
+        manual = bed_assignment.assign_waiting_patients(
+            allocated_by='admin', from_queue=True, limit=1, allocation_type='manual'
+        )['assigned']
+        assert [a['patient_id'] for a in manual] == [first]
+
+        # The auto endpoint's round leaves a scheduled patient who was never queued waiting
+        automatic = bed_assignment.assign_waiting_patients(from_queue=True)['assigned']
+        assert [a['patient_id'] for a in automatic] == [second]
+        assert len(icu_waitlist_queue.get_waitlist_queue()) == 0
+        assert bed_board.get_bed_board().count('available') == 1
+
+        with db.get_db_connection() as conn:
+            rows = conn.execute(
+                'SELECT patient_id, allocated_by, allocation_type FROM bed_allocations'
+            ).fetchall()
+        assert {tuple(row) for row in rows} == {(first, 'admin', 'manual'),
+                                               (second, 'system', 'automatic')}
+    finally:
+        bed_board.close_bed_boards()
+        icu_waitlist_queue.close_waitlist_queues()
+
+
+def test_waitlist_queue_orders_by_aged_priority_and_recovers_from_table(db):
+    import random
+
+    import icu_waitlist_queue
+    from icu_waitlist_queue import IndexedHeap, WaitlistQueue
+
+    heap = IndexedHeap()
+    rng = random.Random(7)
+    keys = {}
+    for item_id in range(200):
+        keys[item_id] = rng.random()
+        heap.push(item_id, keys[item_id])
+    for item_id in rng.sample(range(200), 50):
+        keys[item_id] = rng.random()
+        heap.update(item_id, keys[item_id])
+    for item_id in rng.sample(range(200), 50):
+        heap.remove(item_id)
+        del keys[item_id]
+    assert [heap.pop()[1] for _ in range(len(heap))] == sorted(keys, key=keys.get)
+
+    patient_ids = [_make_patient(db, f'p{i}@example.com') for i in range(4)]
+    # Waited 30 hours at priority 50: ages past a fresh 70, not past a fresh 90
+    with db.get_db_connection() as conn:
+        conn.execute('''
+            INSERT INTO icu_waitlist (patient_id, priority, added_at)
+            VALUES (?, 50, datetime('now', '-30 hours'))
+        ''', (patient_ids[0],))
+
+    waitlist = WaitlistQueue(db.DATABASE_PATH, aging_per_hour=1.0)
+    try:
+        middle = waitlist.enqueue(patient_ids[1], None, 70)
+        top = waitlist.enqueue(patient_ids[2], None, 90)
+        bottom = waitlist.enqueue(patient_ids[3], None, 10)
+        [prediction_id] = db.save_icu_prediction_bulk([{'patient_id': patient_ids[3], 'assessment_id': None,
+                                                        'prediction_data': {'icu_needed': 1}}])
+        assert waitlist.enqueue(patient_ids[3], prediction_id, 20) == bottom
+        assert waitlist.waiting_patient(patient_ids[3])['prediction_id'] == prediction_id
+        order = [e['patient_id'] for e in waitlist.snapshot()]
+        assert order == [patient_ids[2], patient_ids[0], patient_ids[1], patient_ids[3]]
+        assert waitlist.snapshot()[1]['priority_score'] == pytest.approx(80, abs=0.2)
+
+        assert waitlist.reprioritize(middle, 100)
+        assert waitlist.peek()['waitlist_id'] == middle
+        assert waitlist.cancel(top) and not waitlist.cancel(top)
+        assert waitlist.dequeue()['waitlist_id'] == middle
+
+        # A fresh instance rebuilds the same queue from the table
+        recovered = WaitlistQueue(db.DATABASE_PATH, aging_per_hour=1.0)
+        assert recovered.snapshot() == waitlist.snapshot()
+        recovered.close()
+
+        # Commits to other tables do not reload it
+        reloads = waitlist.status()['reloads']
+        _make_patient(db, 'other@example.com')
+        assert len(waitlist) == 2 and waitlist.status()['reloads'] == reloads
+
+        # Allocating a bed elsewhere, or enqueueing in a unit of work, reaches the queue on commit
+        bed_id = _make_beds(db, 1)[0]
+        db.allocate_bed(patient_ids[0], bed_id)
+        with db.unit_of_work():
+            waitlist.enqueue(patient_ids[2], None, 40)
+        assert [e['patient_id'] for e in waitlist.snapshot()] == [patient_ids[2], patient_ids[3]]
+        with db.get_db_connection() as conn:
+            statuses = dict(conn.execute('SELECT patient_id, status FROM icu_waitlist WHERE patient_id = ?',
+                                         (patient_ids[0],)).fetchall())
+        assert statuses == {patient_ids[0]: 'allocated'}
+    finally:
+        waitlist.close()
+        icu_waitlist_queue.close_waitlist_queues()
+
+
+def test_occupancy_forecast_counts_occupants_and_likely_admissions(db):
+    import icu_forecast
+
+    bed_ids = _make_beds(db, 3)
+    db.update_bed_status(bed_ids[2], 'maintenance')
+    occupant, certain, never, later = [_make_patient(db, f'p{i}@example.com') for i in range(4)]
+    db.allocate_bed(occupant, bed_ids[0])
+    with db.get_db_connection() as conn:
+        conn.execute("UPDATE icu_beds SET expected_discharge = datetime('now', '+30 days') "
+                     "WHERE bed_id = ?", (bed_ids[0],))
+        for patient_id, days_ahead in ((certain, 2), (never, 2), (later, 40)):
+            conn.execute("UPDATE patients SET status = 'scheduled', surgery_date = DATE('now', ?) "
+                         "WHERE patient_id = ?", (f'+{days_ahead} days', patient_id))
+    for patient_id, probability in ((certain, 100), (never, 0), (later, 100)):
+        db.save_icu_prediction(patient_id, None, {'icu_needed': 1, 'icu_probability': probability,
+                                                  'predicted_icu_days': 20})
+
+    forecast = icu_forecast.forecast_icu_occupancy(horizon_days=5, scenarios=2000, los_cv=0.1, seed=3)
+    assert (forecast['capacity'], forecast['current_occupants'], forecast['scheduled_patients']) == (2, 1, 1)
+    assert [day['p50'] for day in forecast['days']] == [1, 1, 2, 2, 2]
+    assert forecast['p_over_capacity_any_day'] == 0
+
+    # One bed: the certain admission overflows it from its surgery day on
+    forecast = icu_forecast.forecast_icu_occupancy(horizon_days=5, scenarios=2000, capacity=1,
+                                                 los_cv=0.1, seed=3)
+    assert [day['p_over_capacity'] for day in forecast['days']] == [0, 0, 1, 1, 1]
+    # Days are labelled with the same (UTC) dates the surgery dates were compared with
+    surgery_date = db.get_patient_by_id(certain)['surgery_date']
+    assert forecast['days'][2]['date'] == surgery_date
+
+
+def test_icu_event_stream_publishes_changes_and_resumes_from_last_event_id(db, monkeypatch):
+    import json
+
+    import bed_board
+    import icu_event_stream
+    import icu_waitlist_queue
+
+    monkeypatch.setattr(icu_event_stream, 'POLL_SECONDS', 0.05)
+    bed_ids = _make_beds(db, 2)
+    patient_id = _make_patient(db)
+
+    def read(events, until):
+        """Parsed events from a subscription up to and including one of type until"""
+        received = []
+        for chunk in events:
+            if chunk.startswith('id:'):
+                lines = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+                received.append((lines['id'], lines['event'], json.loads(lines['data'])))
+                if lines['event'] == until:
+                    return received
+        raise AssertionError('stream ended')
+
+    stream = icu_event_stream.get_event_stream()
+    try:
+        events = stream.subscribe(heartbeat=0.05)
+        [(_, _, snapshot)] = read(events, 'snapshot')
+        assert [bed['status'] for bed in snapshot['beds']] == ['available', 'available']
+        assert snapshot['capacity']['available_beds'] == 2 and snapshot['waitlist'] == []
+
+        # Through the bed board (notified) and straight to the database (polled)
+        bed_board.allocate_bed(patient_id, bed_ids[0])
+        received = read(events, 'capacity')
+        [bed] = [data for _, event, data in received if event == 'bed']
+        assert (bed['bed_id'], bed['status'], bed['patient_name']) == (bed_ids[0], 'occupied', 'Test Patient')
+        first_id = received[0][0]
+        db.update_bed_status(bed_ids[1], 'maintenance')
+        assert read(events, 'capacity')[-1][2]['maintenance_beds'] == 1
+        icu_waitlist_queue.add_to_icu_waitlist(patient_id, None, 80)
+        [(_, _, waitlist)] = read(events, 'waitlist')
+        assert [entry['patient_id'] for entry in waitlist] == [patient_id]
+        events.close()
+
+        # A reconnect gets what it missed after its last event; an unknown ID gets a snapshot
+        resumed = read(stream.subscribe(first_id, heartbeat=0.05), 'waitlist')
+        assert [event for _, event, _ in resumed] == ['capacity', 'bed', 'capacity', 'waitlist']
+        [(_, event, snapshot)] = read(stream.subscribe('elsewhere-7', heartbeat=0.05), 'snapshot')
+        assert {bed['bed_id']: bed['status'] for bed in snapshot['beds']} == \
+            {bed_ids[0]: 'occupied', bed_ids[1]: 'maintenance'}
+        assert stream.status()['published'] == 5
+    finally:
+        icu_event_stream.close_event_streams()
+        icu_waitlist_queue.close_waitlist_queues()
+        bed_board.close_bed_boards()
+
+
+def test_icu_ledger_reconstructs_bed_state_at_past_timestamps(db):
+    import icu_ledger
+
+    bed_ids = _make_beds(db, 3)
+    patient_id = _make_patient(db)
+    allocation_id = db.allocate_bed(patient_id, bed_ids[0])
+    icu_ledger.take_snapshot()
+    db.discharge_from_icu(allocation_id)
+    db.update_bed_status(bed_ids[1], 'maintenance')
+    with db.get_db_connection() as conn:
+        conn.execute('DELETE FROM icu_beds WHERE bed_id = ?', (bed_ids[2],))
+        events = conn.execute('SELECT event_type, bed_id, status FROM icu_events ORDER BY event_id').fetchall()
+    assert [tuple(e) for e in events] == [
+        ('created', bed_ids[0], 'available'), ('created', bed_ids[1], 'available'),
+        ('created', bed_ids[2], 'available'), ('updated', bed_ids[0], 'occupied'),
+        ('updated', bed_ids[0], 'cleaning'), ('updated', bed_ids[1], 'maintenance'),
+        ('removed', bed_ids[2], 'available')
+    ]
+
+    # At the time of each event, before and after the snapshot, the replay
+    # matches the ledger read up to that event (several events can share a millisecond)
+    with db.get_db_connection() as conn:
+        rows = conn.execute(f'''
+            SELECT occurred_at, event_type, {db.ICU_EVENT_COLUMNS} FROM icu_events ORDER BY event_id
+        ''').fetchall()
+    expected = {}
+    for i, row in enumerate(rows):
+        if row['event_type'] == 'removed':
+            del expected[row['bed_id']]
+        else:
+            expected[row['bed_id']] = row['status']
+        if i + 1 == len(rows) or rows[i + 1]['occurred_at'] != row['occurred_at']:
+            state = icu_ledger.get_icu_state_at(row['occurred_at'])
+            assert {b['bed_id']: b['status'] for b in state['beds']} == expected
+
+    now = icu_ledger.get_icu_state_at(icu_ledger.datetime.utcnow())
+    assert now['snapshot_id'] is not None and now['events_replayed'] == 3
+    assert (now['capacity']['total_beds'], now['capacity']['cleaning_beds'],
+            now['capacity']['maintenance_beds']) == (2, 1, 1)
+    assert [b['patient_id'] for b in now['beds']] == [None, None]
+    with pytest.raises(ValueError):
+        icu_ledger.get_icu_state_at('2000-01-01T00:00:00')
+
+    first = icu_ledger.get_icu_state_at(rows[0]['occurred_at'])['capacity']
+    series = icu_ledger.get_icu_occupancy_series(rows[0]['occurred_at'], rows[-1]['occurred_at'])
+    assert [(p['occupied'], p['total']) for p in series['points']] == \
+        [(first['occupied_beds'], first['total_beds'])]
+
+
+def test_auto_allocator_assigns_freed_beds_to_queued_patients_under_a_single_lease(db, monkeypatch):
+    import time
+
+    import auto_allocator
+    import bed_board
+    import icu_waitlist_queue
+
+    monkeypatch.setattr(auto_allocator, 'POLL_SECONDS', 0.05)
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+    bed_ids = _make_beds(db, 2)
+    db.update_bed_status(bed_ids[1], 'maintenance')
+    queued, cancelled, outsider, later = (_make_patient(db, f'p{i}@example.com') for i in range(4))
+    for patient_id in (queued, cancelled, outsider, later):
+        db.save_risk_assessment(patient_id, 'CRITICAL', risks, '{}', '{}')
+    icu_waitlist_queue.add_to_icu_waitlist(queued, None, 50)
+    waitlist = icu_waitlist_queue.get_waitlist_queue()
+    waitlist.cancel(icu_waitlist_queue.add_to_icu_waitlist(cancelled, None, 90))
+
+    def occupant(bed_id):
+        return bed_board.get_bed_board().get(bed_id)['patient_id']
+
+    def wait_for_occupant(bed_id, patient_id):
+        deadline = time.monotonic() + 5
+        while occupant(bed_id) != patient_id:
+            assert time.monotonic() < deadline, 'auto-allocation did not happen'
+            time.sleep(0.02)
+
+    allocator = auto_allocator.AutoAllocator(db.DATABASE_PATH, debounce=0.05, strategy='greedy')
+    monkeypatch.setitem(auto_allocator._allocators, db.DATABASE_PATH, allocator)
+    try:
+        # The first pass gives the free bed to the one patient still queued
+        allocator.start()
+        wait_for_occupant(bed_ids[0], queued)
+
+        # A bed released straight through database.py is found by polling, but
+        # a scheduled high-risk patient who was never waitlisted does not get it
+        db.update_bed_status(bed_ids[1], 'available')
+        time.sleep(0.3)
+        assert occupant(bed_ids[1]) is None
+        icu_waitlist_queue.add_to_icu_waitlist(later, None, 40)
+        wait_for_occupant(bed_ids[1], later)
+        assert len(waitlist) == 0
+
+        # The lease keeps any other worker from allocating meanwhile
+        assert not db.acquire_lease(auto_allocator.LEASE_NAME, 'elsewhere', 60)
+        time.sleep(0.3)
+        status = allocator.status()
+        assert status['assigned'] == 2 and status['errors'] == 0
+        # Idle once every bed is taken: no more passes
+        assert status['passes'] == 2
+        latency = status['bed_free_to_assignment_seconds']
+        assert latency['samples'] == 2 and 0 <= latency['max'] < 5
+    finally:
+        allocator.close()
+        bed_board.close_bed_boards()
+        icu_waitlist_queue.close_waitlist_queues()
+    assert db.acquire_lease(auto_allocator.LEASE_NAME, 'elsewhere', 60)
+
+
+def test_icu_recommendations_rank_window_candidates_under_pressure(db):
+    import icu_recommendations
+
+    risks = {'aki': 10.0, 'cardiovascular': 5.0, 'transfusion': 2.0}
+
+    def patient(name, level, icu_probability, days_ahead, emergency=0):
+        patient_id = _make_patient(db, f'{name}@example.com')
+        if level:
+            db.save_risk_assessment(patient_id, level, risks, '{}', '{}')
+        db.save_icu_prediction(patient_id, None, {'icu_probability': icu_probability,
+                                                  'predicted_icu_days': 2})
+        with db.get_db_connection() as conn:
+            conn.execute('''
+                UPDATE patients SET surgery_date = DATE('now', ? || ' days'), emergency_surgery = ?
+                WHERE patient_id = ?
+            ''', (days_ahead, emergency, patient_id))
+        return patient_id
+
+    low = patient('low', 'LOW', 5, 2)
+    moderate = patient('moderate', 'MODERATE', 20, 7)
+    unassessed = patient('unassessed', None, 0, 0)
+    patient('high', 'HIGH', 5, 1)
+    patient('likely-icu', 'LOW', 60, 1)
+    patient('emergency', 'LOW', 5, 1, emergency=1)
+    patient('later', 'LOW', 5, 8)
+    patient('past', 'LOW', 5, -1)
+
+    bed_ids = _make_beds(db, 3)
+    stays = {}
+    for days, level in [(5, 'MODERATE'), (8, 'CRITICAL'), (1, 'LOW')]:
+        occupant = patient(f'occupant{days}', level, 90, 0)
+        bed_id = bed_ids[len(stays)]
+        allocation_id = db.allocate_bed(occupant, bed_id)
+        with db.get_db_connection() as conn:
+            conn.execute("UPDATE bed_allocations SET allocated_at = datetime('now', ? || ' days') "
+                         "WHERE allocation_id = ?", (-days, allocation_id))
+        stays[occupant] = (bed_id, days)
+
+    result = icu_recommendations.get_icu_recommendations()
+    assert result['pressure'] and result['capacity']['utilization_rate'] == 100
+    postpone = result['recommendations']['postpone_elective']
+    assert [r['patient_id'] for r in postpone] == [low, unassessed, moderate]
+    assert [r['days_until'] for r in postpone] == [2, 0, 7]
+    assert postpone[0]['score'] == pytest.approx(60 + 40 * (1 - 5 / 30), abs=0.1)
+
+    # Only the long, non-critical stay; its length comes from the allocation
+    [step_down] = result['recommendations']['expedite_discharge']
+    occupant = next(p for p, (_, days) in stays.items() if days == 5)
+    assert (step_down['patient_id'], step_down['bed_id'], step_down['current_stay_days']) == \
+        (occupant, stays[occupant][0], 5)
+    assert step_down['score'] == pytest.approx(50 + 40)
+
+    db.update_bed_status(bed_ids[2], 'available')
+    with db.get_db_connection() as conn:
+        conn.execute('UPDATE icu_beds SET patient_id = NULL WHERE bed_id = ?', (bed_ids[2],))
+    calm = icu_recommendations.get_icu_recommendations()
+    assert not calm['pressure'] and calm['recommendations']['postpone_elective'] == []
+
+    # A critical (or unknown) risk level scores no readiness instead of NaN
+    ranked = icu_recommendations._rank_step_down([
+        {'patient_id': 1, 'stay_days': 4.0, 'predicted_icu_days': 2, 'risk_level': 'CRITICAL'},
+        {'patient_id': 2, 'stay_days': 4.0, 'predicted_icu_days': 2, 'risk_level': 'HIGH'},
+        {'patient_id': 3, 'stay_days': 4.0, 'predicted_icu_days': None, 'risk_level': 'UNKNOWN'}
+    ], min_days=3)
+    assert [(r['patient_id'], r['score']) for r in ranked] == [(2, 70.0), (1, 50.0), (3, 33.3)]